@@ -22,13 +22,50 @@ PART B: Database with SQLite
     - Design the database with tables for locations, costs, cuisines, and the main table for restaurant attributes.
     - Read the data from the JSON files and store it in an SQLite database.
     - Insert the data into the database (ref db design).
+    - Geocode the restaurants' addresses (latitude / longitude) into a spatial index, for "restaurants near" queries.
+    - Publish a read-only catalog snapshot of the database after each load, for the front end.
 """
 
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
+from lxml import etree
+import gzip
+import io
 import json
+import os
+import queue
+import random
+import re
+import shutil
 import sqlite3
-from collections import defaultdict
+import sys
+import threading
+import time
+import textwrap
+import zlib
+from email.utils import parsedate_to_datetime
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+from urllib.parse import urlencode, urlsplit, urlunsplit
+
+import lab3db
+import lab3trace
+
+# Optional: faster JSON encoder / zstd compression for the JSON Lines files (used if installed)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Site the relative links of the pages (restaurant pages, next directory page) are resolved against
+# (the benchmark points it to a local stand-in of the site)
+SITE_URL = "https://guide.michelin.com"
 
 # URLs to scrape data from
 URL_DICT = {
@@ -36,232 +73,2477 @@ URL_DICT = {
     "Cupertino": "https://guide.michelin.com/us/en/california/cupertino/restaurants",
 }
 
+# Crawl journal: table in the database file, recording the status of every page of a long crawl
+CRAWL_JOURNAL_FILE = "restaurants.db"
+# Seconds a directory page done in the journal is reused (a resumed crawl), older ones are fetched again
+# (a later run finds the new restaurants); the restaurant pages done are always reused
+CRAWL_DIRECTORY_MAX_AGE = 60 * 60
+
+# Region registry: JSON file of region name -> directory url (URL_DICT is used if the file doesn't exist)
+REGIONS_FILE = "regions.json"
+MAX_PARALLEL_REGIONS = 4  # regions scraped at the same time (threads, they share the HTTP client)
+PARSE_PROCESSES = None  # processes parsing the directory pages (None: one per CPU)
+
+# Concurrency limits for crawling the individual restaurant pages
+MAX_CRAWL_WORKERS = 8  # total number of pages fetched at the same time
+PER_HOST_LIMIT = 4  # max number of pages fetched at the same time from one host
+
+# Settings of the shared HTTP client used for all the scraper requests
+POOL_SIZE = MAX_CRAWL_WORKERS  # keep-alive connections kept open per host
+CONNECT_TIMEOUT = 5  # seconds to establish a connection
+READ_TIMEOUT = 20  # seconds to wait for the server to send data
+MAX_RETRIES = 3  # retries of a request that failed with a transient error
+BACKOFF_FACTOR = 0.5  # base delay (seconds) of the exponential backoff between retries
+MAX_BACKOFF = 30  # cap (seconds) of the delay between retries
+RETRY_STATUSES = {429, 500, 502, 503, 504}  # HTTP status codes worth retrying
+
+# Polite rate limiting: token bucket per host, slowed down when the server throttles us
+RATE_LIMIT = 4.0  # requests per second per host
+RATE_BURST = 8  # requests that can be sent at once after an idle period
+MIN_RATE = 0.2  # the adaptive slowdown never goes below this rate (requests per second)
+THROTTLE_STATUSES = {429, 503}  # "Too Many Requests" / "Service Unavailable": slow down
+SLOWDOWN_FACTOR = 0.5  # the rate of a host is multiplied by this when it throttles us
+RECOVERY_STEP = 0.05  # after each success the rate goes back up by this fraction of RATE_LIMIT
+
+# Directory pages fetched ahead while the current page is parsed (the next one + speculative /page/N+k)
+PREFETCH_PAGES = 2
+
+# Settings of the streaming pipeline (scraper -> address crawler -> database)
+PIPELINE_QUEUE_SIZE = 64  # max items waiting between two stages (backpressure)
+PIPELINE_BATCH_SIZE = 100  # rows inserted per database transaction
+PIPELINE_PUT_TIMEOUT = 0.1  # seconds a stage waits on a full queue before checking that its consumer is still there
+
+# Bytes read at a time when a JSON Lines file is checked / repaired before appending to it
+JSON_LINES_CHUNK_SIZE = 1024 * 1024
+
+# Settings of the on-disk HTTP response cache
+HTTP_CACHE_FILE = "http_cache.db"
+CACHE_MAX_AGE = 6 * 60 * 60  # seconds a cached page is used without asking the server (older: conditional GET)
+CACHE_MAX_BYTES = 200 * 1024 * 1024  # size cap of the cached (compressed) pages, least recently used are evicted
+
+# Geocoding: offline gazetteer (postcode / city centers, by country) used by default, and the online geocoder
+GAZETTEER_FILE = "gazetteer.json"
+GEOCODER_URL = "https://nominatim.openstreetmap.org/search"
+GEOCODER_USER_AGENT = "CIS41B-Lab3-restaurants/1.0"  # the geocoding service asks for an identifying User-Agent
+GEOCODER_RATE = 1.0  # requests per second to the online geocoder (its usage policy's limit)
+GEOCODE_BATCH_SIZE = 500  # restaurants read and geocoded at a time
+GEOCODE_COMMIT_INTERVAL = 5.0  # seconds between the commits of a geocoding run (a long run keeps its progress)
+
+# A fetched page: content is the raw body (bytes), parsed is the parse result stored with it (or None),
+# from_cache is True if the body came from the cache (fresh entry or 304 Not Modified)
+CachedPage = namedtuple("CachedPage", ["url", "content", "parsed", "from_cache"])
+
+
+def intern_field(value):
+    """
+    RETURN: the interned string for a str value, other values (None from a JSON null or a NULL column) as is
+    """
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Restaurant:
+    """
+    Compact record of a scraped restaurant (replaces the defaultdict(lambda: "N/A") dictionaries):
+
+        - __slots__: no per-record dict or lambda factory, so much less memory per restaurant
+        - cost, cuisine and location strings are interned (they repeat across restaurants, one copy is kept)
+        - picklable (can be sent to worker processes), hashed by url, equal if all the fields are equal
+        - dict-style access (restaurant["url"], restaurant.get(), .items()) still works, missing fields are "N/A"
+        - fast conversion to a dict (JSON), a tuple (SQLite) and back
+    """
+
+    __slots__ = ("name", "url", "location", "cost", "cuisine", "address")
+    FIELDS = __slots__
+    INTERNED_FIELDS = ("location", "cost", "cuisine")
+
+    def __init__(self, name="N/A", url="N/A", location="N/A", cost="N/A", cuisine="N/A", address="N/A"):
+        self.name = name
+        self.url = url
+        self.location = intern_field(location)
+        self.cost = intern_field(cost)
+        self.cuisine = intern_field(cuisine)
+        self.address = address
+
+    @classmethod
+    def from_dict(cls, dictionary):
+        """
+        RETURN: a Restaurant from a dictionary (for example an item of the JSON file), unknown keys are ignored
+        """
+        return cls(**{field: dictionary[field] for field in cls.FIELDS if field in dictionary})
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def to_tuple(self):
+        """
+        RETURN: the fields as a tuple, in FIELDS order (Restaurant(*record.to_tuple()) is a copy)
+        """
+        return (self.name, self.url, self.location, self.cost, self.cuisine, self.address)
+
+    # dict-style access, so the code (and data) written for the dictionaries keeps working
+    def __getitem__(self, field):
+        if field not in self.FIELDS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __setitem__(self, field, value):
+        if field not in self.FIELDS:
+            raise KeyError(field)
+        setattr(self, field, intern_field(value) if field in self.INTERNED_FIELDS else value)
+
+    def get(self, field, default=None):
+        return getattr(self, field) if field in self.FIELDS else default
+
+    def keys(self):
+        return self.FIELDS
+
+    def items(self):
+        return zip(self.FIELDS, self.to_tuple())
+
+    def __eq__(self, other):
+        if not isinstance(other, Restaurant):
+            return NotImplemented
+        return self.to_tuple() == other.to_tuple()
+
+    def __hash__(self):
+        return hash(self.url)
+
+    def __reduce__(self):
+        # pickle as (class, field tuple): smaller and faster than the default for __slots__ classes
+        return (Restaurant, self.to_tuple())
+
+    def __repr__(self):
+        return f"Restaurant({', '.join(f'{field}={value!r}' for field, value in self.items())})"
+
+
+def json_default(value):
+    """
+    json.dump(default=...) function, so Restaurant records can be written to JSON like dictionaries
+    """
+    if isinstance(value, Restaurant):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class ResponseCache:
+    """
+    Persistent HTTP response cache keyed by URL, stored in an SQLite file:
+
+        - Stores the page body (zlib compressed), its validators (ETag / Last-Modified) and the parse result
+        - Entries younger than max_age are served without a request, older ones are revalidated
+          with a conditional GET (If-None-Match / If-Modified-Since)
+        - Total size is capped, the least recently used entries are evicted first
+    """
+
+    def __init__(self, filename=HTTP_CACHE_FILE, max_age=CACHE_MAX_AGE, max_bytes=CACHE_MAX_BYTES):
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+
+        # the cache is shared by the crawler threads: one connection, guarded by a lock
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS Response (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            content BLOB NOT NULL,
+            parsed TEXT,
+            size INTEGER NOT NULL,
+            fetched_at REAL NOT NULL,
+            last_used REAL NOT NULL
+            )"""
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON Response (last_used)")
+        self.conn.commit()
+
+    def lookup(self, url):
+        """
+        PARAM: url (str) - the url of the page
+        RETURN: dict with etag, last_modified, content, parsed and fresh (bool) keys, or None if not cached
+        """
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT etag, last_modified, content, parsed, fetched_at FROM Response WHERE url = ?", (url,)
+            ).fetchone()
+        if row is None:
+            return None
+
+        etag, last_modified, content, parsed, fetched_at = row
+        return {
+            "etag": etag,
+            "last_modified": last_modified,
+            "content": zlib.decompress(content),
+            "parsed": json.loads(parsed) if parsed is not None else None,
+            "fresh": time.time() - fetched_at < self.max_age,
+        }
+
+    def conditional_headers(self, entry):
+        """
+        RETURN: the If-None-Match / If-Modified-Since headers to revalidate a cached entry
+        """
+        headers = {}
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def store(self, url, response):
+        """
+        Store a 200 response (body + validators), replacing the previous entry and its parse result
+        """
+        content = zlib.compress(response.content)
+        now = time.time()
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO Response (url, etag, last_modified, content, parsed, size, fetched_at, last_used) "
+                "VALUES (?, ?, ?, ?, NULL, ?, ?, ?)",
+                (
+                    url,
+                    response.headers.get("ETag"),
+                    response.headers.get("Last-Modified"),
+                    content,
+                    len(content),
+                    now,
+                    now,
+                ),
+            )
+            self._evict()
+            self.conn.commit()
+
+    def store_parsed(self, url, parsed):
+        """
+        Store the parse result of a cached page, so a fresh or not-modified page doesn't need to be parsed again
+        """
+        with self._lock:
+            self.conn.execute(
+                "UPDATE Response SET parsed = ? WHERE url = ?", (json.dumps(parsed, default=json_default), url)
+            )
+            self.conn.commit()
+
+    def touch(self, url, revalidated=False):
+        """
+        Mark an entry as used (LRU), and restart its max age if the server said it's not modified
+        """
+        now = time.time()
+        with self._lock:
+            if revalidated:
+                self.conn.execute("UPDATE Response SET last_used = ?, fetched_at = ? WHERE url = ?", (now, now, url))
+            else:
+                self.conn.execute("UPDATE Response SET last_used = ? WHERE url = ?", (now, url))
+            self.conn.commit()
+
+    def _evict(self):
+        # delete the least recently used entries until the cache is under its size cap (caller holds the lock)
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM Response").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for url, size in self.conn.execute("SELECT url, size FROM Response ORDER BY last_used").fetchall():
+            self.conn.execute("DELETE FROM Response WHERE url = ?", (url,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def close(self):
+        self.conn.close()
+
+
+def parse_retry_after(value):
+    """
+    PARAM: value (str) - a Retry-After header: a number of seconds or an HTTP date (or None)
+    RETURN: the number of seconds to wait (float), or None if there's no valid value
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Token bucket of one host: tokens are added at `rate` per second up to `burst`, each request takes one.
+    A request that finds no token reserves the next one and waits for it (the count goes negative),
+    so concurrent requests are spaced out instead of all waking up at once.
+    """
+
+    def __init__(self, rate, burst):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0  # no request before this time (Retry-After)
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """
+        Take a token
+        RETURN: the number of seconds to wait before sending the request
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.blocked_until - now)
+
+    def slow_down(self, retry_after=None):
+        """
+        The host throttled us: divide the rate (never below MIN_RATE), no burst,
+        and no request at all during retry_after seconds if the server said so
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.rate = max(MIN_RATE, self.rate * SLOWDOWN_FACTOR)
+            self.tokens = min(self.tokens, 0)
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+
+    def speed_up(self):
+        """
+        Successful request: the rate goes back up slowly, to the base rate
+        """
+        with self.lock:
+            if self.rate < self.base_rate:
+                self._refill(time.monotonic())
+                self.rate = min(self.base_rate, self.rate + self.base_rate * RECOVERY_STEP)
+
+
+class HostRateLimiter:
+    """
+    Scheduler in front of every scraper request: one TokenBucket per host, with adaptive slowdown
+    on 429 / 503 responses (honouring Retry-After), and metrics of the time spent waiting vs fetching.
+    """
+
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.wait_seconds = 0.0
+        self.fetch_seconds = 0.0
+        self.throttled = Counter()  # host -> number of 429 / 503 responses
+
+    def bucket(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rate, self.burst)
+            return self._buckets[host]
+
+    def acquire(self, url):
+        """
+        Wait until a request to the url's host is allowed
+        """
+        wait = self.bucket(url).reserve()
+        if wait > 0:
+            with lab3trace.span("fetch.rate_limit_wait"):
+                time.sleep(wait)
+        with self._lock:
+            self.wait_seconds += wait
+
+    def record(self, url, response, seconds):
+        """
+        Record the result of a request: fetch time, and slow down / speed up the host
+
+        PARAM: response - the requests.Response, or None if the request failed (connection error)
+        PARAM: seconds (float) - time of the request
+        """
+        bucket = self.bucket(url)
+        with self._lock:
+            self.fetch_seconds += seconds
+        if response is not None and response.status_code in THROTTLE_STATUSES:
+            with self._lock:
+                self.throttled[urlsplit(url).netloc] += 1
+            bucket.slow_down(parse_retry_after(response.headers.get("Retry-After")))
+        elif response is not None:
+            bucket.speed_up()
+
+    def stats(self):
+        """
+        RETURN: dict with the time spent waiting for the rate limit vs fetching, the throttled responses
+            per host and the current rate of each host
+        """
+        with self._lock:
+            return {
+                "wait_seconds": round(self.wait_seconds, 3),
+                "fetch_seconds": round(self.fetch_seconds, 3),
+                "throttled": dict(self.throttled),
+                "rates": {host: round(bucket.rate, 3) for host, bucket in self._buckets.items()},
+            }
+
+
+class ScraperClient:
+    """
+    Shared HTTP client for all the scraper requests:
+
+        - Keeps a pool of keep-alive connections per host (requests.Session + HTTPAdapter)
+        - Uses connect and read timeouts on every request
+        - Retries connection errors, timeouts and transient HTTP statuses with exponential backoff and jitter
+        - Counts requests, retries and how many connections were opened vs reused
+        - Optionally uses a ResponseCache (fetch()) to avoid downloading and parsing unchanged pages
+        - Optionally sends every request through a HostRateLimiter (polite crawling, slows down when throttled)
+    """
+
+    def __init__(
+        self,
+        pool_size=POOL_SIZE,
+        timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+        max_retries=MAX_RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        max_backoff=MAX_BACKOFF,
+        cache=None,
+        rate_limiter=None,
+    ):
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+
+        # One session for every request, so connections are reused (keep-alive)
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+
+        # Counters (the client is shared by the crawler threads, so use a lock)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.speculative_misses = 0  # speculative requests of pages that don't exist (404), not failures
+        self.cache_hits = 0
+        self.not_modified = 0
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _backoff(self, attempt):
+        """
+        Sleep before the next retry: exponential backoff with "full jitter"
+        (random delay between 0 and backoff_factor * 2^attempt, capped at max_backoff)
+        """
+        time.sleep(random.uniform(0, min(self.max_backoff, self.backoff_factor * 2**attempt)))
+
+    def get(self, url, headers=None, speculative=False):
+        """
+        GET the url, retrying transient errors
+
+        PARAM: url (str) - the url to fetch
+        PARAM: headers (dict) - extra request headers (optional)
+        PARAM: speculative (bool) - the page may not exist (a guessed url): a 404 / 410 isn't counted as a failure
+        RETURN: the requests.Response
+        RAISES: requests.RequestException if the request still fails after all the retries
+        """
+        for attempt in range(self.max_retries + 1):
+            self._count("requests")
+            if self.rate_limiter:
+                self.rate_limiter.acquire(url)
+
+            start = time.monotonic()
+            response = None
+            try:
+                with lab3trace.span("fetch.http", url=url):
+                    response = self.session.get(url, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    self._count("failures")
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+                    if speculative and response.status_code in (404, 410):
+                        self._count("speculative_misses")
+                    elif response.status_code >= 400:
+                        self._count("failures")
+                    response.raise_for_status()
+                    return response
+                response.close()  # release the connection back to the pool before retrying
+            finally:
+                if self.rate_limiter:
+                    self.rate_limiter.record(url, response, time.monotonic() - start)
+
+            self._count("retries")
+            lab3trace.count("fetch.retries")
+            if self.rate_limiter and response is not None and response.status_code in THROTTLE_STATUSES:
+                continue  # the rate limiter makes the next attempt wait (Retry-After / slower rate)
+            self._backoff(attempt)
+
+    @lab3trace.timed("fetch.page")
+    def fetch(self, url, speculative=False):
+        """
+        Fetch a page through the response cache (if the client has one):
+            - fresh cached page: no request at all
+            - stale cached page: conditional GET, a 304 reuses the cached body and parse result
+            - otherwise: normal GET, and the response is stored in the cache
+
+        PARAM: url (str) - the url to fetch
+        PARAM: speculative (bool) - the page may not exist (see get())
+        RETURN: a CachedPage
+        """
+        if self.cache is None:
+            return CachedPage(url, self.get(url, speculative=speculative).content, None, False)
+
+        entry = self.cache.lookup(url)
+        if entry is not None and entry["fresh"]:
+            self._count("cache_hits")
+            lab3trace.count("fetch.cache_hits")
+            self.cache.touch(url)
+            return CachedPage(url, entry["content"], entry["parsed"], True)
+
+        headers = self.cache.conditional_headers(entry) if entry is not None else None
+        response = self.get(url, headers=headers, speculative=speculative)
+        if entry is not None and response.status_code == 304:
+            self._count("not_modified")
+            lab3trace.count("fetch.not_modified")
+            self.cache.touch(url, revalidated=True)
+            return CachedPage(url, entry["content"], entry["parsed"], True)
+
+        self.cache.store(url, response)
+        return CachedPage(url, response.content, None, False)
+
+    def store_parsed(self, page, parsed):
+        """
+        Keep the parse result of a fetched page in the cache (no-op without a cache)
+        """
+        if self.cache is not None and page.parsed is None:
+            self.cache.store_parsed(page.url, parsed)
+
+    def stats(self):
+        """
+        RETURN: dict of counters: requests, retries, failures, speculative misses, connections opened and reused
+        """
+        # each urllib3 connection pool (one per host) counts the connections it opened and the requests it sent
+        pool_manager = self.adapter.poolmanager
+        pools = [pool_manager.pools[key] for key in pool_manager.pools.keys()]
+        opened = sum(pool.num_connections for pool in pools)
+        sent = sum(pool.num_requests for pool in pools)
+
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "failures": self.failures,
+            "speculative_misses": self.speculative_misses,
+            "cache_hits": self.cache_hits,
+            "not_modified": self.not_modified,
+            "connections_opened": opened,
+            "connections_reused": max(sent - opened, 0),
+            "rate_limiter": self.rate_limiter.stats() if self.rate_limiter else None,
+        }
+
+    def close(self):
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
+
+
+_scraper_client = None
+_scraper_client_lock = threading.Lock()
+
+
+def get_scraper_client():
+    """
+    RETURN: the ScraperClient shared by all the scraper functions
+        (created on first use, with the on-disk cache and the per-host rate limiter)
+    """
+    global _scraper_client
+    with _scraper_client_lock:
+        if _scraper_client is None:
+            _scraper_client = ScraperClient(cache=ResponseCache(), rate_limiter=HostRateLimiter())
+        return _scraper_client
+
+
+def set_scraper_client(client):
+    """
+    Replace the shared ScraperClient (e.g. a client without cache and rate limit for a local benchmark)
+
+    PARAM: client (ScraperClient) - the new shared client
+    RETURN: the previous shared client (None if it wasn't created yet)
+    """
+    global _scraper_client
+    with _scraper_client_lock:
+        previous, _scraper_client = _scraper_client, client
+        return previous
+
+
+# Fast extraction engine: lxml parses the page in C, and precompiled XPath expressions only
+# read the nodes we need (instead of building a BeautifulSoup tree and running CSS selectors)
+HTML_PARSER = etree.HTMLParser(encoding="utf-8", remove_comments=True)
+
+
+def _has_class(name):
+    # XPath predicate for "the class attribute contains this class" (same as a CSS .class selector)
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+# Same elements as the CSS selectors / find_all() of parse_directory_page_bs4() and parse_restaurant_address_bs4()
+XPATH_CARDS = etree.XPath("//div[@class='card__menu box-placeholder js-restaurant__list_item js-match-height js-map']")
+XPATH_CARD_NAME = etree.XPath(
+    f"(.//div[{_has_class('card__menu-content')}]//h3[{_has_class('card__menu-content--title')}])[1]"
+)
+XPATH_CARD_LINK = etree.XPath(f"(.//a[{_has_class('link')}])[1]/@href")
+XPATH_CARD_LOCATION = etree.XPath(f"(.//div[{_has_class('card__menu-footer--location')}])[1]")
+XPATH_CARD_PRICE = etree.XPath(f"(.//div[{_has_class('card__menu-footer--price')}])[1]")
+XPATH_NEXT_PAGE = etree.XPath(
+    f"(//div[{_has_class('btn-carousel')}]//a[{_has_class('btn-carousel__link')}]"
+    f"[contains(@href, '/page/')]"
+    f"[.//span[{_has_class('icon')} and {_has_class('fal')} and {_has_class('fa-angle-right')}]])[1]/@href"
+)
+XPATH_ADDRESS = etree.XPath(f"(//li[{_has_class('restaurant-details__heading--address')}])[1]")
+
+
+def _text(element):
+    # all the text inside an element (same as BeautifulSoup's .text)
+    return "".join(element.itertext())
+
+
+@lab3trace.timed("parse.directory")
+def parse_directory_tree(content):
+    """
+    RETURN: the lxml tree of a directory page (None if the page is empty)
+    """
+    return etree.fromstring(content, HTML_PARSER)
+
+
+@lab3trace.timed("extract.next_page")
+def find_next_page_url(root):
+    """
+    RETURN: url of the next directory page (the link with the right arrow icon), or None if it's the last page
+    """
+    next_page_link = XPATH_NEXT_PAGE(root)
+    return "".join([SITE_URL, next_page_link[0]]) if next_page_link else None
+
+
+@lab3trace.timed("extract.cards")
+def extract_directory_cards(root):
+    """
+    RETURN: list of Restaurant records of the restaurant cards of a directory page tree
+    """
+    restaurant_dict_list = []
+    for card in XPATH_CARDS(root):
+        cost_and_type = _text(XPATH_CARD_PRICE(card)[0]).split("·")
+        restaurant_dict_list.append(
+            Restaurant(
+                name=_text(XPATH_CARD_NAME(card)[0]).strip(),
+                url="".join([SITE_URL, XPATH_CARD_LINK(card)[0]]),
+                location=_text(XPATH_CARD_LOCATION(card)[0]).strip(),
+                cost=cost_and_type[0].strip(),
+                cuisine=cost_and_type[1].strip(),
+            )
+        )
+    return restaurant_dict_list
+
+
+def parse_directory_page(content):
+    """
+    Parse a directory page with lxml + XPath (fast path), and extract for each restaurant card:
+        1. URL of the restaurant
+        2. Name of the restaurant
+        3. Location or city name of the restaurant
+        4. Cost of the restaurant (number of $$ signs)
+        5. Cuisine of the restaurant
+
+    Gives the same result as parse_directory_page_bs4(), several times faster.
+
+    PARAM: content (bytes) - the HTML of the directory page
+    RETURN: tuple (restaurants, next_url)
+        restaurants - list of Restaurant records
+        next_url - url of the next directory page, or None if it's the last page
+    """
+    root = parse_directory_tree(content)
+    if root is None:  # empty page
+        return [], None
 
-def fetch_restaurants_directory_data(url):
+    return extract_directory_cards(root), find_next_page_url(root)
+
+
+@lab3trace.timed("parse.directory_bs4")
+def parse_directory_page_bs4(content):
     """
-    Fetch data from page: use use requests.get() to fetch the page content,
-    and then use BeautifulSoup to parse the HTML and extract:
+    Use BeautifulSoup to parse a directory page and extract for each restaurant card:
         1. URL of the restaurant
         2. Name of the restaurant
         3. Location or city name of the restaurant
         4. Cost of the restaurant (number of $$ signs)
         5. Cuisine of the restaurant
 
-    PARAM: url (str) - the url to scrape data from
-    RETURN: a list of dictionaries, where each dictionary has restaurant details, if fails returns false
+    PARAM: content (bytes) - the HTML of the directory page
+    RETURN: tuple (restaurants, next_url)
+        restaurants - list of Restaurant records
+        next_url - url of the next directory page, or None if it's the last page
+    NOTE: reference implementation of parse_directory_page() (used to check and benchmark the fast path)
+    """
+    soup = BeautifulSoup(content, "lxml")
+    restaurant_dict_list = []
+
+    # Get the restaurant cards
+    cards = soup.find_all("div", class_="card__menu box-placeholder js-restaurant__list_item js-match-height js-map")
+
+    # Get the restaurant details from each card in the list of cards
+    for card in cards:
+        # create a record to store the restaurant details (w/ default vals "N/A" to avoid key errors)
+        restaurant = Restaurant()
+
+        # Get the restaurant name
+        # restaurant["name"] = card.find("restaurant-name")
+        restaurant["name"] = card.select_one("div.card__menu-content h3.card__menu-content--title").text.strip()
+        # ^ select_one() returns the first element that matches the CSS selector
+        # ^ div.card__menu-content h3.card__menu-content--title is the CSS selector
+        # for the <h3> tag with class="card__menu-content--title" inside a <div> tag with class="card__menu-content"
+
+        # Get the restaurant URL
+        restaurant["url"] = "".join([SITE_URL, card.select_one("a.link").get("href")])
+        # ^ a.link is the CSS selector for the <a> tag with class="link"
+        # ^ get() returns the value of the specified attribute - in this case, href (the URL)
+
+        # Get the restaurant location
+        restaurant["location"] = card.select_one("div.card__menu-footer--location").text.strip()
+        # ^ using CSS selector for <div> tag, class="card__menu-footer--location"
+        # NOTE: this also gets the country, which is not needed. will keep for now.
+
+        # Get the restaurant cost and cuisine type from the footer
+        cost_and_type = card.select_one("div.card__menu-footer--price").text.split("·")
+        restaurant["cost"] = cost_and_type[0].strip()
+        restaurant["cuisine"] = cost_and_type[1].strip()
+
+        restaurant_dict_list.append(restaurant)
+
+    # Get the next page URL, if it exists. Only get the link with the right arrow icon!
+    next_page_link = soup.select_one(
+        "div.btn-carousel a.btn-carousel__link[href*='/page/'][href]:has(span.icon.fal.fa-angle-right)"
+    )
+    if next_page_link:
+        next_url = "".join([SITE_URL, next_page_link["href"]])
+    else:
+        next_url = None
+
+    return restaurant_dict_list, next_url
+
+
+def speculative_page_urls(next_url, count):
+    """
+    RETURN: the urls of the count directory pages after next_url, if its url ends with /page/N
+        (the pagination pattern of the Michelin Guide, with its trailing slash if it has one), else an empty list
+    """
+    match = re.search(r"/page/(\d+)(/?)$", next_url)
+    if not match:
+        return []
+    number, slash = int(match.group(1)), match.group(2)
+    return [f"{next_url[:match.start()]}/page/{number + k}{slash}" for k in range(1, count + 1)]
+
+
+def directory_page_key(url):
+    """
+    RETURN: the key of a directory page url for the prefetched pages (no trailing slash), so a guessed
+        /page/N url and the page's real next link match
+    """
+    return url.rstrip("/")
+
+
+def iter_directory_cards(url, client=None, raise_errors=False, parse=None, prefetch=PREFETCH_PAGES):
+    """
+    Generator version of fetch_restaurants_directory_data(): yields the restaurants page by page,
+    so the next stages (like the address crawl) can start before the last directory page is fetched.
+
+    Pagination is pipelined: the next page link is looked up first, and that page is fetched (in a background
+    thread) while the cards of the current page are extracted. When the next page url is /page/N, the pages
+    after it are fetched speculatively too (prefetch pages ahead in total). A guess past the last page is
+    dropped: not fetched if it hasn't started yet, and its 404 isn't counted as a failure.
+
+    PARAM: url (str) - the url to scrape data from
+    PARAM: client (ScraperClient) - the HTTP client to use (default: the shared client)
+    PARAM: raise_errors (bool) - if True, a page that fails raises instead of ending the generator
+    PARAM: parse - function content -> (restaurants, next_url), for example to parse in another process
+        (default None: parse in this thread, finding the next page link before extracting the cards)
+    PARAM: prefetch (int) - number of directory pages fetched ahead (0: no prefetching)
+    YIELDS: Restaurant records
+    """
+    client = client or get_scraper_client()
+    pending = {}  # directory_page_key(url) -> future of the page fetch
+    stopped = threading.Event()  # set when the generator ends: the speculative fetches not started are skipped
+
+    def fetch_page(page_url, speculative):
+        if speculative and stopped.is_set():
+            return None
+        return client.fetch(page_url, speculative=speculative)
+
+    with ThreadPoolExecutor(max_workers=max(prefetch, 1), thread_name_prefix="directory-prefetch") as fetcher:
+
+        def start_fetch(page_urls, speculative=False):
+            for page_url in page_urls:
+                key = directory_page_key(page_url)
+                if key not in pending:
+                    pending[key] = fetcher.submit(fetch_page, page_url, speculative)
+
+        def prefetch_from(next_url):
+            # fetch the next page, and the speculative pages after it
+            if next_url and prefetch:
+                start_fetch([next_url])
+                start_fetch(speculative_page_urls(next_url, prefetch - 1), speculative=True)
+
+        try:
+            # while loop to get all pages
+            # NOTE: recursion would also work, but could be risky for... reasons.
+            while url:
+                # Get the page content (fetched ahead, or now)
+                start_fetch([url])
+                try:
+                    page = pending.pop(directory_page_key(url)).result()
+                except requests.RequestException as error:
+                    if raise_errors:
+                        raise
+                    # keep the pages already yielded, stop here
+                    print(f"Failed to fetch {url}: {error}")
+                    return
+
+                if page.parsed is not None:
+                    # unchanged page: rebuild the restaurant records from the cached parse result
+                    next_url = page.parsed["next_url"]
+                    prefetch_from(next_url)
+                    restaurants = [Restaurant.from_dict(restaurant) for restaurant in page.parsed["restaurants"]]
+                elif parse is None:
+                    # find the next page first, and fetch it while the cards of this page are extracted
+                    root = parse_directory_tree(page.content)
+                    next_url = find_next_page_url(root) if root is not None else None
+                    prefetch_from(next_url)
+                    restaurants = extract_directory_cards(root) if root is not None else []
+                    client.store_parsed(page, {"restaurants": restaurants, "next_url": next_url})
+                else:
+                    restaurants, next_url = parse(page.content)
+                    prefetch_from(next_url)
+                    client.store_parsed(page, {"restaurants": restaurants, "next_url": next_url})
+
+                yield from restaurants
+                url = next_url
+        finally:
+            # last page, error or early stop: drop the fetches still pending (the speculative ones past the end)
+            stopped.set()
+            for future in pending.values():
+                future.cancel()
+
+
+def fetch_restaurants_directory_data(url, client=None, raise_errors=False):
+    """
+    Fetch data from page: use the shared ScraperClient to fetch the page content (through the response cache),
+    and parse_directory_page() to extract the restaurants. Follows the next page links to get all pages.
+    A page that is not modified since the last run is not parsed again (the cached parse result is used).
+
+    PARAM: url (str) - the url to scrape data from
+    PARAM: client (ScraperClient) - the HTTP client to use (default: the shared client)
+    PARAM: raise_errors (bool) - if True, a page that fails raises instead of returning a partial list
+    RETURN: a list of Restaurant records.
+        If a page fails (after retries), the restaurants of the pages already fetched are returned.
+    """
+    return list(iter_directory_cards(url, client, raise_errors))
+
+
+@lab3trace.timed("parse.restaurant")
+def parse_restaurant_address(content):
+    """
+    Parse a restaurant page with lxml + XPath (fast path) and extract the address.
+    Gives the same result as parse_restaurant_address_bs4().
+
+    PARAM: content (bytes) - the HTML of the restaurant page
+    RETURN: the street address and city of the restaurant (str), "" if not found
+    """
+    root = etree.fromstring(content, HTML_PARSER)
+    address_element = XPATH_ADDRESS(root) if root is not None else None
+    if address_element:
+        return _text(address_element[0]).strip()
+    else:
+        return ""
+
+
+@lab3trace.timed("parse.restaurant_bs4")
+def parse_restaurant_address_bs4(content):
+    """
+    Use BeautifulSoup to parse a restaurant page and extract the address
+    (reference implementation of parse_restaurant_address())
+
+    PARAM: content (bytes) - the HTML of the restaurant page
+    RETURN: the street address and city of the restaurant (str), "" if not found
+    """
+    soup = BeautifulSoup(content, "lxml")
+
+    # get the restaurant address
+    address_element = soup.select_one("li.restaurant-details__heading--address")
+    if address_element:
+        return address_element.text.strip()
+    else:
+        return ""
+
+
+@lab3trace.timed("scrape.restaurant")
+def extract_restaurant_address(url, client=None):
+    """
+    Use the URL of the restaurant to extract address (street address and city).
+    The page is fetched through the response cache, an unchanged page is not parsed again.
+
+    PARAM: url (str) - url of the restaurants' Michelin page
+    PARAM: client (ScraperClient) - the HTTP client to use (default: the shared client)
+    RETURN: the street address and city of the restaurant (str)
+    """
+    client = client or get_scraper_client()
+
+    page = client.fetch(url)
+    if page.parsed is not None:
+        return page.parsed["address"]
+
+    address = parse_restaurant_address(page.content)
+    client.store_parsed(page, {"address": address})
+    return address
+
+
+class HostSemaphores:
+    """
+    One semaphore per host, to limit the number of requests in flight to the same host
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        """
+        RETURN: the semaphore of the url's host (created on first use)
+        """
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.limit)
+            return self._semaphores[host]
+
+
+def crawl_restaurant_addresses(urls, max_workers=MAX_CRAWL_WORKERS, per_host_limit=PER_HOST_LIMIT, on_result=None):
+    """
+    Crawl the restaurant pages concurrently (thread pool) to extract the addresses.
+    The number of requests in flight to the same host is limited by a semaphore per host,
+    and a failing page does not stop the crawl of the other pages.
+
+    PARAM: urls (list of str) - urls of the restaurants' Michelin pages
+    PARAM: max_workers (int) - number of threads fetching pages
+    PARAM: per_host_limit (int) - max number of concurrent requests to one host
+    PARAM: on_result - optional function on_result(url, address, error) called (from the crawler threads)
+        as soon as each page is done, error is None on success (used to journal the crawl)
+    RETURN: tuple (addresses, failures)
+        addresses - list of addresses in the same order as urls (None if the page failed)
+        failures - dict of url -> error message for every page that failed
+    """
+    host_semaphores = HostSemaphores(per_host_limit)
+
+    def crawl(url):
+        with host_semaphores.get(url):
+            try:
+                address = extract_restaurant_address(url)
+            except Exception as error:
+                if on_result:
+                    on_result(url, None, f"{type(error).__name__}: {error}")
+                raise
+        if on_result:
+            on_result(url, address, None)
+        return address
+
+    addresses = []
+    failures = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # submit all urls first, then collect the results in input order
+        futures = [executor.submit(crawl, url) for url in urls]
+        for url, future in zip(urls, futures):
+            try:
+                addresses.append(future.result())
+            except Exception as error:  # report the failure, keep crawling the rest
+                addresses.append(None)
+                failures[url] = f"{type(error).__name__}: {error}"
+
+    return addresses, failures
+
+
+def add_restaurant_addresses(restaurants, max_workers=MAX_CRAWL_WORKERS, per_host_limit=PER_HOST_LIMIT):
+    """
+    Use the restaurant urls to get the street addresses (concurrently), and add them to the records.
+    Restaurants whose page failed get "N/A" as address, and the failures are printed.
+
+    PARAM: restaurants (list of Restaurant) - the restaurant records
+    RETURN: dict of url -> error message for the pages that failed
+    """
+    addresses, failures = crawl_restaurant_addresses(
+        [restaurant["url"] for restaurant in restaurants], max_workers, per_host_limit
+    )
+    for restaurant, address in zip(restaurants, addresses):
+        restaurant["address"] = address if address is not None else "N/A"
+
+    for url, error in failures.items():
+        print(f"Failed to get address from {url}: {error}")
+
+    return failures
+
+
+def write_to_json_file(restauraunts_dict, filename):
+    """
+    Write data to a JSON file
+
+    PARAM: data - the data to write to the file
+    PARAM: filename - the name of the file to write to
+    TODO: try using args and kwargs??
+    """
+    with open(filename, "w", encoding="utf-8") as file:
+        json.dump(restauraunts_dict, file, indent=4, default=json_default)
+
+
+class JsonFileSink:
+    """
+    Writes restaurants to a JSON file one at a time (streaming), in the same format as write_to_json_file()
+    """
+
+    def __init__(self, filename):
+        self.file = open(filename, "w", encoding="utf-8")
+        self.count = 0
+
+    def write(self, restaurant):
+        # each restaurant is an item of the JSON list, indented like json.dump(..., indent=4) does
+        self.file.write("[\n" if self.count == 0 else ",\n")
+        self.file.write(textwrap.indent(json.dumps(restaurant, indent=4, default=json_default), "    "))
+        self.count += 1
+
+    def close(self):
+        self.file.write("[]" if self.count == 0 else "\n]")
+        self.file.close()
+
+
+def open_json_lines(filename, mode):
+    """
+    Open a JSON Lines file in binary mode, compressed according to its extension:
+    .gz (gzip), .zst (zstd, needs the zstandard package), anything else is not compressed.
+    In append mode a compressed file gets a new gzip member / zstd frame, which the reader reads across.
+
+    PARAM: filename (str) - the file
+    PARAM: mode (str) - "rb", "wb" or "ab"
+    RETURN: a binary file object
+    """
+    if filename.endswith(".gz"):
+        return gzip.open(filename, mode)
+    if filename.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError("the zstandard package is needed to read / write .zst files")
+        if mode == "rb":
+            reader = zstandard.ZstdDecompressor().stream_reader(open(filename, "rb"), read_across_frames=True)
+            return io.BufferedReader(reader)
+        return zstandard.open(filename, mode)
+    return open(filename, mode)
+
+
+def encode_json_line(restaurant):
+    """
+    RETURN: the restaurant as one compact line of JSON (bytes, UTF-8, with the newline), using orjson if installed
+    """
+    if orjson is not None:
+        return orjson.dumps(restaurant, default=json_default, option=orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(restaurant, default=json_default, ensure_ascii=False, separators=(",", ":")) + "\n").encode()
+
+
+def json_lines_read_errors():
+    """
+    RETURN: tuple of the exceptions raised when reading a damaged (torn) compressed JSON Lines file
+    """
+    errors = (EOFError, gzip.BadGzipFile, zlib.error)
+    return errors + (zstandard.ZstdError,) if zstandard is not None else errors
+
+
+def _json_lines_decompressor(filename):
+    """
+    RETURN: a function returning a decompressor of one gzip member / zstd frame of the file (with the eof and
+        unused_data attributes), or None if the file isn't compressed
+    """
+    if filename.endswith(".gz"):
+        return lambda: zlib.decompressobj(wbits=31)
+    if filename.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError("the zstandard package is needed to read / write .zst files")
+        return lambda: zstandard.ZstdDecompressor().decompressobj()
+    return None
+
+
+def _truncate_after_last_newline(file):
+    """
+    Truncate a binary file (opened "r+b") after its last newline, reading it backwards
+
+    RETURN: the number of bytes removed
+    """
+    end = file.seek(0, os.SEEK_END)
+    position, size = end, 0
+    while position > 0:
+        start = max(0, position - JSON_LINES_CHUNK_SIZE)
+        file.seek(start)
+        newline = file.read(position - start).rfind(b"\n")
+        if newline >= 0:
+            size = start + newline + 1
+            break
+        position = start
+    if size != end:
+        file.truncate(size)
+    return end - size
+
+
+def _last_member(filename, make_decompressor):
+    """
+    Decompress a gzip / zstd file member by member (the output is dropped)
+
+    RETURN: (offset where the last member starts, True if it's complete)
+    """
+    member_start, complete, offset = 0, True, 0
+    decompressor = None
+    with open(filename, "rb") as file:
+        while chunk := file.read(JSON_LINES_CHUNK_SIZE):
+            while chunk:
+                if decompressor is None:
+                    decompressor, member_start, complete = make_decompressor(), offset, False
+                try:
+                    decompressor.decompress(chunk)
+                except json_lines_read_errors():
+                    return member_start, False  # damaged member: everything from it is rewritten
+                if decompressor.eof:
+                    offset += len(chunk) - len(decompressor.unused_data)
+                    chunk = decompressor.unused_data
+                    decompressor, complete = None, True
+                else:
+                    offset += len(chunk)
+                    chunk = b""
+    return member_start, complete
+
+
+def repair_json_lines(filename):
+    """
+    Make a JSON Lines file end with a complete record, so restaurants can be appended to it. A write that was
+    interrupted leaves a torn last line, or a compressed file whose last gzip member / zstd frame has no end
+    (its content up to the last flush can still be decompressed):
+
+        - not compressed: the file is truncated after its last newline
+        - compressed: the file is decompressed to find its last member; if it's incomplete, its complete
+          lines are compressed again into a new, complete member, which replaces it
+
+    PARAM: filename (str) - the file (.jsonl, .jsonl.gz or .jsonl.zst)
+    RETURN: True if the file was repaired
+    """
+    make_decompressor = _json_lines_decompressor(filename)
+    if make_decompressor is None:
+        with open(filename, "r+b") as file:
+            return _truncate_after_last_newline(file) > 0
+
+    member_start, complete = _last_member(filename, make_decompressor)
+    if complete:
+        return False
+
+    # Compress the complete lines of the last member into a new member (in a temporary file of the same format)
+    base, extension = os.path.splitext(filename)
+    temporary = f"{base}.repair{extension}"
+    decompressor, pending = make_decompressor(), b""
+    with open(filename, "rb") as source, open_json_lines(temporary, "wb") as target:
+        source.seek(member_start)
+        while chunk := source.read(JSON_LINES_CHUNK_SIZE):
+            try:
+                data = pending + decompressor.decompress(chunk)
+            except json_lines_read_errors():
+                break
+            lines, newline, pending = data.rpartition(b"\n")
+            if newline:
+                target.write(lines + newline)
+
+    # Replace the incomplete member with the new one
+    with open(filename, "r+b") as file, open(temporary, "rb") as repaired:
+        file.truncate(member_start)
+        file.seek(member_start)
+        shutil.copyfileobj(repaired, file)
+    os.remove(temporary)
+    return True
+
+
+class JsonLinesSink:
+    """
+    Appends restaurants to a JSON Lines file (one compact JSON object per line), optionally gzip / zstd compressed.
+
+        - the restaurants are written as they are scraped (nothing is kept in memory)
+        - the file is opened in append mode, so a scrape that stopped can be resumed in the same file
+          (a torn last record or compressed member is repaired first: repair_json_lines())
+        - the default pretty JSON (write_to_json_file(), JsonFileSink) stays the export format
+    """
+
+    def __init__(self, filename, flush_every=PIPELINE_BATCH_SIZE):
+        if os.path.exists(filename):
+            repair_json_lines(filename)
+        self.file = open_json_lines(filename, "ab")
+        self.flush_every = flush_every
+        self.count = 0
+
+    def write(self, restaurant):
+        self.file.write(encode_json_line(restaurant))
+        self.count += 1
+        if self.count % self.flush_every == 0:
+            self.file.flush()  # (so a crash loses at most the last few restaurants)
+
+    def close(self):
+        self.file.close()
+
+
+def iter_json_lines(filename):
+    """
+    Lazily read the restaurants of a JSON Lines file (see JsonLinesSink), one at a time.
+    Damaged records (a write that was interrupted) are skipped, and counted in a message:
+        - an incomplete last line, or a line that isn't valid JSON (a torn record followed by appended ones)
+        - an incomplete or corrupt gzip member / zstd frame: the file is read up to it
+
+    PARAM: filename (str) - the file (.jsonl, .jsonl.gz or .jsonl.zst)
+    YIELDS: Restaurant records
+    """
+    loads = orjson.loads if orjson is not None else json.loads
+    damaged = 0
+    with open_json_lines(filename, "rb") as file:
+        try:
+            for line in file:
+                if not line.endswith(b"\n"):
+                    damaged += 1  # interrupted write
+                    break
+                try:
+                    record = loads(line)
+                except ValueError:  # (json and orjson decode errors)
+                    damaged += 1
+                    continue
+                yield Restaurant.from_dict(record)
+        except json_lines_read_errors():
+            damaged += 1  # torn compressed member: the records after it can't be found
+    if damaged:
+        print(f"Skipped {damaged} damaged record(s) of {filename}")
+
+
+def open_sink(filename):
+    """
+    RETURN: the sink for a file name: JsonLinesSink for .jsonl (.gz, .zst) files, JsonFileSink (pretty JSON) otherwise
+    """
+    if ".jsonl" in filename:
+        return JsonLinesSink(filename)
+    return JsonFileSink(filename)
+
+
+def create_database(filename="restaurants.db"):
+    """
+    Create the SQLite database and the tables needed with the following schema:
+    - Restaurant name
+    - Restaurant URL
+    - Location (lookup table), int : city
+    - Cost (lookup table), int : n$
+    - Cuisine type (lookup table), int : type
+    - Addess (street address and city)
+    - Delisted flag (1 if the restaurant is no longer listed on the Michelin Guide)
+
+    then migrates it to the current schema version (lab3db.migrate()): cost levels, cities and countries,
+    every cuisine of a restaurant (RestaurantCuisine), and the indexes of the front end's queries,
+    and tunes the connection for loading (tune_database_connection())
+
+    PARAM: filename (str) - the database file
+    RETURN: the database connection (type: sqlite3.connect??)
+    """
+    conn = sqlite3.connect(filename)  # Connect to the database
+    cursor = conn.cursor()
+
+    # -------------------------------------------#
+    # Create the tables needed for the database #
+    # -------------------------------------------#
+
+    # Create the "Cuisine" lookup table
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS Cuisine (
+        cuisine_id INTEGER PRIMARY KEY,
+        cuisine_name TEXT UNIQUE
+        )"""
+    )
+
+    # Create the "Cost" lookup table
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS Cost (
+        cost_id INTEGER PRIMARY KEY,
+        cost_symbol TEXT UNIQUE
+        )"""
+    )
+
+    # Create the "Location" lookup table
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS Location (
+        location_id INTEGER PRIMARY KEY,
+        location_name TEXT UNIQUE
+        )"""
+    )
+
+    # Create the "Restaurant" table
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS Restaurant (
+        restaurant_id INTEGER PRIMARY KEY,
+        restaurant_name TEXT UNIQUE,
+        restaurant_url TEXT UNIQUE,
+        cuisine_id INTEGER,
+        cost_id INTEGER,
+        location_id INTEGER,
+        street_address TEXT NOT NULL,
+        delisted INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY (cuisine_id) REFERENCES Cuisine (cuisine_id),
+        FOREIGN KEY (cost_id) REFERENCES Cost (cost_id),
+        FOREIGN KEY (location_id) REFERENCES Location (location_id)
+        )"""
+    )
+
+    # Databases created before the incremental mode don't have the "delisted" column yet
+    columns = [column[1] for column in cursor.execute("PRAGMA table_info(Restaurant)")]
+    if "delisted" not in columns:
+        cursor.execute("ALTER TABLE Restaurant ADD COLUMN delisted INTEGER NOT NULL DEFAULT 0")
+
+    # Add indeces to the foreign key columns in the "Restaurant" table
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cuisine_id ON Restaurant (cuisine_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cost_id ON Restaurant (cost_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_location_id ON Restaurant (location_id)")
+
+    conn.commit()  # Commit the changes to the database
+
+    # Migrate to the current schema (only the missing migrations run: the version is stored in the file)
+    lab3db.migrate(conn)
+    tune_database_connection(conn)  # (once per connection: the loads reuse it)
+
+    return conn  # Return the database connection
+
+
+@lab3trace.timed("db.insert")
+def insert_into_database(conn, dict_list):
+    """
+    Insert the data into the SQLite database
+
+    PARAM: conn - the database connection
+    PARAM: dict_list - the data to insert into the database (Restaurant records, or dictionaries from the JSON file)
+    """
+    cursor = conn.cursor()  # Get the cursor
+
+    # Insert into the database in the order that respects the foreign key constraints
+    for row in dict_list:
+        # Extract the values from the dictionary
+        restaurant_name = row["name"]
+        restaurant_url = row["url"]
+        cuisine_names = lab3db.split_cuisines(row["cuisine"])  # e.g. "Japanese, Sushi": the primary cuisine first
+        cost_symbol = row["cost"]
+        location_name = row["location"]
+        street_address = row["address"]
+
+        # Insert the cuisines into the "Cuisine" table, using INSERT OR IGNORE to avoid duplicate entries
+        cuisine_ids = []
+        for cuisine_name in cuisine_names:
+            cursor.execute(
+                "INSERT OR IGNORE INTO Cuisine (cuisine_name) VALUES (?)",
+                (cuisine_name,),
+            )
+            cursor.execute("SELECT cuisine_id FROM Cuisine WHERE cuisine_name = ?", (cuisine_name,))
+            cuisine_ids.append(cursor.fetchone()[0])  # Use fetchone() to get the id of the last inserted row
+
+        # Insert the data into the "Cost" table using INSERT OR IGNORE to avoid duplicate entries
+        cursor.execute(
+            "INSERT OR IGNORE INTO Cost (cost_symbol) VALUES (?)",
+            (cost_symbol,),
+        )
+        # Get the id of the last inserted row to use as the foreign key for the "Restaurant" table
+        cursor.execute("SELECT cost_id FROM Cost WHERE cost_symbol = ?", (cost_symbol,))
+        cost_id = cursor.fetchone()[0]
+
+        # Insert the data into the "Location" table
+        cursor.execute(
+            "INSERT OR IGNORE INTO Location (location_name) VALUES (?)",
+            (location_name,),
+        )
+        cursor.execute("SELECT location_id FROM Location WHERE location_name = ?", (location_name,))
+        location_id = cursor.fetchone()[0]
+
+        # Insert the data into the "Restaurant" table using INSERT OR IGNORE to avoid duplicate entries
+        cursor.execute(
+            "INSERT OR IGNORE INTO Restaurant (restaurant_name, restaurant_url, cuisine_id, cost_id, cost_level, location_id, street_address) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                restaurant_name,
+                restaurant_url,
+                cuisine_ids[0],
+                cost_id,
+                lab3db.cost_level(cost_symbol),
+                location_id,
+                street_address,
+            ),
+        )
+
+        # Link the restaurant to all its cuisines (only if it was inserted: an existing restaurant keeps its own)
+        if cursor.rowcount == 1:
+            lab3db.link_cuisines(
+                conn, [(restaurant_url, cuisine_id, position) for position, cuisine_id in enumerate(cuisine_ids)]
+            )
+
+    lab3db.normalize_locations(conn)  # city and country of the new locations
+    conn.commit()  # Commit the changes to the database
+
+
+# Lookup tables: table -> (id column, name column, key of the value in the restaurant dictionaries)
+LOOKUP_TABLES = {
+    "Cuisine": ("cuisine_id", "cuisine_name", "cuisine"),
+    "Cost": ("cost_id", "cost_symbol", "cost"),
+    "Location": ("location_id", "location_name", "location"),
+}
+BULK_CHUNK_SIZE = 10000  # rows resolved and inserted per executemany() call by the bulk loader
+
+
+def tune_database_connection(conn):
+    """
+    Set the pragmas for fast loading (once per connection: create_database() does it):
+        - WAL journal: readers (the GUI) aren't blocked by the writer, and commits are cheaper
+        - synchronous=NORMAL: no fsync on every commit (safe with WAL, only the last commits can be lost on power loss)
+        - temp_store=MEMORY and a bigger page cache (for index building)
+    """
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -64000")  # (negative: in KiB, so 64 MB)
+
+
+class LookupIds:
+    """
+    In-memory name -> id cache of the lookup tables (Cuisine, Cost, Location), loaded once from the database.
+    New names are inserted with executemany() and added to the cache.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.ids = {}
+        for table, (id_column, name_column, _) in LOOKUP_TABLES.items():
+            query = f"SELECT {name_column}, {id_column} FROM {table}"
+            self.ids[table] = dict(conn.execute(query))
+
+    def add_names(self, table, names):
+        """
+        Insert the names that are not in the cache yet, and cache their ids
+        """
+        id_column, name_column, _ = LOOKUP_TABLES[table]
+        cache = self.ids[table]
+        new_names = {name for name in names if name not in cache}
+        if not new_names:
+            return
+
+        self.conn.executemany(
+            f"INSERT OR IGNORE INTO {table} ({name_column}) VALUES (?)", [(name,) for name in new_names]
+        )
+        placeholders = ", ".join("?" * len(new_names))
+        query = f"SELECT {name_column}, {id_column} FROM {table} WHERE {name_column} IN ({placeholders})"
+        cache.update(self.conn.execute(query, list(new_names)))
+
+
+@lab3trace.timed("db.bulk_insert")
+def bulk_insert_into_database(conn, dict_list, lookup_ids=None):
+    """
+    Bulk version of insert_into_database(), for large loads:
+        - lookup ids come from an in-memory cache (LookupIds) instead of an INSERT + SELECT per row and table
+        - new lookup values and the restaurants are inserted with executemany(), in chunks
+        - the whole load is one explicit transaction (rolled back if anything fails); if the caller already
+          has a transaction open, the load is part of it instead (the caller commits or rolls back)
+        - a restaurant already in the database (same url or name) is skipped, with its cuisines: its search
+          row isn't rebuilt during the load, so it must not change (use upsert_into_database() to update it)
+
+    PARAM: conn - the database connection (from create_database(), tuned for loading)
+    PARAM: dict_list - the data to insert into the database (any iterable, read in chunks)
+    PARAM: lookup_ids (LookupIds) - cache to reuse between calls (optional)
+    RETURN: the number of rows processed
+    """
+    lookup_ids = lookup_ids or LookupIds(conn)
+    rows = iter(dict_list)
+    count = 0
+
+    own_transaction = not conn.in_transaction
+    if own_transaction:
+        conn.execute("BEGIN")
+    try:
+        # the new restaurants are added to the search index once at the end of the load
+        with lab3db.deferred_search_index(conn):
+            while True:
+                chunk = list(islice(rows, BULK_CHUNK_SIZE))
+                if not chunk:
+                    break
+
+                # resolve the lookup ids of the chunk (new names are inserted first)
+                cuisines = {name: lab3db.split_cuisines(name) for name in {row["cuisine"] for row in chunk}}
+                lookup_ids.add_names("Cuisine", {name for names in cuisines.values() for name in names})
+                lookup_ids.add_names("Cost", {row["cost"] for row in chunk})
+                lookup_ids.add_names("Location", {row["location"] for row in chunk})
+                cuisine_ids, cost_ids, location_ids = (
+                    lookup_ids.ids[table] for table in ("Cuisine", "Cost", "Location")
+                )
+
+                last_id = conn.execute("SELECT COALESCE(MAX(restaurant_id), 0) FROM Restaurant").fetchone()[0]
+                conn.executemany(
+                    "INSERT OR IGNORE INTO Restaurant "
+                    "(restaurant_name, restaurant_url, cuisine_id, cost_id, cost_level, location_id, street_address) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (
+                            row["name"],
+                            row["url"],
+                            cuisine_ids[cuisines[row["cuisine"]][0]],
+                            cost_ids[row["cost"]],
+                            lab3db.cost_level(row["cost"]),
+                            location_ids[row["location"]],
+                            row["address"],
+                        )
+                        for row in chunk
+                    ],
+                )
+                # link the cuisines of the inserted rows only (new ids; the first row of a url repeated in the chunk)
+                new_rows = conn.execute("SELECT restaurant_url FROM Restaurant WHERE restaurant_id > ?", (last_id,))
+                inserted = {url for (url,) in new_rows}
+                linked = []
+                for row in chunk:
+                    if row["url"] in inserted:
+                        inserted.discard(row["url"])
+                        linked.append(row)
+                lab3db.link_cuisines(
+                    conn,
+                    (
+                        (row["url"], cuisine_ids[name], position)
+                        for row in linked
+                        for position, name in enumerate(cuisines[row["cuisine"]])
+                    ),
+                )
+                count += len(chunk)
+            lab3db.normalize_locations(conn)
+        if own_transaction:
+            conn.commit()
+    except BaseException:
+        if own_transaction:
+            conn.rollback()
+        raise
+
+    return count
+
+
+def get_lookup_id(cursor, table, id_column, name_column, name):
+    """
+    Get the id of a value in a lookup table (Cuisine, Cost, Location), inserting the value if it's new
+
+    RETURN: the id (int)
+    """
+    cursor.execute(f"INSERT OR IGNORE INTO {table} ({name_column}) VALUES (?)", (name,))
+    cursor.execute(f"SELECT {id_column} FROM {table} WHERE {name_column} = ?", (name,))
+    return cursor.fetchone()[0]
+
+
+@lab3trace.timed("db.upsert")
+def upsert_into_database(conn, dict_list, listed_urls=None):
+    """
+    Insert new restaurants and update the existing ones (matched by url) in the SQLite database.
+    Unlike insert_into_database(), a restaurant that changed is updated, and a delisted one is listed again.
+
+    Restaurant names are unique too, so a restaurant whose name is already used by another url is:
+        - moved to its new url (the row of the old url is updated), if the old url isn't in listed_urls
+        - skipped (and printed) if the old url is still listed: two restaurants can't have the same name
+    A restaurant whose address is None keeps its stored address (e.g. its page failed).
+
+    PARAM: conn - the database connection
+    PARAM: dict_list - the restaurants to insert or update
+    PARAM: listed_urls (set) - the urls still listed (default: none, a name collision is a move)
+    RETURN: dict with the number of upserted, moved and skipped restaurants
+    """
+    cursor = conn.cursor()
+    listed_urls = listed_urls or set()
+    stats = {"upserted": 0, "moved": 0, "skipped": 0}
+
+    for row in dict_list:
+        cursor.execute(
+            "SELECT restaurant_url FROM Restaurant WHERE restaurant_name = ? AND restaurant_url <> ?",
+            (row["name"], row["url"]),
+        )
+        collision = cursor.fetchone()
+        if collision is not None:
+            old_url = collision[0]
+            url_used = cursor.execute("SELECT 1 FROM Restaurant WHERE restaurant_url = ?", (row["url"],)).fetchone()
+            if old_url in listed_urls or url_used:
+                print(f"Skipped {row['url']}: the name {row['name']!r} is already used by {old_url}")
+                stats["skipped"] += 1
+                continue
+            cursor.execute("UPDATE Restaurant SET restaurant_url = ? WHERE restaurant_url = ?", (row["url"], old_url))
+            stats["moved"] += 1
+
+        cuisine_ids = [
+            get_lookup_id(cursor, "Cuisine", "cuisine_id", "cuisine_name", name)
+            for name in lab3db.split_cuisines(row["cuisine"])
+        ]
+        cost_id = get_lookup_id(cursor, "Cost", "cost_id", "cost_symbol", row["cost"])
+        location_id = get_lookup_id(cursor, "Location", "location_id", "location_name", row["location"])
+        address = row["address"]
+        if address is None:
+            cursor.execute("SELECT street_address FROM Restaurant WHERE restaurant_url = ?", (row["url"],))
+            address = (cursor.fetchone() or ("N/A",))[0]
+
+        cursor.execute(
+            "INSERT INTO Restaurant (restaurant_name, restaurant_url, cuisine_id, cost_id, cost_level, location_id, street_address) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (restaurant_url) DO UPDATE SET "
+            "restaurant_name = excluded.restaurant_name, cuisine_id = excluded.cuisine_id, cost_id = excluded.cost_id, "
+            "cost_level = excluded.cost_level, location_id = excluded.location_id, "
+            "street_address = excluded.street_address, delisted = 0",
+            (
+                row["name"],
+                row["url"],
+                cuisine_ids[0],
+                cost_id,
+                lab3db.cost_level(row["cost"]),
+                location_id,
+                address,
+            ),
+        )
+
+        # Replace the restaurant's cuisines
+        cursor.execute(
+            "DELETE FROM RestaurantCuisine "
+            "WHERE restaurant_id = (SELECT restaurant_id FROM Restaurant WHERE restaurant_url = ?)",
+            (row["url"],),
+        )
+        lab3db.link_cuisines(
+            conn, [(row["url"], cuisine_id, position) for position, cuisine_id in enumerate(cuisine_ids)]
+        )
+        stats["upserted"] += 1
+
+    lab3db.normalize_locations(conn)
+    conn.commit()
+    return stats
+
+
+def incremental_refresh(conn, urls=URL_DICT.values()):
+    """
+    Incremental re-scrape: the directory pages are scraped again, but the restaurant pages (addresses)
+    are only crawled for restaurants that are new or whose name, cost, cuisine or location changed.
+
+        - New and changed restaurants are upserted (a changed restaurant whose page failed keeps its address)
+        - A new url with the name of a restaurant that is no longer listed is a move (see upsert_into_database())
+        - Restaurants that are no longer listed are tombstoned (delisted = 1), not deleted
+        - Unchanged restaurants are not touched
+
+    PARAM: conn - the database connection (from create_database())
+    PARAM: urls - the directory urls to scrape
+    RETURN: dict with the number of new, changed, unchanged, moved, skipped and delisted restaurants
+    """
+    # Scrape the directory cards (one entry per restaurant url).
+    # If a directory page fails this raises, so a partial scrape never delists restaurants.
+    scraped = {}
+    for url in urls:
+        for restaurant in fetch_restaurants_directory_data(url, raise_errors=True):
+            scraped.setdefault(restaurant["url"], restaurant)
+
+    # Get the restaurants already in the database, decoded, by url
+    cursor = conn.cursor()
+    # (the cuisines are joined in the same order as on the card: "Japanese, Sushi")
+    cursor.execute(
+        f"""
+        SELECT R.restaurant_url, R.restaurant_name, CO.cost_symbol,
+               COALESCE({lab3db.CUISINES_SQL.format(restaurant_id="R.restaurant_id")}, C.cuisine_name),
+               L.location_name, R.delisted
+        FROM Restaurant R
+        JOIN Cuisine C ON R.cuisine_id = C.cuisine_id
+        JOIN Cost CO ON R.cost_id = CO.cost_id
+        JOIN Location L ON R.location_id = L.location_id
+    """
+    )
+    existing = {row[0]: row[1:] for row in cursor.fetchall()}
+
+    # Diff the scraped cards against the database rows
+    new, changed, unchanged = [], [], 0
+    for url, restaurant in scraped.items():
+        cuisines = lab3db.NAME_SEPARATOR.join(lab3db.split_cuisines(restaurant["cuisine"]))
+        listed_row = (restaurant["name"], restaurant["cost"], cuisines, restaurant["location"], 0)
+        if url not in existing:
+            new.append(restaurant)
+        elif existing[url] != listed_row:
+            changed.append(restaurant)  # (a delisted restaurant that is listed again also counts as changed)
+        else:
+            unchanged += 1
+
+    # Only crawl the restaurant pages of the new and changed restaurants, then upsert them
+    failures = add_restaurant_addresses(new + changed)
+    for restaurant in changed:
+        if restaurant["url"] in failures:
+            restaurant["address"] = None  # (keep the stored address, not "N/A")
+    stats = upsert_into_database(conn, new + changed, listed_urls=scraped.keys())
+
+    # Tombstone the restaurants that are no longer listed (a moved restaurant's old url is gone already)
+    gone = [(url,) for url, row in existing.items() if url not in scraped and row[-1] == 0]
+    cursor.executemany("UPDATE Restaurant SET delisted = 1 WHERE restaurant_url = ?", gone)
+    delisted = cursor.rowcount
+    conn.commit()
+
+    return {
+        "new": len(new),
+        "changed": len(changed),
+        "unchanged": unchanged,
+        "moved": stats["moved"],
+        "skipped": stats["skipped"],
+        "delisted": delisted,
+    }
+
+
+# DE-DUPLICATION #
+
+MISSING_VALUES = ("N/A", "", None)  # field values that count as "no value" when merging duplicates
+
+
+def canonical_url(url):
+    """
+    RETURN: the canonical form of a restaurant url, used as its identity:
+        lowercase scheme and host, no query string or fragment, no trailing slash
+    """
+    parts = urlsplit(url.strip())
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip("/"), "", ""))
+
+
+class DiskKeyStore:
+    """
+    On-disk replacement of the dict used by RestaurantDeduplicator, for crawls too big for memory:
+    canonical url -> restaurant, stored as JSON in an SQLite table (the url is the primary key)
+    """
+
+    def __init__(self, filename):
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS SeenRestaurant (url TEXT PRIMARY KEY, restaurant TEXT NOT NULL)")
+
+    def get(self, key):
+        row = self.conn.execute("SELECT restaurant FROM SeenRestaurant WHERE url = ?", (key,)).fetchone()
+        return Restaurant.from_dict(json.loads(row[0])) if row else None
+
+    def __setitem__(self, key, restaurant):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO SeenRestaurant (url, restaurant) VALUES (?, ?)",
+            (key, json.dumps(restaurant, default=json_default)),
+        )
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM SeenRestaurant").fetchone()[0]
+
+    def values(self):
+        self.conn.commit()
+        for (restaurant,) in self.conn.execute("SELECT restaurant FROM SeenRestaurant ORDER BY rowid"):
+            yield Restaurant.from_dict(json.loads(restaurant))
+
+    def close(self):
+        self.conn.close()
+
+
+class RestaurantDeduplicator:
+    """
+    De-duplicates restaurants by canonical url with a hash lookup (O(1) per restaurant):
+
+        - the first restaurant seen with a url is kept, the next ones are duplicates
+        - the fields of a duplicate are merged into the kept restaurant:
+            policy "first": the kept values win, a duplicate only fills the missing ("N/A") values
+            policy "last": the non-missing values of the duplicate replace the kept ones
+        - duplicates are counted per region, and conflicting (different, non-missing) values are counted
+
+    The kept restaurants are in a dict, or in a DiskKeyStore for very large crawls.
+    """
+
+    def __init__(self, key_store=None, policy="first"):
+        if policy not in ("first", "last"):
+            raise ValueError(f"unknown merge policy: {policy}")
+        self.policy = policy
+        self.kept = key_store if key_store is not None else {}
+        self.duplicates = Counter()  # region -> number of duplicates
+        self.conflicts = 0
+
+    @lab3trace.timed("dedup.add")
+    def add(self, restaurant, region=None):
+        """
+        PARAM: restaurant (dict) - the restaurant
+        PARAM: region (str) - the region it was scraped from (for the duplicate counts)
+        RETURN: True if the restaurant is new, False if it's a duplicate (merged into the kept one)
+        """
+        key = canonical_url(restaurant["url"])
+        kept = self.kept.get(key)
+        if kept is None:
+            self.kept[key] = restaurant
+            return True
+
+        self.duplicates[region] += 1
+        lab3trace.count("dedup.duplicates")
+        for field, value in restaurant.items():
+            if field == "url" or value in MISSING_VALUES:  # (same canonical url, the kept spelling stays)
+                continue
+            kept_value = kept.get(field)
+            if kept_value in MISSING_VALUES:
+                kept[field] = value
+            elif kept_value != value:
+                self.conflicts += 1
+                if self.policy == "last":
+                    kept[field] = value
+        self.kept[key] = kept  # (needed by the DiskKeyStore, the dict already has the merged object)
+        return False
+
+    def restaurants(self):
+        """
+        RETURN: iterator of the unique (merged) restaurants, in the order they were first seen
+        """
+        return iter(self.kept.values())
+
+
+def deduplicate_regions(restaurants_by_region, key_store=None, policy="first"):
+    """
+    De-duplicate the restaurants of several regions in one pass
+
+    PARAM: restaurants_by_region - iterable of (region name, list of restaurants)
+    PARAM: key_store - optional DiskKeyStore (default: in memory)
+    PARAM: policy (str) - merge policy of RestaurantDeduplicator
+    RETURN: tuple (restaurants, deduplicator) - list of unique restaurants, and the deduplicator (for its counts)
+    """
+    deduplicator = RestaurantDeduplicator(key_store, policy)
+    for region, restaurants in restaurants_by_region:
+        for restaurant in restaurants:
+            deduplicator.add(restaurant, region)
+
+    return list(deduplicator.restaurants()), deduplicator
+
+
+# STREAMING PIPELINE #
+
+
+class _StageError:
+    # wraps an exception raised in a pipeline stage, to re-raise it in the consumer thread
+    def __init__(self, error):
+        self.error = error
+
+
+_END_OF_STAGE = object()
+
+
+def queue_stage(iterable, maxsize=PIPELINE_QUEUE_SIZE):
+    """
+    Run a pipeline stage (an iterable) in a background thread, and yield its items through a bounded queue:
+    the stage blocks when the queue is full, so a fast stage can't get far ahead of a slow one (backpressure).
+
+    If the consumer stops early (an error downstream, KeyboardInterrupt, the generator is closed), the stage
+    thread stops too: it stops waiting on the full queue and closes the stage (so its executors and
+    connections are released, and the stages before it are closed: see close_stage()). The consumer waits
+    for the stage thread to end.
+
+    PARAM: iterable - the stage (generator)
+    PARAM: maxsize (int) - max number of items waiting in the queue
+    YIELDS: the items of the stage. An exception in the stage is raised here.
+    """
+    items = queue.Queue(maxsize)
+    stopped = threading.Event()  # set when the consumer stops
+
+    def put(item):
+        # RETURN: False if the consumer stopped (the item is dropped)
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=PIPELINE_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        stage = iter(iterable)
+        try:
+            for item in stage:
+                if not put(item):
+                    break
+        except Exception as error:
+            put(_StageError(error))
+        finally:
+            close_stage(stage)  # (a generator stopped early runs its cleanup now)
+            put(_END_OF_STAGE)
+
+    thread = threading.Thread(target=produce, name="pipeline-stage", daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item = items.get()
+            if item is _END_OF_STAGE:
+                return
+            if isinstance(item, _StageError):
+                raise item.error
+            yield item
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def close_stage(stage):
+    """
+    Close a pipeline stage if it's a generator (no-op otherwise): it runs its cleanup (finally blocks, with
+    blocks) now instead of when it's garbage collected. The stages close their input in turn, so closing the
+    last stage closes the whole pipeline.
+    """
+    close = getattr(stage, "close", None)
+    if close is not None:
+        close()
+
+
+def directory_cards(urls):
+    """
+    Pipeline stage (first): the restaurant cards of the directory pages of every url (see iter_directory_cards())
+    A generator, so closing it closes the directory page generator running.
+
+    PARAM: urls - the directory urls to scrape
+    YIELDS: Restaurant records
+    """
+    for url in urls:
+        yield from iter_directory_cards(url)
+
+
+def unique_restaurants(restaurants, deduplicator=None):
+    """
+    Pipeline stage: skip the restaurants already seen (same canonical url), so their page isn't crawled twice.
+    NOTE: a duplicate is merged into the kept restaurant, which may already be further down the pipeline.
+
+    PARAM: restaurants - iterable of Restaurant records
+    PARAM: deduplicator (RestaurantDeduplicator) - to get the counts afterwards (default: a new one)
+    """
+    deduplicator = deduplicator or RestaurantDeduplicator()
+    try:
+        for restaurant in restaurants:
+            if deduplicator.add(restaurant):
+                yield restaurant
+    finally:
+        close_stage(restaurants)
+
+
+def enrich_with_addresses(restaurants, max_workers=MAX_CRAWL_WORKERS, per_host_limit=PER_HOST_LIMIT):
+    """
+    Pipeline stage: crawl the restaurant pages concurrently and add the addresses.
+    At most max_workers pages are in flight, and the restaurants are yielded in input order.
+    A restaurant whose page failed gets "N/A" as address (the failure is printed).
+
+    PARAM: restaurants - iterable of Restaurant records
+    YIELDS: the Restaurant records with their address
+    """
+    host_semaphores = HostSemaphores(per_host_limit)
+
+    def crawl(url):
+        with host_semaphores.get(url):
+            return extract_restaurant_address(url)
+
+    def finish(restaurant, future):
+        try:
+            restaurant["address"] = future.result()
+        except Exception as error:
+            print(f"Failed to get address from {restaurant['url']}: {type(error).__name__}: {error}")
+            restaurant["address"] = "N/A"
+        return restaurant
+
+    in_flight = deque()  # (restaurant, future) in input order
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="address-crawl") as executor:
+            for restaurant in restaurants:
+                in_flight.append((restaurant, executor.submit(crawl, restaurant["url"])))
+                # window full: wait for the oldest page before reading more restaurants
+                if len(in_flight) >= max_workers:
+                    yield finish(*in_flight.popleft())
+
+            while in_flight:
+                yield finish(*in_flight.popleft())
+    finally:
+        close_stage(restaurants)
+
+
+def write_pipeline_rows(conn, rows, batch_size=PIPELINE_BATCH_SIZE, sinks=()):
+    """
+    Pipeline stage (last): insert the rows into the database, committing every batch_size rows,
+    and pass every row to the optional sinks (for example a JsonFileSink)
+
+    PARAM: conn - the database connection
+    PARAM: rows - iterable of Restaurant records (with address)
+    PARAM: batch_size (int) - rows per transaction
+    PARAM: sinks - objects with a write(row) method
+    RETURN: the number of rows written
+    """
+    lookup_ids = LookupIds(conn)  # shared by all the batches
+    batch = []
+    count = 0
+    for row in rows:
+        for sink in sinks:
+            sink.write(row)
+        batch.append(row)
+        if len(batch) >= batch_size:
+            count += bulk_insert_into_database(conn, batch, lookup_ids)  # (one transaction per batch)
+            batch = []
+
+    if batch:
+        count += bulk_insert_into_database(conn, batch, lookup_ids)
+
+    return count
+
+
+def run_pipeline(
+    conn, urls=URL_DICT.values(), json_filename=None, batch_size=PIPELINE_BATCH_SIZE, queue_size=PIPELINE_QUEUE_SIZE
+):
+    """
+    Streaming version of part A + part B: the directory pages yield restaurant cards, the address crawler
+    enriches them, and the database writer inserts them in batches, all at the same time.
+    The stages are connected by bounded queues, so memory use doesn't grow with the number of restaurants.
+
+    PARAM: conn - the database connection (from create_database())
+    PARAM: urls - the directory urls to scrape
+    PARAM: json_filename (str) - if given, the restaurants are also written to this file
+        (pretty JSON, or JSON Lines if the name has .jsonl, see open_sink())
+    PARAM: batch_size (int) - rows per database transaction
+    PARAM: queue_size (int) - max items waiting between two stages
+    RETURN: the number of restaurants written
+    """
+    cards = queue_stage(directory_cards(urls), queue_size)
+    rows = queue_stage(enrich_with_addresses(unique_restaurants(cards)), queue_size)
+
+    sinks = [open_sink(json_filename)] if json_filename else []
+    try:
+        return write_pipeline_rows(conn, rows, batch_size, sinks)
+    finally:
+        close_stage(rows)  # (stops every stage if the writer stopped early)
+        for sink in sinks:
+            sink.close()
+
+
+# RESUMABLE CRAWL #
+
+
+class CrawlJournal:
+    """
+    Durable journal of a crawl (CrawlJournal table, next to the restaurant tables in restaurants.db):
+    the status (pending / done / failed) of every directory page and restaurant page, with its result.
+
+        - a restarted crawl skips what is done and continues with what is pending or failed
+          (the directory pages only for a while: they expire, so a later run sees the new listings)
+        - the failed urls can be retried on their own
+        - every change is committed right away, so nothing done is lost if the crawl is killed
     """
-    # Create list for restaurant dicts
-    restaurant_dict_list = []
-    # while loop to get all pages
-    # NOTE: recursion would also work, but could be risky for... reasons.
-    while url:
-        # Get the page content and create a beautiful soup object
-        try:
-            page = requests.get(url)  # TODO: try-exception block
-        except:
-            return False
 
-        soup = BeautifulSoup(page.content, "lxml")
+    def __init__(self, filename=CRAWL_JOURNAL_FILE):
+        # used by the crawler threads: one connection guarded by a lock
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS CrawlJournal (
+            url TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            result TEXT,
+            updated_at REAL NOT NULL
+            )"""
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_journal_status ON CrawlJournal (kind, status)")
+        self.conn.commit()
+
+    def _execute(self, query, parameters=()):
+        with self._lock:
+            rows = self.conn.execute(query, parameters).fetchall()
+            self.conn.commit()
+        return rows
+
+    def get(self, url, max_age=None):
+        """
+        PARAM: url (str) - the url
+        PARAM: max_age (float) - ignore the entry if it was updated more than max_age seconds ago (None: never)
+        RETURN: tuple (status, result) of a url (result decoded from JSON), or None if it isn't in the journal
+        """
+        rows = self._execute(
+            "SELECT status, result FROM CrawlJournal WHERE url = ? AND updated_at >= ?",
+            (url, time.time() - max_age if max_age is not None else float("-inf")),
+        )
+        if not rows:
+            return None
+        status, result = rows[0]
+        return status, json.loads(result) if result is not None else None
+
+    def add_pending(self, url, kind, result=None):
+        """
+        Add a url to crawl (kept as it is if it's already in the journal)
+        """
+        self._execute(
+            "INSERT OR IGNORE INTO CrawlJournal (url, kind, status, result, updated_at) VALUES (?, ?, 'pending', ?, ?)",
+            (url, kind, json.dumps(result, default=json_default), time.time()),
+        )
+
+    def mark_done(self, url, kind, result):
+        self._execute(
+            "INSERT INTO CrawlJournal (url, kind, status, attempts, result, updated_at) "
+            "VALUES (?, ?, 'done', 1, ?, ?) "
+            "ON CONFLICT (url) DO UPDATE SET status = 'done', attempts = attempts + 1, error = NULL, "
+            "result = excluded.result, updated_at = excluded.updated_at",
+            (url, kind, json.dumps(result, default=json_default), time.time()),
+        )
 
-        # Get the restaurant cards
-        cards = soup.find_all(
-            "div", class_="card__menu box-placeholder js-restaurant__list_item js-match-height js-map"
+    def mark_failed(self, url, kind, error):
+        self._execute(
+            "INSERT INTO CrawlJournal (url, kind, status, attempts, error, updated_at) "
+            "VALUES (?, ?, 'failed', 1, ?, ?) "
+            "ON CONFLICT (url) DO UPDATE SET status = 'failed', attempts = attempts + 1, error = excluded.error, "
+            "updated_at = excluded.updated_at",
+            (url, kind, error, time.time()),
         )
 
-        # Get the restaurant details from each card in the list of cards
-        for card in cards:
-            # create a dictionary to store the restaurant details (w/ default vals to avoid key errors)
-            restaurant = defaultdict(lambda: "N/A")
-
-            # Get the restaurant name
-            # restaurant["name"] = card.find("restaurant-name")
-            restaurant["name"] = card.select_one("div.card__menu-content h3.card__menu-content--title").text.strip()
-            # ^ select_one() returns the first element that matches the CSS selector
-            # ^ div.card__menu-content h3.card__menu-content--title is the CSS selector
-            # for the <h3> tag with class="card__menu-content--title" inside a <div> tag with class="card__menu-content"
-
-            # Get the restaurant URL
-            restaurant["url"] = "".join(["https://guide.michelin.com", card.select_one("a.link").get("href")])
-            # ^ a.link is the CSS selector for the <a> tag with class="link"
-            # ^ get() returns the value of the specified attribute - in this case, href (the URL)
-            # print(url)
-
-            # Get the restaurant location
-            restaurant["location"] = card.select_one("div.card__menu-footer--location").text.strip()
-            # ^ using CSS selector for <div> tag, class="card__menu-footer--location"
-            # NOTE: this also gets the country, which is not needed. will keep for now.
-
-            # Get the restaurant cost and cuisine type from the footer
-            cost_and_type = card.select_one("div.card__menu-footer--price").text.split("·")
-            restaurant["cost"] = cost_and_type[0].strip()
-            restaurant["cuisine"] = cost_and_type[1].strip()
-
-            restaurant_dict_list.append(restaurant)
-
-        # Get the next page URL, if it exists. Only get the link with the right arrow icon!
-        next_page_link = soup.select_one(
-            "div.btn-carousel a.btn-carousel__link[href*='/page/'][href]:has(span.icon.fal.fa-angle-right)"
+    def entries(self, kind, statuses):
+        """
+        RETURN: list of (url, result) of the urls of a kind ("directory" / "detail") with one of the statuses
+        """
+        placeholders = ", ".join("?" * len(statuses))
+        rows = self._execute(
+            f"SELECT url, result FROM CrawlJournal WHERE kind = ? AND status IN ({placeholders}) ORDER BY rowid",
+            (kind, *statuses),
         )
-        if next_page_link:
-            url = "".join(["https://guide.michelin.com", next_page_link["href"]])
+        return [(url, json.loads(result) if result is not None else None) for url, result in rows]
+
+    def counts(self):
+        """
+        RETURN: dict of (kind, status) -> number of urls
+        """
+        rows = self._execute("SELECT kind, status, COUNT(*) FROM CrawlJournal GROUP BY kind, status")
+        return {(kind, status): count for kind, status, count in rows}
+
+    def reset(self):
+        """
+        Forget the previous crawl (to start a new one from scratch)
+        """
+        self._execute("DELETE FROM CrawlJournal")
+
+    def close(self):
+        self.conn.close()
+
+
+def journaled_directory_cards(url, journal, max_age=CRAWL_DIRECTORY_MAX_AGE):
+    """
+    Scrape the directory pages of a region, starting from url, through the journal:
+    pages done less than max_age seconds ago (a resumed crawl) are read from the journal instead of being
+    fetched again. Older ones are fetched again (through the response cache), so new restaurants are found.
+
+    PARAM: url (str) - the first directory page of the region
+    PARAM: journal (CrawlJournal) - the crawl journal
+    PARAM: max_age (float) - seconds a directory page done is reused (None: always)
+    RETURN: tuple (restaurants, error) - the Restaurant records, and None or the error of the page that failed
+    """
+    restaurants = []
+    while url:
+        entry = journal.get(url, max_age)
+        if entry is not None and entry[0] == "done":
+            page_restaurants = [Restaurant.from_dict(restaurant) for restaurant in entry[1]["restaurants"]]
+            next_url = entry[1]["next_url"]
         else:
-            url = None
+            try:
+                page = get_scraper_client().fetch(url)
+                page_restaurants, next_url = parse_directory_page(page.content)
+            except Exception as error:
+                journal.mark_failed(url, "directory", f"{type(error).__name__}: {error}")
+                return restaurants, f"{url}: {type(error).__name__}: {error}"
+            journal.mark_done(url, "directory", {"restaurants": page_restaurants, "next_url": next_url})
 
-    return restaurant_dict_list
+        restaurants.extend(page_restaurants)
+        url = next_url
 
+    return restaurants, None
 
-def extract_restaurant_address(url):
+
+def journaled_address_crawl(journal, statuses=("pending", "failed")):
     """
-    Use the URL of the restaurant to extract address (street address and city)
+    Crawl the restaurant pages of the journal with one of the statuses, recording each result as it's done
 
-    PARAM: url (str) - url of the restaurants' Michelin page
-    RETURN: the street address and city of the restaurant (str)
+    PARAM: journal (CrawlJournal) - the crawl journal
+    PARAM: statuses - the statuses to crawl (("failed",) to only retry the failed urls)
+    RETURN: dict of url -> error message for the pages that failed (again)
     """
-    # get the page content and create a beautiful soup object
-    page = requests.get(url)
-    soup = BeautifulSoup(page.content, "lxml")
+    cards = {url: card for url, card in journal.entries("detail", statuses)}
 
-    # get the restaurant address
-    address_element = soup.select_one("li.restaurant-details__heading--address")
-    if address_element:
-        return address_element.text.strip()
-    else:
-        return ""
+    def record(url, address, error):
+        if error is None:
+            restaurant = Restaurant.from_dict(cards[url])
+            restaurant.address = address
+            journal.mark_done(url, "detail", restaurant)
+        else:
+            journal.mark_failed(url, "detail", error)
 
+    _, failures = crawl_restaurant_addresses(list(cards), on_result=record)
+    return failures
 
-def write_to_json_file(restauraunts_dict, filename):
+
+def resumable_crawl(urls=URL_DICT.values(), journal=None):
     """
-    Write data to a JSON file
+    Part A with a durable crawl journal: if the crawl is stopped (crash, Ctrl-C, network down),
+    running it again picks up where it stopped, and only the pending and failed pages are fetched.
+    The directory pages are fetched again once their journal entry is older than CRAWL_DIRECTORY_MAX_AGE,
+    so a later run finds the new restaurants (only their pages are crawled).
+    Call journal.reset() to start a new crawl from scratch.
+
+    PARAM: urls - the directory urls to scrape
+    PARAM: journal (CrawlJournal) - the crawl journal (default: the CrawlJournal table of restaurants.db)
+    RETURN: tuple (restaurants, counts)
+        restaurants - the Restaurant records (with address) of all the restaurant pages that are done
+        counts - dict of (kind, status) -> number of urls in the journal
+    """
+    journal = journal or CrawlJournal()
 
-    PARAM: data - the data to write to the file
-    PARAM: filename - the name of the file to write to
-    TODO: try using args and kwargs??
+    # Directory pages: a failed region doesn't stop the others (its pages are retried on the next run)
+    for url in urls:
+        restaurants, error = journaled_directory_cards(url, journal)
+        if error:
+            print(f"Directory page failed, will be retried on the next run: {error}")
+        for restaurant in restaurants:
+            journal.add_pending(restaurant.url, "detail", restaurant)
+
+    # Restaurant pages: only the ones not done yet
+    failures = journaled_address_crawl(journal)
+    for url, error in failures.items():
+        print(f"Failed to get address from {url} (will be retried): {error}")
+
+    restaurants = [Restaurant.from_dict(result) for _, result in journal.entries("detail", ("done",))]
+    return restaurants, journal.counts()
+
+
+def retry_failed_urls(journal=None):
     """
-    with open(filename, "w", encoding="utf-8") as file:
-        json.dump(restauraunts_dict, file, indent=4)
+    Retry only the restaurant pages that failed in the journal
+
+    RETURN: dict of url -> error message for the pages that failed again
+    """
+    return journaled_address_crawl(journal or CrawlJournal(), statuses=("failed",))
 
 
-def create_database():
+# MULTI-REGION SCRAPING #
+
+# Result of the scrape of one region: error is None if all its pages were scraped
+RegionResult = namedtuple("RegionResult", ["name", "restaurants", "error", "seconds"])
+
+
+def load_region_registry(filename=REGIONS_FILE):
     """
-    Create the SQLite database and the tables needed with the following schema:
-    - Restaurant name
-    - Restaurant URL
-    - Location (lookup table), int : city
-    - Cost (lookup table), int : n$
-    - Cuisine type (lookup table), int : type
-    - Addess (street address and city)
+    Load the regions to scrape from a JSON config file: {"region name": "directory url", ...}
 
-    RETURN: the database connection (type: sqlite3.connect??)
+    PARAM: filename (str) - the config file
+    RETURN: dict of region name -> directory url (URL_DICT if the file doesn't exist)
     """
-    conn = sqlite3.connect("restaurants.db")  # Connect to the database
-    cursor = conn.cursor()
+    try:
+        with open(filename, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return dict(URL_DICT)
 
-    # -------------------------------------------#
-    # Create the tables needed for the database #
-    # -------------------------------------------#
 
-    # Create the "Cuisine" lookup table
-    cursor.execute(
-        """CREATE TABLE IF NOT EXISTS Cuisine (
-        cuisine_id INTEGER PRIMARY KEY,
-        cuisine_name TEXT UNIQUE
-        )"""
-    )
+def scrape_region(name, url, parse=None):
+    """
+    Scrape all the directory pages of one region, printing its progress.
+    An error only stops this region: the restaurants of the pages already scraped are kept.
 
-    # Create the "Cost" lookup table
-    cursor.execute(
-        """CREATE TABLE IF NOT EXISTS Cost (
-        cost_id INTEGER PRIMARY KEY,
-        cost_symbol TEXT UNIQUE
-        )"""
-    )
+    PARAM: name (str) - the region name
+    PARAM: url (str) - the first directory page of the region
+    PARAM: parse - function content -> (restaurants, next_url) (default: parse in this thread)
+    RETURN: a RegionResult
+    """
+    print(f"[{name}] scraping {url}")
+    start = time.perf_counter()
+    restaurants = []
+    error = None
+    try:
+        for restaurant in iter_directory_cards(url, raise_errors=True, parse=parse):
+            restaurants.append(restaurant)
+    except Exception as exception:  # failure isolation: the other regions go on
+        error = f"{type(exception).__name__}: {exception}"
 
-    # Create the "Location" lookup table
-    cursor.execute(
-        """CREATE TABLE IF NOT EXISTS Location (
-        location_id INTEGER PRIMARY KEY,
-        location_name TEXT UNIQUE
-        )"""
-    )
+    seconds = time.perf_counter() - start
+    status = f"FAILED ({error})" if error else "done"
+    print(f"[{name}] {status}: {len(restaurants)} restaurants in {seconds:.1f} s")
+    return RegionResult(name, restaurants, error, seconds)
 
-    # Create the "Restaurant" table
-    cursor.execute(
-        """CREATE TABLE IF NOT EXISTS Restaurant (
-        restaurant_id INTEGER PRIMARY KEY,
-        restaurant_name TEXT UNIQUE,
-        restaurant_url TEXT UNIQUE,
-        cuisine_id INTEGER,
-        cost_id INTEGER,
-        location_id INTEGER,
-        street_address TEXT NOT NULL,
-        FOREIGN KEY (cuisine_id) REFERENCES Cuisine (cuisine_id),
-        FOREIGN KEY (cost_id) REFERENCES Cost (cost_id),
-        FOREIGN KEY (location_id) REFERENCES Location (location_id)
-        )"""
-    )
 
-    # Add indeces to the foreign key columns in the "Restaurant" table
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cuisine_id ON Restaurant (cuisine_id)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cost_id ON Restaurant (cost_id)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_location_id ON Restaurant (location_id)")
+def scrape_regions(registry, max_regions=MAX_PARALLEL_REGIONS, parse_processes=PARSE_PROCESSES):
+    """
+    Scrape the directory pages of many regions in parallel:
+        - the regions are scraped by a pool of threads sharing the HTTP client (network I/O)
+        - the pages are parsed by a pool of processes (CPU bound, not limited by the GIL)
+    The restaurants of all the regions are de-duplicated (by url) in one pass at the end.
+
+    PARAM: registry (dict) - region name -> directory url (see load_region_registry())
+    PARAM: max_regions (int) - regions scraped at the same time
+    PARAM: parse_processes (int) - number of parsing processes (None: one per CPU)
+    RETURN: tuple (restaurants, results, deduplicator)
+        restaurants - list of unique Restaurant records, in region order
+        results - list of RegionResult, one per region (in registry order)
+        deduplicator - the RestaurantDeduplicator (duplicate counts per region)
+    """
+    with ProcessPoolExecutor(parse_processes) as parse_pool, ThreadPoolExecutor(max_regions) as region_pool:
 
-    conn.commit()  # Commit the changes to the database
+        def parse(content):
+            # (the Restaurant records are pickled back from the parsing process)
+            return parse_pool.submit(parse_directory_page, content).result()
 
-    return conn  # Return the database connection
+        futures = [region_pool.submit(scrape_region, name, url, parse) for name, url in registry.items()]
+        results = [future.result() for future in futures]
 
+    restaurants, deduplicator = deduplicate_regions((result.name, result.restaurants) for result in results)
+    return restaurants, results, deduplicator
 
-def insert_into_database(conn, dict_list):
+
+# GEOCODING #
+
+
+class GazetteerGeocoder:
+    """
+    Offline geocoder: the center of the address's postcode, or of its city, from a gazetteer file
+    (GAZETTEER_FILE: {"postcodes": {country: {postcode: [lat, lon]}}, "cities": {country: {city: [lat, lon]}}}).
+    Addresses are like the restaurant pages': "1100 N. First St., San Jose, 95112, USA" (country last).
     """
-    Insert the data into the SQLite database
 
-    PARAM: conn - the database connection
-    PARAM: dict_list - the data to insert into the database
+    name = "gazetteer"
+
+    def __init__(self, filename=GAZETTEER_FILE):
+        with open(filename, "r", encoding="utf-8") as file:
+            gazetteer = json.load(file)
+        self.postcodes = gazetteer.get("postcodes", {})
+        self.cities = gazetteer.get("cities", {})
+
+    def geocode(self, address):
+        """
+        PARAM: address (str) - the street address
+        RETURN: (latitude, longitude), or None if neither its postcode nor its city is in the gazetteer
+        """
+        parts = [part.strip() for part in address.split(",")]
+        country = parts[-1]
+        # (from the end: the postcode and the city come after the street)
+        for places in (self.postcodes.get(country, {}), self.cities.get(country, {})):
+            for part in reversed(parts[:-1]):
+                if part in places:
+                    return tuple(places[part])
+        return None
+
+
+class NominatimGeocoder:
+    """
+    Online geocoder (OpenStreetMap Nominatim, street-level), through a ScraperClient:
+    timeouts and retries, and its own rate limiter (GEOCODER_RATE requests per second)
     """
-    cursor = conn.cursor()  # Get the cursor
 
-    # Insert into the database in the order that respects the foreign key constraints
-    for row in dict_list:
-        # Extract the values from the dictionary
-        restaurant_name = row["name"]
-        restaurant_url = row["url"]
-        cuisine_name = row["cuisine"]
-        cost_symbol = row["cost"]
-        location_name = row["location"]
-        street_address = row["address"]
+    name = "nominatim"
 
-        # Insert the data into the "Cuisine" table, using INSERT OR IGNORE to avoid duplicate entries
-        cursor.execute(
-            "INSERT OR IGNORE INTO Cuisine (cuisine_name) VALUES (?)",
-            (cuisine_name,),
-        )
-        cursor.execute("SELECT cuisine_id FROM Cuisine WHERE cuisine_name = ?", (cuisine_name,))
-        cuisine_id = cursor.fetchone()[0]  # Use fetchone() to get the id of the last inserted row
+    def __init__(self, client=None, url=GEOCODER_URL):
+        self.client = client or ScraperClient(rate_limiter=HostRateLimiter(rate=GEOCODER_RATE, burst=1))
+        self.url = url
 
-        # Insert the data into the "Cost" table using INSERT OR IGNORE to avoid duplicate entries
-        cursor.execute(
-            "INSERT OR IGNORE INTO Cost (cost_symbol) VALUES (?)",
-            (cost_symbol,),
-        )
-        # Get the id of the last inserted row to use as the foreign key for the "Restaurant" table
-        cursor.execute("SELECT cost_id FROM Cost WHERE cost_symbol = ?", (cost_symbol,))
-        cost_id = cursor.fetchone()[0]
+    def geocode(self, address):
+        """
+        PARAM: address (str) - the street address
+        RETURN: (latitude, longitude), or None if the address isn't found
+        RAISES: requests.RequestException if the request fails
+        """
+        query = urlencode({"q": address, "format": "jsonv2", "limit": 1})
+        response = self.client.get(f"{self.url}?{query}", headers={"User-Agent": GEOCODER_USER_AGENT})
+        results = response.json()
+        if not results:
+            return None
+        return float(results[0]["lat"]), float(results[0]["lon"])
 
-        # Insert the data into the "Location" table
-        cursor.execute(
-            "INSERT OR IGNORE INTO Location (location_name) VALUES (?)",
-            (location_name,),
-        )
-        cursor.execute("SELECT location_id FROM Location WHERE location_name = ?", (location_name,))
-        location_id = cursor.fetchone()[0]
+    def close(self):
+        self.client.close()
 
-        # Insert the data into the "Restaurant" table using INSERT OR IGNORE to avoid duplicate entries
-        cursor.execute(
-            "INSERT OR IGNORE INTO Restaurant (restaurant_name, restaurant_url, cuisine_id, cost_id, location_id, street_address) "
-            "VALUES (?, ?, ?, ?, ?, ?)",
-            (restaurant_name, restaurant_url, cuisine_id, cost_id, location_id, street_address),
-        )
 
-    conn.commit()  # Commit the changes to the database
+@lab3trace.timed("geocode.restaurants")
+def geocode_restaurants(conn, geocoder=None, retry_failed=False, batch_size=GEOCODE_BATCH_SIZE):
+    """
+    Geocoding stage: give coordinates to the restaurants that aren't in the spatial index (RestaurantGeo) yet,
+    i.e. the new ones and the ones whose address changed.
+
+        - Each address is looked up once: the results (also "not found") are kept in the GeocodeCache table
+        - The geocoder is pluggable: any object with geocode(address) -> (latitude, longitude) or None,
+          and a name (stored with the cached results)
+        - Committed every GEOCODE_COMMIT_INTERVAL seconds, so a long (online) geocoding keeps its progress
+        - An address whose lookup raised an error isn't cached, it's looked up again on the next run
+
+    PARAM: conn - the database connection (from create_database())
+    PARAM: geocoder - the geocoder (default: GazetteerGeocoder, offline)
+    PARAM: retry_failed (bool) - look up again the addresses cached as "not found"
+    PARAM: batch_size (int) - restaurants read and geocoded at a time
+    RETURN: dict with the number of restaurants located, of addresses looked up, found in the cache,
+        not found, and of lookup errors
+    """
+    geocoder = geocoder or GazetteerGeocoder()
+    stats = {"located": 0, "lookups": 0, "cached": 0, "not_found": 0, "errors": 0}
+    last_id = 0
+    last_commit = time.monotonic()
+    while True:
+        # the next batch of restaurants without coordinates (by id: the batches never overlap)
+        batch = conn.execute(
+            "SELECT R.restaurant_id, R.street_address FROM Restaurant R WHERE R.restaurant_id > ? "
+            "AND NOT EXISTS (SELECT 1 FROM RestaurantGeo G WHERE G.restaurant_id = R.restaurant_id) "
+            "ORDER BY R.restaurant_id LIMIT ?",
+            (last_id, batch_size),
+        ).fetchall()
+        if not batch:
+            break
+        last_id = batch[-1][0]
+
+        # the addresses already looked up
+        addresses = list({address for _, address in batch})
+        points = {}
+        for start in range(0, len(addresses), lab3db.BATCH_SIZE):
+            chunk = addresses[start : start + lab3db.BATCH_SIZE]
+            placeholders = ", ".join("?" * len(chunk))
+            for address, latitude, longitude in conn.execute(
+                f"SELECT address, latitude, longitude FROM GeocodeCache WHERE address IN ({placeholders})", chunk
+            ):
+                if latitude is not None:
+                    points[address] = (latitude, longitude)
+                elif not retry_failed:
+                    points[address] = None
+        stats["cached"] += len(points)
+        lab3trace.count("geocode.cache_hits", len(points))
+
+        # look up the others
+        looked_up = []
+        for address in addresses:
+            if address in points:
+                continue
+            stats["lookups"] += 1
+            lab3trace.count("geocode.lookups")
+            try:
+                with lab3trace.span("geocode.lookup"):
+                    point = geocoder.geocode(address)
+            except Exception as error:  # failure isolation: the other addresses go on
+                stats["errors"] += 1
+                print(f"Geocoding failed for {address!r}: {type(error).__name__}: {error}")
+                continue
+            points[address] = point
+            latitude, longitude = point if point is not None else (None, None)
+            looked_up.append((address, latitude, longitude, geocoder.name, time.time()))
+        conn.executemany("INSERT OR REPLACE INTO GeocodeCache VALUES (?, ?, ?, ?, ?)", looked_up)
+
+        # a restaurant is a point in the R*Tree: (id, min lat, max lat, min lon, max lon)
+        located = []
+        for restaurant_id, address in batch:
+            point = points.get(address)
+            if point is not None:
+                located.append((restaurant_id, point[0], point[0], point[1], point[1]))
+            elif address in points:
+                stats["not_found"] += 1
+        conn.executemany("INSERT OR REPLACE INTO RestaurantGeo VALUES (?, ?, ?, ?, ?)", located)
+        stats["located"] += len(located)
+        if time.monotonic() - last_commit >= GEOCODE_COMMIT_INTERVAL:
+            conn.commit()
+            last_commit = time.monotonic()
+
+    conn.commit()
+    return stats
 
 
 # UNIT TESTING #
@@ -308,26 +2590,9 @@ def view_decoded_database(conn):
     
     print("\n *** Viewing DECODED database *** \n")
     
-    # Get the cursor
-    cursor = conn.cursor()
-
-    # Execute a SELECT query with JOIN operations to retrieve data from the "Restaurant" table and related lookup tables
-    cursor.execute(
-        """
-        SELECT R.restaurant_name, C.cuisine_name, CO.cost_symbol, L.location_name, R.street_address
-        FROM Restaurant R
-        JOIN Cuisine C ON R.cuisine_id = C.cuisine_id
-        JOIN Cost CO ON R.cost_id = CO.cost_id
-        JOIN Location L ON R.location_id = L.location_id
-    """
-    )
-
-    # Fetch all the rows from the result set
-    rows = cursor.fetchall()
-
-    # Print the rows with row indices
-    for index, row in enumerate(rows, start=1):
-        print(f"Row {index}: {row}")
+    # Get the restaurants decoded (one joined query, see lab3db) and print them with row indices
+    for index, restaurant in enumerate(lab3db.iter_restaurants(conn), start=1):
+        print(f"Row {index}: {restaurant}")
 
 
 def test_partA_without_duplicates():
@@ -340,16 +2605,15 @@ def test_partA_without_duplicates():
     )
 
     # Get the restaurant data from both cities
-    restaurants = []
 
-    # VERSION 1: skip duplicate dict entries (NOTE this is also handled elsewhere)
-
-    restaurants.extend(r for r in fetch_restaurants_directory_data(URL_DICT["San Jose"]) if r not in restaurants)
-    restaurants.extend(r for r in fetch_restaurants_directory_data(URL_DICT["Cupertino"]) if r not in restaurants)
+    # VERSION 1: skip duplicate restaurants (same canonical url, NOTE this is also handled elsewhere)
+    restaurants, deduplicator = deduplicate_regions(
+        (region, fetch_restaurants_directory_data(URL_DICT[region])) for region in ("San Jose", "Cupertino")
+    )
+    print(f"Duplicates per region: {dict(deduplicator.duplicates)}")
 
-    # Now, use the restaurant urls to get the restaurant street addresses, and add to dictionary
-    for restaurant in restaurants:
-        restaurant["address"] = extract_restaurant_address(restaurant["url"])
+    # Now, use the restaurant urls to get the restaurant street addresses (concurrently), and add to the records
+    add_restaurant_addresses(restaurants)
 
     # Now, write the data to a JSON file using the write_to_json_file() function
     write_to_json_file(restaurants, "restaurants.json")
@@ -371,9 +2635,8 @@ def test_partA_with_duplicates():
     for url in URL_DICT.values():
         restaurants.extend(fetch_restaurants_directory_data(url))
 
-    # Now, use the restaurant urls to get the restaurant street addresses, and add to dictionary
-    for restaurant in restaurants:
-        restaurant["address"] = extract_restaurant_address(restaurant["url"])
+    # Now, use the restaurant urls to get the restaurant street addresses (concurrently), and add to the records
+    add_restaurant_addresses(restaurants)
 
     # Now, write the data to a JSON file using the write_to_json_file() function
     write_to_json_file(restaurants, "restaurants.json")
@@ -390,15 +2653,16 @@ def test_partB():
 
     # read the data from the JSON file
     with open("restaurants.json", "r") as file:
-        restaurants_from_json = json.load(file)
+        restaurants_from_json = [Restaurant.from_dict(restaurant) for restaurant in json.load(file)]
 
     print(f"Number of restaurants: {len(restaurants_from_json)}")
 
     # Call the create_database() function to create the database and get the connection
     conn = create_database()
 
-    # Call the insert_into_database() function to insert the data into the database
-    insert_into_database(conn, restaurants_from_json)
+    # Call the bulk_insert_into_database() function to insert the data into the database (one transaction)
+    bulk_insert_into_database(conn, restaurants_from_json)
+    print(f"Snapshot: {lab3db.publish_snapshot(conn)}")
 
     # # Call the view_database() function to view the contents of the database
     print("\n *** View the database *** \n")
@@ -409,6 +2673,115 @@ def test_partB():
     view_decoded_database(conn)
 
 
+def test_partB_json_lines(filename="restaurants.jsonl.gz"):
+    print(
+        """
+        ---------------------------------------------------------
+        |       Running part B from a JSON Lines file           |
+        ---------------------------------------------------------
+        """
+    )
+
+    # The restaurants are read lazily from the file and inserted in chunks (never all in memory)
+    conn = create_database()
+    count = bulk_insert_into_database(conn, iter_json_lines(filename))
+    print(f"Number of restaurants: {count}")
+    print(f"Snapshot: {lab3db.publish_snapshot(conn)}")
+
+    view_decoded_database(conn)
+
+
+def test_pipeline():
+    print(
+        """
+        ---------------------------------------------------------
+        |       Running streaming pipeline (scrape -> db)       |
+        ---------------------------------------------------------
+        """
+    )
+
+    # Scrape, crawl and insert at the same time, and also write the JSON file from the same stream
+    conn = create_database()
+    count = run_pipeline(conn, json_filename="restaurants.json")
+    print(f"Number of restaurants: {count}")
+    print(f"HTTP client stats: {get_scraper_client().stats()}")
+    print(f"Snapshot: {lab3db.publish_snapshot(conn)}")
+
+    view_decoded_database(conn)
+
+
+def test_multi_region():
+    print(
+        """
+        ---------------------------------------------------------
+        |       Running part A for all the registry regions     |
+        ---------------------------------------------------------
+        """
+    )
+
+    # Scrape all the regions of the registry in parallel, then crawl the addresses
+    restaurants, results, deduplicator = scrape_regions(load_region_registry())
+    failed = [result.name for result in results if result.error]
+    print(f"Number of restaurants: {len(restaurants)} ({len(results)} regions, failed: {failed or 'none'})")
+    print(f"Duplicates per region: {dict(deduplicator.duplicates)}")
+
+    add_restaurant_addresses(restaurants)
+    write_to_json_file(restaurants, "restaurants.json")
+
+
+def test_resumable_crawl():
+    print(
+        """
+        ---------------------------------------------------------
+        |       Running part A with the crawl journal           |
+        ---------------------------------------------------------
+        """
+    )
+
+    # Run it again after stopping it: the pages already done are not fetched again
+    restaurants, counts = resumable_crawl()
+    print(f"Number of restaurants: {len(restaurants)}, journal: {counts}")
+
+    write_to_json_file(restaurants, "restaurants.json")
+
+
+def test_incremental_refresh():
+    print(
+        """
+        ---------------------------------------------------------
+        |       Running incremental refresh (only changes)      |
+        ---------------------------------------------------------
+        """
+    )
+
+    # Re-scrape the directory pages, and only crawl / write the restaurants that changed
+    conn = create_database()
+    print(f"Refresh: {incremental_refresh(conn)}")
+    print(f"HTTP client stats: {get_scraper_client().stats()}")
+    print(f"Snapshot: {lab3db.publish_snapshot(conn)}")
+
+    view_decoded_database(conn)
+
+
+def test_geocoding():
+    print(
+        """
+        ---------------------------------------------------------
+        |       Geocoding and restaurants near a place          |
+        ---------------------------------------------------------
+        """
+    )
+
+    # Geocode the restaurants that have no coordinates yet (offline gazetteer)
+    conn = create_database()
+    print(f"Geocoding: {geocode_restaurants(conn)}")
+    print(f"Snapshot: {lab3db.publish_snapshot(conn)}")
+
+    # The restaurants nearest to downtown San Jose
+    for restaurant_id, name, distance in lab3db.nearest_restaurants(conn, 37.3337, -121.8907, count=5):
+        print(f"{restaurant_id:5} {name:40} {distance:6.2f} km")
+
+
 def main():
     """
     Main function (testing)
@@ -426,36 +2799,44 @@ def main():
     print("\n ***** TESTING PART A: Scraping & writing to json ***** \b")
 
     # Get the restaurant data from both cities
-    restaurants = []
 
-    # VERSION 1: skip duplicate dict entries (NOTE this is also handled in db insertion)
-    restaurants.extend(r for r in fetch_restaurants_directory_data(URL_DICT["San Jose"]) if r not in restaurants)
-    restaurants.extend(r for r in fetch_restaurants_directory_data(URL_DICT["Cupertino"]) if r not in restaurants)
+    # VERSION 1: skip duplicate restaurants (same canonical url, NOTE this is also handled in db insertion)
+    restaurants, deduplicator = deduplicate_regions(
+        (region, fetch_restaurants_directory_data(URL_DICT[region])) for region in ("San Jose", "Cupertino")
+    )
+    print(f"Duplicates per region: {dict(deduplicator.duplicates)}")
 
     # # VERSION 2: get all restaurants, including duplicates to test db insertion
     # for url in URL_DICT.values():
     #     restaurants.extend(fetch_restaurants_directory_data(url))
 
-    # Use the restaurant urls to get the restaurant street addresses, and add to dictionary
-    for restaurant in restaurants:
-        restaurant["address"] = extract_restaurant_address(restaurant["url"])
+    # Use the restaurant urls to get the restaurant street addresses (concurrently), and add to the records
+    add_restaurant_addresses(restaurants)
 
     # Now, write the data to a JSON file using the write_to_json_file() function
     write_to_json_file(restaurants, "restaurants.json")
 
+    print(f"HTTP client stats: {get_scraper_client().stats()}")
+
     print("\n ***** TESTING PART B: writing to & reading from db ***** \n")
 
     # read the data from the JSON file
     with open("restaurants.json", "r") as file:
-        restaurants_from_json = json.load(file)
+        restaurants_from_json = [Restaurant.from_dict(restaurant) for restaurant in json.load(file)]
 
     print(f"Number of restaurants: {len(restaurants_from_json)}")
 
     # Call the create_database() function to create the database and get the connection
     conn = create_database()
 
-    # Call the insert_into_database() function to insert the data into the database
-    insert_into_database(conn, restaurants_from_json)
+    # Call the bulk_insert_into_database() function to insert the data into the database (one transaction)
+    bulk_insert_into_database(conn, restaurants_from_json)
+
+    # Geocode the new restaurants (offline gazetteer), for the front end's "restaurants near" queries
+    print(f"Geocoding: {geocode_restaurants(conn)}")
+
+    # Publish the read-only catalog snapshot the front end reads (swapped in atomically if it's running)
+    print(f"Snapshot: {lab3db.publish_snapshot(conn)}")
 
     # Call the view_database() function to view the contents of the database
     view_database(conn)
@@ -471,3 +2852,9 @@ if __name__ == "__main__":
     # test_partA_without_duplicates()
     # test_partA_with_duplicates()
     # test_partB()
+    # test_pipeline()
+    # test_partB_json_lines()
+    # test_multi_region()
+    # test_resumable_crawl()
+    # test_incremental_refresh()
+    # test_geocoding()
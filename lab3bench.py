@@ -0,0 +1,1072 @@
+"""
+Authors: Alex Hagemeister & Marcel Gunadi
+Spring Quarter, 2023
+CIS41B Advanced Python
+
+Lab 3: Web Scraping and Database Interaction
+
+lab3bench.py
+
+    Benchmarks of the back end (lab3back.py) and of the front end's queries (lab3db.py), also on the
+    first version of the schema (before the migrations) to compare the filter queries, and on a catalog
+    snapshot to compare with the live database.
+    The pages are synthetic copies of the Michelin Guide pages (same structure as the pages the
+    scraper parses), or saved pages given on the command line, so nothing hits the live site.
+
+    The scraper benchmark runs the scraper against StubMichelinSite, a local HTTP stand-in of the site
+    (configurable latency, number of restaurants and error rate), and writes machine-readable results
+    (JSON) to compare between commits. The HTTP client tests (tests/test_scraper.py) run against it too.
+
+    usage: python lab3bench.py [saved directory / restaurant page files...]
+           python lab3bench.py scraper [--sizes 100,1000,10000] [--latency 0.005] [--error-rate 0.01]
+                                       [--output results.json]
+"""
+
+import argparse
+import hashlib
+import heapq
+import json
+import multiprocessing
+import os
+import pickle
+import random
+import re
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import lab3back
+import lab3db
+import lab3trace
+
+# Markup around the cards, to get pages about the size of the real ones
+PAGE_FILLER = "".join(f'<script>var data{i} = "{"x" * 200}";</script>\n' for i in range(300))
+
+CUISINES = ["Ethiopian", "Portuguese", "Mexican", "French", "Japanese", "Californian", "Thai", "Italian"]
+COSTS = ["$", "$$", "$$$", "$$$$"]
+CITIES = ["San Jose", "Cupertino", "Los Gatos", "Saratoga", "Campbell", "Santa Clara"]
+NAME_WORDS = [
+    "Luna", "Adega", "Petiscos", "Golden", "Garden", "Kitchen", "Bistro", "Casa", "Sakura", "Maison", "Taqueria"
+]
+
+
+def make_card(index):
+    """
+    RETURN: the HTML of a restaurant card of a directory page (synthetic restaurant number index)
+    """
+    slug = f"restaurant-{index}"
+    city = CITIES[index % len(CITIES)]
+    href = f"/us/en/california/{city.lower().replace(' ', '-')}/restaurant/{slug}"
+    return f"""
+    <div class="col-md-6 col-lg-4 col-xl-3">
+      <div class="card__menu box-placeholder js-restaurant__list_item js-match-height js-map" data-index="{index}">
+        <div class="card__menu-image"><a href="{href}" class="image-wrapper pl-image"><img src="x.jpg"></a></div>
+        <div class="card__menu-content card__menu-content--flex js-match-height-content">
+          <div class="card__menu-content--rating"><span class="distinction-icon"></span></div>
+          <h3 class="card__menu-content--title pl-text pl-big js-match-height-title">
+            <a href="{href}" aria-label="Open {escape(slug)}" class="link">Restaurant {index} &amp; Bar</a>
+          </h3>
+          <div class="card__menu-footer d-flex">
+            <div class="card__menu-footer--location flex-fill pl-text">{city}, USA</div>
+          </div>
+          <div class="card__menu-footer--price pl-text">
+            {COSTS[index % len(COSTS)]}
+            ·
+            {CUISINES[index % len(CUISINES)]}
+          </div>
+        </div>
+      </div>
+    </div>"""
+
+
+def make_directory_page(
+    page_number, page_count, cards_per_page=20, base="/us/en/california/san-jose/restaurants", restaurant_count=None
+):
+    """
+    RETURN: the HTML (bytes) of directory page page_number (1 based) of page_count pages,
+        with the previous / next page arrows of the real site
+        (if restaurant_count is given, the last page only has the cards up to it)
+    """
+    first = (page_number - 1) * cards_per_page
+    last = first + cards_per_page if restaurant_count is None else min(first + cards_per_page, restaurant_count)
+    cards = "".join(make_card(index) for index in range(first, last))
+
+    arrows = []
+    if page_number > 1:
+        arrows.append(
+            f'<a class="btn-carousel__link" href="{base}/page/{page_number - 1}">'
+            '<span class="icon fal fa-angle-left"></span></a>'
+        )
+    if page_number < page_count:
+        arrows.append(
+            f'<a class="btn-carousel__link" href="{base}/page/{page_number + 1}">'
+            '<span class="icon fal fa-angle-right"></span></a>'
+        )
+
+    return f"""<!DOCTYPE html>
+<html lang="en"><head><meta charset="utf-8"><title>Restaurants</title>{PAGE_FILLER}</head>
+<body><!-- listing -->
+<div class="row restaurant__list-row js-toggle-result-row">{cards}</div>
+<div class="js-restaurant__bottom-pagination"><div class="btn-carousel hide-not-first">{"".join(arrows)}</div></div>
+{PAGE_FILLER}</body></html>""".encode("utf-8")
+
+
+def make_restaurant_page(index):
+    """
+    RETURN: the HTML (bytes) of the page of the synthetic restaurant number index
+    """
+    return f"""<!DOCTYPE html>
+<html lang="en"><head><meta charset="utf-8"><title>Restaurant {index}</title>{PAGE_FILLER}</head>
+<body><div class="restaurant-details__heading d-none d-lg-block">
+<h2 class="restaurant-details__heading--title">Restaurant {index} &amp; Bar</h2>
+<ul class="restaurant-details__heading--list">
+<li class="restaurant-details__heading--address">
+    {index} N. First St., Ste. C., San José, 95112, USA
+</li>
+<li class="restaurant-details__heading-price">$$ · Ethiopian</li>
+</ul></div>
+{PAGE_FILLER}</body></html>""".encode("utf-8")
+
+
+def best_time(function, content, repeat):
+    """
+    RETURN: the best time (seconds) of repeat calls of function(content)
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(content)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def benchmark_html_extraction(directory_pages=None, restaurant_pages=None, repeat=5):
+    """
+    Compare the lxml/XPath extraction engine with the BeautifulSoup one:
+    checks that both give the same output on every page, and prints the time per page and the speedup.
+
+    PARAM: directory_pages (list of bytes) - directory pages (default: synthetic pages)
+    PARAM: restaurant_pages (list of bytes) - restaurant pages (default: synthetic pages)
+    PARAM: repeat (int) - number of runs per page, the best one is kept
+    """
+    if not directory_pages:
+        directory_pages = [make_directory_page(page, 3) for page in (1, 2, 3)]
+    if not restaurant_pages:
+        restaurant_pages = [make_restaurant_page(index) for index in range(3)]
+
+    tests = [
+        ("directory page", directory_pages, lab3back.parse_directory_page, lab3back.parse_directory_page_bs4),
+        ("restaurant page", restaurant_pages, lab3back.parse_restaurant_address, lab3back.parse_restaurant_address_bs4),
+    ]
+    for name, pages, fast, reference in tests:
+        for content in pages:
+            if fast(content) != reference(content):
+                raise AssertionError(f"lxml and BeautifulSoup extraction differ on a {name}")
+
+        fast_time = sum(best_time(fast, content, repeat) for content in pages) / len(pages)
+        reference_time = sum(best_time(reference, content, repeat) for content in pages) / len(pages)
+        print(
+            f"{name:16}: BeautifulSoup {reference_time * 1000:8.2f} ms | lxml {fast_time * 1000:8.2f} ms"
+            f" | speedup x{reference_time / fast_time:.1f}"
+        )
+
+
+def iter_rows(count):
+    """
+    YIELDS: count synthetic restaurant dictionaries, as read from the JSON file
+    """
+    for index in range(count):
+        yield {
+            "name": f"{NAME_WORDS[index % len(NAME_WORDS)]} {NAME_WORDS[index // 7 % len(NAME_WORDS)]} {index}",
+            "url": f"https://guide.michelin.com/us/en/california/restaurant/restaurant-{index}",
+            "location": f"{CITIES[index % len(CITIES)]} {index % 500}, USA",
+            "cost": COSTS[index % len(COSTS)],
+            "cuisine": CUISINES[index % len(CUISINES)],
+            "address": f"{index} N. First St., San José, 95112, USA",
+        }
+
+
+def make_rows(count):
+    """
+    RETURN: a list of count synthetic restaurant dictionaries, as read from the JSON file
+    """
+    return list(iter_rows(count))
+
+
+def benchmark_database_insert(count=100000):
+    """
+    Compare insert_into_database() (7 statements per row) with bulk_insert_into_database()
+    (cached lookup ids, executemany, one transaction) on count synthetic rows, each in a new database file.
+    """
+    rows = make_rows(count)
+    with tempfile.TemporaryDirectory() as directory:
+        times = {}
+        for name, insert in [
+            ("insert_into_database", lab3back.insert_into_database),
+            ("bulk_insert_into_database", lab3back.bulk_insert_into_database),
+        ]:
+            conn = lab3back.create_database(os.path.join(directory, f"{name}.db"))
+            start = time.perf_counter()
+            insert(conn, rows)
+            times[name] = time.perf_counter() - start
+
+            inserted = conn.execute("SELECT COUNT(*) FROM Restaurant").fetchone()[0]
+            conn.close()
+            if inserted != count:
+                raise AssertionError(f"{name} inserted {inserted} rows instead of {count}")
+            print(f"{name:26}: {times[name]:7.2f} s | {count / times[name]:10.0f} rows/s")
+
+    print(f"speedup x{times['insert_into_database'] / times['bulk_insert_into_database']:.1f}")
+
+
+def measure(build):
+    """
+    RETURN: tuple (result, seconds, bytes) - result of build(), its run time and the memory it allocated
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build()
+    seconds = time.perf_counter() - start
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, seconds, allocated
+
+
+def benchmark_record_memory(count=1000000):
+    """
+    Compare the memory of count scraped restaurants stored as defaultdict(lambda: "N/A") (old)
+    and as Restaurant records (new), and the time to serialize the records to JSON, SQLite tuples and pickle.
+    """
+    rows = make_rows(count)
+
+    def build_dicts():
+        # (the strings are copied, like the scraper creates new strings for every card)
+        return [defaultdict(lambda: "N/A", {key: "".join(value) for key, value in row.items()}) for row in rows]
+
+    def build_records():
+        return [lab3back.Restaurant(**{key: "".join(value) for key, value in row.items()}) for row in rows]
+
+    print(f"{count} restaurants:")
+    results = {}
+    for name, build in [("defaultdict", build_dicts), ("Restaurant", build_records)]:
+        records, seconds, allocated = measure(build)
+        results[name] = allocated
+        print(
+            f"{name:12}: {allocated / 2**20:8.1f} MB ({allocated / count:6.0f} bytes/restaurant),"
+            f" built in {seconds:.2f} s"
+        )
+        del records
+    print(f"memory saved: {1 - results['Restaurant'] / results['defaultdict']:.0%}")
+
+    records = build_records()
+    for name, serialize in [
+        ("JSON", lambda: json.dumps(records, default=lab3back.json_default)),
+        ("SQLite tuples", lambda: [record.to_tuple() for record in records]),
+        ("pickle", lambda: pickle.dumps(records, pickle.HIGHEST_PROTOCOL)),
+    ]:
+        start = time.perf_counter()
+        serialize()
+        print(f"serialize to {name:13}: {time.perf_counter() - start:.2f} s")
+
+
+def like_search(conn, text, limit=lab3db.SEARCH_LIMIT):
+    """
+    The search without the full-text index: every word must be in the name, cuisine, city or address,
+    with LIKE '%word%' (a scan of every restaurant), sorted by name
+    """
+    where, params = [], []
+    for word in text.split():
+        where.append(
+            "(R.restaurant_name LIKE ? OR C.cuisine_name LIKE ? OR L.location_name LIKE ? OR R.street_address LIKE ?)"
+        )
+        params.extend([f"%{word}%"] * 4)
+    return conn.execute(
+        "SELECT R.restaurant_id, R.restaurant_name, C.cuisine_name, L.location_name FROM Restaurant R "
+        "JOIN Cuisine C ON R.cuisine_id = C.cuisine_id JOIN Location L ON R.location_id = L.location_id "
+        f"WHERE R.delisted = 0 AND {' AND '.join(where)} ORDER BY R.restaurant_name LIMIT ?",
+        params + [limit],
+    ).fetchall()
+
+
+def benchmark_search(count=1000000, repeat=5):
+    """
+    Compare the full-text search (FTS5, ranked, word prefixes) with a LIKE '%...%' scan on count synthetic
+    restaurants, and the cost of the search index on the bulk insert.
+    """
+    queries = ["luna", "sak bis", "thai campbell", "first st 4242", "golden garden 77", "42424"]
+    with tempfile.TemporaryDirectory() as directory:
+        conn = lab3back.create_database(os.path.join(directory, "search.db"))
+        start = time.perf_counter()
+        lab3back.bulk_insert_into_database(conn, iter_rows(count))
+        print(f"bulk insert of {count} restaurants (with the search index): {time.perf_counter() - start:.2f} s")
+
+        print(f"{'query':18} | {'FTS5':>9} | {'LIKE':>9} | speedup | results (FTS5 / LIKE)")
+        for text in queries:
+            times, results = {}, {}
+            for name, search in [("FTS5", lab3db.search_restaurants), ("LIKE", like_search)]:
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    results[name] = search(conn, text)
+                times[name] = (time.perf_counter() - start) / repeat
+            print(
+                f"{text:18} | {times['FTS5'] * 1000:6.2f} ms | {times['LIKE'] * 1000:6.1f} ms |"
+                f" x{times['LIKE'] / times['FTS5']:6.1f} | {len(results['FTS5'])} / {len(results['LIKE'])}"
+            )
+        conn.close()
+
+
+COUNTRIES = ["USA", "Japan", "France", "Italy", "Spain", "Thailand", "Mexico", "Portugal"]
+
+# The schema of the first version of create_database() (before lab3db.migrate()): the location and cost
+# are strings, one cuisine per restaurant, and only the foreign keys are indexed
+V1_SCHEMA_SQL = [
+    "CREATE TABLE Cuisine (cuisine_id INTEGER PRIMARY KEY, cuisine_name TEXT UNIQUE)",
+    "CREATE TABLE Cost (cost_id INTEGER PRIMARY KEY, cost_symbol TEXT UNIQUE)",
+    "CREATE TABLE Location (location_id INTEGER PRIMARY KEY, location_name TEXT UNIQUE)",
+    """CREATE TABLE Restaurant (
+        restaurant_id INTEGER PRIMARY KEY,
+        restaurant_name TEXT UNIQUE,
+        restaurant_url TEXT UNIQUE,
+        cuisine_id INTEGER,
+        cost_id INTEGER,
+        location_id INTEGER,
+        street_address TEXT NOT NULL,
+        FOREIGN KEY (cuisine_id) REFERENCES Cuisine (cuisine_id),
+        FOREIGN KEY (cost_id) REFERENCES Cost (cost_id),
+        FOREIGN KEY (location_id) REFERENCES Location (location_id)
+    )""",
+    "CREATE INDEX idx_cuisine_id ON Restaurant (cuisine_id)",
+    "CREATE INDEX idx_cost_id ON Restaurant (cost_id)",
+    "CREATE INDEX idx_location_id ON Restaurant (location_id)",
+]
+
+
+def iter_catalog_rows(count):
+    """
+    YIELDS: count synthetic restaurant dictionaries (see iter_rows()) from several countries,
+    one in three with two cuisines ("Japanese, Thai")
+    """
+    for index, row in enumerate(iter_rows(count)):
+        city = CITIES[index % len(CITIES)]
+        row["location"] = f"{city} {index % 500}, {COUNTRIES[index // 3 % len(COUNTRIES)]}"
+        if index % 3 == 0:
+            row["cuisine"] = f"{row['cuisine']}, {CUISINES[index // 5 % len(CUISINES)]}"
+        yield row
+
+
+def create_v1_database(filename, rows):
+    """
+    Create a database with the first version's schema (V1_SCHEMA_SQL) and load rows into it
+
+    RETURN: the database connection
+    """
+    conn = sqlite3.connect(filename)
+    for sql in V1_SCHEMA_SQL:
+        conn.execute(sql)
+    ids = {"Cuisine": {}, "Cost": {}, "Location": {}}
+
+    def lookup_id(table, name):
+        if name not in ids[table]:
+            ids[table][name] = len(ids[table]) + 1
+        return ids[table][name]
+
+    conn.executemany(
+        "INSERT INTO Restaurant (restaurant_name, restaurant_url, cuisine_id, cost_id, location_id, street_address) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (
+            (
+                row["name"],
+                row["url"],
+                lookup_id("Cuisine", row["cuisine"]),
+                lookup_id("Cost", row["cost"]),
+                lookup_id("Location", row["location"]),
+                row["address"],
+            )
+            for row in rows
+        ),
+    )
+    for table, name_column in [("Cuisine", "cuisine_name"), ("Cost", "cost_symbol"), ("Location", "location_name")]:
+        conn.executemany(
+            f"INSERT INTO {table} VALUES (?, ?)", [(table_id, name) for name, table_id in ids[table].items()]
+        )
+    conn.commit()
+    return conn
+
+
+def benchmark_filter_queries(count=1000000, repeat=5):
+    """
+    Compare the GUI's typical filter queries on the first schema (string costs and locations, one cuisine per
+    restaurant, foreign key indexes) and on the migrated schema v2 (cost levels, countries, RestaurantCuisine,
+    composite indexes), on count synthetic restaurants. The two give the same results.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        v1 = create_v1_database(os.path.join(directory, "v1.db"), iter_catalog_rows(count))
+        v1.close()
+        print(f"load of {count} restaurants (schema v1): {time.perf_counter() - start:.2f} s")
+
+        shutil.copy(os.path.join(directory, "v1.db"), os.path.join(directory, "v2.db"))
+        v1 = lab3db.open_read_only(os.path.join(directory, "v1.db"))
+        v2 = sqlite3.connect(os.path.join(directory, "v2.db"))
+        start = time.perf_counter()
+        lab3db.migrate(v2)
+        print(f"migration to schema v{lab3db.SCHEMA_VERSION}: {time.perf_counter() - start:.2f} s")
+
+        city_id = v1.execute("SELECT location_id FROM Location ORDER BY location_id LIMIT 1").fetchone()[0]
+        japan_id = v2.execute("SELECT country_id FROM Country WHERE country_name = 'Japan'").fetchone()[0]
+        japanese_id = v2.execute("SELECT cuisine_id FROM Cuisine WHERE cuisine_name = 'Japanese'").fetchone()[0]
+        order = "ORDER BY R.restaurant_name COLLATE NOCASE, R.restaurant_id LIMIT 50"
+        v1_from = (
+            "FROM Restaurant R JOIN Cost CO ON R.cost_id = CO.cost_id JOIN Location L ON R.location_id = L.location_id "
+            "JOIN Cuisine C ON R.cuisine_id = C.cuisine_id"
+        )
+        tests = [
+            (
+                "city, cost <= 2",
+                lambda conn: conn.execute(
+                    f"SELECT R.restaurant_id, R.restaurant_name {v1_from} "
+                    f"WHERE R.location_id = ? AND length(CO.cost_symbol) <= 2 {order}",
+                    (city_id,),
+                ).fetchall(),
+                lambda conn: lab3db.listing_page(conn, "location", city_id, max_cost_level=2),
+            ),
+            (
+                "cuisine (any)",
+                lambda conn: conn.execute(
+                    f"SELECT R.restaurant_id, R.restaurant_name {v1_from} WHERE C.cuisine_name LIKE ? {order}",
+                    ("%Japanese%",),
+                ).fetchall(),
+                lambda conn: lab3db.listing_page(conn, "cuisine", japanese_id),
+            ),
+            (
+                "count country",
+                lambda conn: conn.execute(
+                    f"SELECT count(*) {v1_from} WHERE L.location_name LIKE ?", ("%, Japan",)
+                ).fetchone()[0],
+                lambda conn: lab3db.filter_count(conn, country_id=japan_id),
+            ),
+            (
+                "count cost <= 2",
+                lambda conn: conn.execute(f"SELECT count(*) {v1_from} WHERE length(CO.cost_symbol) <= 2").fetchone()[0],
+                lambda conn: lab3db.filter_count(conn, max_cost_level=2),
+            ),
+            (
+                "country+cuisine+cost",
+                lambda conn: conn.execute(
+                    f"SELECT R.restaurant_id, R.restaurant_name {v1_from} "
+                    f"WHERE L.location_name LIKE ? AND C.cuisine_name LIKE ? AND length(CO.cost_symbol) <= 2 {order}",
+                    ("%, Japan", "%Japanese%"),
+                ).fetchall(),
+                lambda conn: lab3db.filter_restaurants(conn, japan_id, japanese_id, 2),
+            ),
+        ]
+
+        print(f"{'query':20} | {'schema v1':>11} | {'schema v2':>11} | speedup")
+        for name, before, after in tests:
+            times, results = {}, {}
+            for schema, conn, query in [("v1", v1, before), ("v2", v2, after)]:
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    results[schema] = query(conn)
+                times[schema] = (time.perf_counter() - start) / repeat
+            if results["v1"] != results["v2"]:
+                raise AssertionError(f"the schema v1 and v2 queries differ on {name}")
+            print(
+                f"{name:20} | {times['v1'] * 1000:8.2f} ms | {times['v2'] * 1000:8.2f} ms"
+                f" | x{times['v1'] / times['v2']:7.1f}"
+            )
+        v1.close()
+        v2.close()
+
+
+# Box the benchmark's restaurants are spread over (California): min / max latitude, min / max longitude
+GEO_BOX = (32.5, 42.0, -124.4, -114.1)
+
+
+class StubGeocoder:
+    """
+    Geocoder of the benchmarks (the geocode_restaurants() backend interface): a fixed pseudo-random point
+    of GEO_BOX for every address, without a gazetteer file or network
+    """
+
+    name = "stub"
+
+    def __init__(self, box=GEO_BOX, seed=0):
+        self.box = box
+        self.seed = seed
+
+    def geocode(self, address):
+        generator = random.Random(f"{self.seed}:{address}")
+        min_latitude, max_latitude, min_longitude, max_longitude = self.box
+        return generator.uniform(min_latitude, max_latitude), generator.uniform(min_longitude, max_longitude)
+
+
+def scan_nearest(conn, latitude, longitude, count):
+    """
+    The k nearest restaurants without the spatial index: the distance of every geocoded restaurant
+    """
+    rows = conn.execute(
+        "SELECT G.restaurant_id, R.restaurant_name, "
+        "(G.min_latitude + G.max_latitude) / 2, (G.min_longitude + G.max_longitude) / 2 "
+        "FROM RestaurantGeo G NOT INDEXED JOIN Restaurant R ON R.restaurant_id = G.restaurant_id WHERE R.delisted = 0"
+    )
+    distances = (
+        (restaurant_id, name, lab3db.haversine_km(latitude, longitude, point_latitude, point_longitude))
+        for restaurant_id, name, point_latitude, point_longitude in rows
+    )
+    return heapq.nsmallest(count, distances, key=lambda row: (row[2], row[0]))
+
+
+def benchmark_nearby(count=1000000, queries=5, repeat=1):
+    """
+    Geocoding stage throughput (StubGeocoder lookups, then the GeocodeCache), and the k nearest restaurants
+    with the R*Tree vs a scan of every restaurant, on count synthetic restaurants. The two give the same results.
+    """
+    generator = random.Random(0)
+    min_latitude, max_latitude, min_longitude, max_longitude = GEO_BOX
+    points = [
+        (generator.uniform(min_latitude, max_latitude), generator.uniform(min_longitude, max_longitude))
+        for _ in range(queries)
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        conn = lab3back.create_database(os.path.join(directory, "nearby.db"))
+        lab3back.bulk_insert_into_database(conn, iter_rows(count))
+
+        for name in ["lookups", "from cache"]:
+            if name == "from cache":
+                conn.execute("DELETE FROM RestaurantGeo")
+                conn.commit()
+            start = time.perf_counter()
+            stats = lab3back.geocode_restaurants(conn, StubGeocoder())
+            seconds = time.perf_counter() - start
+            print(f"geocoding ({name:10}): {seconds:6.2f} s | {stats['located'] / seconds:9.0f} restaurants/s")
+
+        print(f"{'query':24} | {'R*Tree':>9} | {'scan':>9} | speedup")
+        for k in [1, 20]:
+            times, results = {}, {}
+            for name, nearest in [("R*Tree", lab3db.nearest_restaurants), ("scan", scan_nearest)]:
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    results[name] = [nearest(conn, latitude, longitude, k) for latitude, longitude in points]
+                times[name] = (time.perf_counter() - start) / repeat / queries
+            found = [[row[0] for row in rows] for rows in results["R*Tree"]]
+            if found != [[row[0] for row in rows] for rows in results["scan"]]:
+                raise AssertionError(f"the R*Tree and the scan differ on the {k} nearest restaurants")
+            print(
+                f"{f'{k} nearest':24} | {times['R*Tree'] * 1000:6.2f} ms | {times['scan'] * 1000:6.0f} ms"
+                f" | x{times['scan'] / times['R*Tree']:7.1f}"
+            )
+
+        start = time.perf_counter()
+        for latitude, longitude in points:
+            lab3db.restaurants_near(conn, latitude, longitude, 5.0)
+        print(f"{'within 5 km (R*Tree)':24} | {(time.perf_counter() - start) / queries * 1000:6.2f} ms")
+        conn.close()
+
+
+def benchmark_snapshot(count=1000000, repeat=20):
+    """
+    The GUI on a catalog snapshot (lab3db.publish_snapshot(): immutable, memory-mapped, precomputed listings)
+    vs on the live database: startup (open, lookup tables, first page of the biggest cuisine), a page deep in
+    the listing (without the previous page) and a prefix count, on count synthetic restaurants.
+    The two give the same results.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "live.db")
+        snapshot_directory = os.path.join(directory, lab3db.SNAPSHOT_DIRECTORY)
+        conn = lab3back.create_database(filename)
+        lab3back.bulk_insert_into_database(conn, iter_catalog_rows(count))
+
+        start = time.perf_counter()
+        snapshot = lab3db.publish_snapshot(conn, snapshot_directory)
+        print(
+            f"publish: {time.perf_counter() - start:.2f} s | database {os.path.getsize(filename) / 1e6:.0f} MB"
+            f" | snapshot {os.path.getsize(snapshot) / 1e6:.0f} MB"
+        )
+        cuisine_id, size = conn.execute(
+            "SELECT cuisine_id, count(*) FROM RestaurantCuisine WHERE delisted = 0 GROUP BY cuisine_id "
+            "ORDER BY count(*) DESC LIMIT 1"
+        ).fetchone()
+        conn.close()
+
+        def open_live():
+            # What the GUI does without a snapshot: a read-write connection for the schema, then a read-only one
+            conn = sqlite3.connect(filename)
+            lab3db.ensure_schema(conn)
+            conn.close()
+            return lab3db.QueryCache(lab3db.open_read_only(filename), lab3db.RESTAURANT_CACHE_SIZE)
+
+        def open_current_snapshot():
+            snapshot = lab3db.current_snapshot(snapshot_directory)
+            return lab3db.QueryCache(lab3db.open_snapshot(snapshot), lab3db.RESTAURANT_CACHE_SIZE)
+
+        def startup(open_queries):
+            queries = open_queries()
+            queries.get_locations()
+            queries.get_cuisines()
+            page = queries.listing_page("cuisine", cuisine_id)
+            queries.conn.close()
+            return page
+
+        live = open_live()
+        current = open_current_snapshot()
+        tests = [
+            ("startup", lambda queries: startup(open_live), lambda queries: startup(open_current_snapshot)),
+            (
+                "page at 90% (offset)",
+                lambda queries: queries.listing_page("cuisine", cuisine_id, offset=size * 9 // 10),
+                None,
+            ),
+            ("prefix count", lambda queries: queries.listing_count("cuisine", cuisine_id, "Ca"), None),
+            ("first page, prefix", lambda queries: queries.listing_page("cuisine", cuisine_id, "Ca"), None),
+        ]
+
+        print(f"{'query':20} | {'database':>11} | {'snapshot':>11} | speedup")
+        for name, live_query, snapshot_query in tests:
+            times, results = {}, {}
+            for source, queries, query in [("live", live, live_query), ("snapshot", current, snapshot_query)]:
+                query = query or live_query
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    results[source] = query(queries)
+                times[source] = (time.perf_counter() - start) / repeat
+            if isinstance(results["live"], list):
+                results["live"] = [tuple(row[:2]) for row in results["live"]]
+            if results["live"] != results["snapshot"]:
+                raise AssertionError(f"the database and the snapshot differ on {name}")
+            print(
+                f"{name:20} | {times['live'] * 1000:8.2f} ms | {times['snapshot'] * 1000:8.2f} ms"
+                f" | x{times['live'] / times['snapshot']:7.1f}"
+            )
+        live.conn.close()
+        current.conn.close()
+
+
+def run_json_io(file_format, filename, count, results):
+    """
+    Write count restaurants to a file and read them back, in a new process (so its peak RSS is its own):
+        "json" - current path: list of records, write_to_json_file() (indent=4), json.load()
+        "jsonl" - streaming path: JsonLinesSink as the records are produced, lazy iter_json_lines()
+    Puts (write seconds, read seconds, peak RSS increase in bytes, file size) on the results queue.
+    """
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    records = (lab3back.Restaurant(**row) for row in iter_rows(count))
+
+    start = time.perf_counter()
+    if file_format == "json":
+        lab3back.write_to_json_file(list(records), filename)
+    else:
+        sink = lab3back.JsonLinesSink(filename)
+        for record in records:
+            sink.write(record)
+        sink.close()
+    write_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if file_format == "json":
+        with open(filename, "r", encoding="utf-8") as file:
+            read = len([lab3back.Restaurant.from_dict(row) for row in json.load(file)])
+    else:
+        read = sum(1 for _ in lab3back.iter_json_lines(filename))
+    read_seconds = time.perf_counter() - start
+
+    if read != count:
+        raise AssertionError(f"read {read} restaurants instead of {count}")
+    peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) * 1024  # (ru_maxrss is in KiB on Linux)
+    results.put((write_seconds, read_seconds, peak, os.path.getsize(filename)))
+
+
+def benchmark_json_io(count=200000):
+    """
+    Compare the write / read time, peak RSS and file size of the pretty JSON file (current path)
+    with JSON Lines files (plain, gzip and zstd if installed), for count restaurants.
+    """
+    print(f"{count} restaurants, JSON encoder: {'orjson' if lab3back.orjson else 'json'}")
+    tests = [("json", "restaurants.json"), ("jsonl", "restaurants.jsonl"), ("jsonl", "restaurants.jsonl.gz")]
+    if lab3back.zstandard is not None:
+        tests.append(("jsonl", "restaurants.jsonl.zst"))
+
+    context = multiprocessing.get_context("spawn")  # (a forked process would start with this process' memory)
+    with tempfile.TemporaryDirectory() as directory:
+        for file_format, name in tests:
+            results = context.Queue()
+            process = context.Process(
+                target=run_json_io, args=(file_format, os.path.join(directory, name), count, results)
+            )
+            process.start()
+            write_seconds, read_seconds, peak, size = results.get()
+            process.join()
+            print(
+                f"{name:22}: write {write_seconds:6.2f} s | read {read_seconds:6.2f} s"
+                f" | peak RSS +{peak / 2**20:7.1f} MB | file {size / 2**20:7.1f} MB"
+            )
+
+
+def benchmark_instrumentation(calls=1000000, pages=200):
+    """
+    Cost of the lab3trace instrumentation: per call of an instrumented empty function (disabled, enabled,
+    enabled with timeline), and on the instrumented directory page parsing.
+    """
+
+    def plain():
+        pass
+
+    instrumented = lab3trace.timed("bench.empty")(plain)
+    content = make_directory_page(1, 2)
+
+    def time_calls(function):
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        return (time.perf_counter() - start) / calls
+
+    def time_parse():
+        start = time.perf_counter()
+        for _ in range(pages):
+            lab3back.parse_directory_page(content)
+        return (time.perf_counter() - start) / pages
+
+    base = time_calls(plain)
+    print(f"plain function call      : {base * 1e9:7.0f} ns")
+    for name, timeline in [("disabled", None), ("enabled", False), ("enabled + timeline", True)]:
+        lab3trace.reset()
+        if timeline is not None:
+            lab3trace.enable(timeline)
+        overhead = time_calls(instrumented) - base
+        parse_time = time_parse()
+        lab3trace.disable()
+        print(f"{name:25}: +{overhead * 1e9:6.0f} ns per call | directory page parsed in {parse_time * 1000:.3f} ms")
+    lab3trace.reset()
+
+
+# SCRAPER BENCHMARK #
+
+# Path of the directory pages of the stand-in site (San Jose, like the first URL_DICT entry)
+DIRECTORY_PATH = "/us/en/california/san-jose/restaurants"
+CARDS_PER_PAGE = 20
+
+# Directory page: <directory path>[/page/N], restaurant page: /us/en/california/<city>/restaurant/restaurant-<index>
+DIRECTORY_PAGE_PATTERN = re.compile(re.escape(DIRECTORY_PATH) + r"(?:/page/(\d+))?/?$")
+RESTAURANT_PAGE_PATTERN = re.compile(r"/us/en/california/[\w-]+/restaurant/restaurant-(\d+)/?$")
+
+SCRAPER_BENCHMARKS = ["directory", "addresses", "insert", "bulk_insert", "pipeline"]
+SCRAPER_SIZES = [100, 1000, 10000]
+
+
+class StubMichelinSite:
+    """
+    Local HTTP stand-in of the Michelin Guide, serving the synthetic directory and restaurant pages
+    (same markup as the real pages) from a thread of this process.
+
+        - The number of restaurants is the first part of the path: /<count>/us/en/california/...
+          so one server serves every benchmark size (the scraper gets SITE_URL = <server url>/<count>)
+        - latency: seconds every response is delayed (like the network and the real server)
+        - error_rate: fraction of the requests answered with "503 Service Unavailable" (retried by the scraper)
+        - throttle(): the next requests are answered with "429 Too Many Requests" and a Retry-After header
+        - etags: the pages have an ETag, and a conditional GET of an unchanged page gets "304 Not Modified"
+          (unless not_modified_responses is False: then the validators are ignored, like some servers do)
+        - HTTP/1.1 keep-alive, so the scraper's connection pool is used like with the real site
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.throttled_requests = 0  # number of the next requests answered with 429
+        self.retry_after = None  # Retry-After header of the 429 responses (str), or None
+        self.throttled = 0
+        self.etags = False
+        self.not_modified_responses = True
+        self.not_modified = 0  # number of 304 responses
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self._thread = None
+
+    def _make_handler(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                status, content, headers = site.respond(self.path, self.headers)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass  # no log line per request
+
+        return Handler
+
+    def throttle(self, requests, retry_after=None):
+        """
+        Answer the next requests with "429 Too Many Requests"
+
+        PARAM: requests (int) - number of requests throttled
+        PARAM: retry_after (str) - Retry-After header of the 429 responses (seconds or HTTP date), None: no header
+        """
+        with self._lock:
+            self.throttled_requests = requests
+            self.retry_after = retry_after
+
+    def respond(self, path, request_headers=None):
+        """
+        PARAM: request_headers - the request's headers (If-None-Match), optional
+        RETURN: (HTTP status, content, extra headers (dict)) of the path
+        """
+        status, content, headers = self._respond(path)
+        if self.etags and status == 200:
+            etag = f'"{hashlib.sha1(content).hexdigest()}"'
+            if self.not_modified_responses and request_headers and request_headers.get("If-None-Match") == etag:
+                with self._lock:
+                    self.not_modified += 1
+                return 304, b"", {"ETag": etag}
+            headers = dict(headers, ETag=etag)
+        return status, content, headers
+
+    def _respond(self, path):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+            if self.throttled_requests > 0:
+                self.throttled_requests -= 1
+                self.throttled += 1
+                headers = {"Retry-After": self.retry_after} if self.retry_after is not None else {}
+                return 429, b"Too Many Requests", headers
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.errors += 1
+                return 503, b"Service Unavailable", {}
+
+        count, _, site_path = path.lstrip("/").partition("/")
+        if not count.isdigit():
+            return 404, b"Not Found", {}
+        count, site_path = int(count), "/" + site_path
+
+        match = DIRECTORY_PAGE_PATTERN.match(site_path)
+        if match:
+            page_count = max(1, -(-count // CARDS_PER_PAGE))
+            page_number = int(match.group(1) or 1)
+            if page_number > page_count:
+                return 404, b"Not Found", {}
+            return 200, make_directory_page(page_number, page_count, CARDS_PER_PAGE, DIRECTORY_PATH, count), {}
+
+        match = RESTAURANT_PAGE_PATTERN.match(site_path)
+        if match and int(match.group(1)) < count:
+            return 200, make_restaurant_page(int(match.group(1))), {}
+        return 404, b"Not Found", {}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="stub-michelin", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class TimedScraperClient(lab3back.ScraperClient):
+    """
+    ScraperClient that records the latency of every page (including its retries)
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.latencies = []
+
+    def get(self, url, headers=None, speculative=False):
+        start = time.perf_counter()
+        response = super().get(url, headers, speculative)
+        self.latencies.append(time.perf_counter() - start)  # (list.append is thread-safe)
+        return response
+
+
+def percentile(values, fraction):
+    """
+    RETURN: the value at this fraction (0-1) of the sorted values, None if there are no values
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_scraper_benchmark(benchmark, size, site_url, results):
+    """
+    Run one scraper benchmark on size restaurants of the stand-in site, in a new process (so its peak RSS
+    is its own). The client has no cache and no rate limit, and retries quickly.
+        "directory" - fetch_restaurants_directory_data() of the directory pages
+        "addresses" - extract_restaurant_address() of the restaurant pages (crawl_restaurant_addresses())
+        "insert" / "bulk_insert" - insert_into_database() / bulk_insert_into_database() of size rows
+        "pipeline" - run_pipeline(): directory pages, restaurant pages and database, streaming
+    Puts the result (dict) on the results queue.
+    """
+    lab3back.SITE_URL = f"{site_url}/{size}"
+    directory_url = lab3back.SITE_URL + DIRECTORY_PATH
+    client = TimedScraperClient(backoff_factor=0.01, max_backoff=0.1)
+    lab3back.set_scraper_client(client)
+
+    with tempfile.TemporaryDirectory() as directory:
+        conn = lab3back.create_database(os.path.join(directory, "bench.db"))
+        start = time.perf_counter()
+        if benchmark == "directory":
+            rows = len(lab3back.fetch_restaurants_directory_data(directory_url, client, raise_errors=True))
+        elif benchmark == "addresses":
+            urls = [f"{lab3back.SITE_URL}/us/en/california/san-jose/restaurant/restaurant-{i}" for i in range(size)]
+            addresses, failures = lab3back.crawl_restaurant_addresses(urls)
+            rows = len(addresses) - len(failures)
+        elif benchmark == "insert":
+            lab3back.insert_into_database(conn, iter_rows(size))
+            rows = size
+        elif benchmark == "bulk_insert":
+            rows = lab3back.bulk_insert_into_database(conn, iter_rows(size))
+        else:
+            rows = lab3back.run_pipeline(conn, [directory_url])
+        seconds = time.perf_counter() - start
+        conn.close()
+
+    stats = client.stats()
+    p50, p99 = percentile(client.latencies, 0.5), percentile(client.latencies, 0.99)
+    results.put(
+        {
+            "benchmark": benchmark,
+            "size": size,
+            "seconds": round(seconds, 4),
+            "pages": len(client.latencies),
+            "rows": rows,
+            "pages_per_second": round(len(client.latencies) / seconds, 1),
+            "rows_per_second": round(rows / seconds, 1),
+            "p50_ms": round(p50 * 1000, 3) if p50 is not None else None,
+            "p99_ms": round(p99 * 1000, 3) if p99 is not None else None,
+            "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,  # (KiB on Linux)
+            "retries": stats["retries"],
+            "failures": stats["failures"],
+            "speculative_misses": stats["speculative_misses"],
+        }
+    )
+
+
+def benchmark_scraper(sizes=SCRAPER_SIZES, benchmarks=SCRAPER_BENCHMARKS, latency=0.0, error_rate=0.0):
+    """
+    Run the scraper benchmarks at every size against a StubMichelinSite, each in a new process.
+
+    PARAM: sizes (list of int) - numbers of restaurants (e.g. 100 to 1000000)
+    PARAM: benchmarks (list of str) - names of the benchmarks (SCRAPER_BENCHMARKS)
+    PARAM: latency (float) - seconds the stand-in site delays every response
+    PARAM: error_rate (float) - fraction of the responses that are 503 errors
+    RETURN: dict: the settings, and a list of the results (see run_scraper_benchmark())
+    """
+    context = multiprocessing.get_context("spawn")
+    results = []
+    with StubMichelinSite(latency, error_rate) as site:
+        for size in sizes:
+            for benchmark in benchmarks:
+                queue = context.Queue()
+                process = context.Process(target=run_scraper_benchmark, args=(benchmark, size, site.url, queue))
+                process.start()
+                result = queue.get()
+                process.join()
+                results.append(result)
+                # (progress on stderr, the JSON report may be on stdout)
+                print(
+                    f"{benchmark:12} {size:8} | {result['seconds']:8.2f} s"
+                    f" | {result['pages_per_second']:8.1f} pages/s | {result['rows_per_second']:9.1f} rows/s"
+                    f" | p50 {result['p50_ms']} ms | p99 {result['p99_ms']} ms"
+                    f" | peak RSS {result['peak_rss_bytes'] / 2**20:6.1f} MB",
+                    file=sys.stderr,
+                )
+
+    return {
+        "python": sys.version.split()[0],
+        "sqlite": lab3db.sqlite3.sqlite_version,
+        "latency": latency,
+        "error_rate": error_rate,
+        "results": results,
+    }
+
+
+def scraper_main(args):
+    parser = argparse.ArgumentParser(prog="lab3bench.py scraper", description="Scraper benchmarks on a local site")
+    parser.add_argument("--sizes", default=",".join(map(str, SCRAPER_SIZES)), help="numbers of restaurants")
+    parser.add_argument("--benchmarks", default=",".join(SCRAPER_BENCHMARKS), help="benchmarks to run")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of 503 responses")
+    parser.add_argument("--output", help="JSON file of the results (default: stdout)")
+    options = parser.parse_args(args)
+
+    report = benchmark_scraper(
+        [int(size) for size in options.sizes.split(",")],
+        options.benchmarks.split(","),
+        options.latency,
+        options.error_rate,
+    )
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+def main(filenames):
+    # saved pages: the ones with restaurant cards are directory pages, the others restaurant pages
+    directory_pages, restaurant_pages = [], []
+    for filename in filenames:
+        with open(filename, "rb") as file:
+            content = file.read()
+        (directory_pages if b"js-restaurant__list_item" in content else restaurant_pages).append(content)
+
+    print("\n ***** Benchmark: HTML extraction ***** \n")
+    benchmark_html_extraction(directory_pages, restaurant_pages)
+
+    print("\n ***** Benchmark: database insert (100k rows) ***** \n")
+    benchmark_database_insert(100000)
+
+    print("\n ***** Benchmark: full-text search vs LIKE scan (1M rows) ***** \n")
+    benchmark_search(1000000)
+
+    print("\n ***** Benchmark: filter queries, schema v1 vs v2 (1M rows) ***** \n")
+    benchmark_filter_queries(1000000)
+
+    print("\n ***** Benchmark: geocoding and nearest restaurants (1M rows) ***** \n")
+    benchmark_nearby(1000000)
+
+    print("\n ***** Benchmark: catalog snapshot vs live database (1M rows) ***** \n")
+    benchmark_snapshot(1000000)
+
+    print("\n ***** Benchmark: JSON / JSON Lines write and read (200k records) ***** \n")
+    benchmark_json_io(200000)
+
+    print("\n ***** Benchmark: restaurant record memory (1M records) ***** \n")
+    benchmark_record_memory(1000000)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["scraper"]:
+        scraper_main(sys.argv[2:])
+    else:
+        main(sys.argv[1:])
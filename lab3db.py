@@ -0,0 +1,1364 @@
+"""
+Authors: Alex Hagemeister & Marcel Gunadi
+Spring Quarter, 2023
+CIS41B Advanced Python
+
+Lab 3: Web Scraping and Database Interaction
+
+lab3db.py
+
+    Data access for the restaurants database, shared by the front end (lab3front.py) and the
+    back end (lab3back.py, to view the database):
+
+    - Decoded restaurant rows (cuisine, cost and location names instead of ids) in one joined query
+    - Batch lookup of many restaurants by id
+    - Schema migrations (versioned schema, PRAGMA user_version)
+    - Restaurant listings by city / cuisine, served by covering indexes, also by pages with a name prefix filter
+      and a max cost level, and filters by country / cuisine / cost level
+    - Full-text search (FTS5) of the restaurants' name, cuisine, city and address
+    - Restaurants near a point (radius and k-nearest queries), served by an R*Tree spatial index
+    - Catalog snapshots: read-only, versioned copies of the database published by the back end after a load,
+      with precomputed listings, opened immutable and memory-mapped by the GUI
+    - QueryCache: in-process read-through cache of the lookup tables and decoded restaurants for the GUI
+    - DatabaseWorker: runs the GUI's queries on a background thread with its own read-only connection
+"""
+
+import math
+import os
+import queue
+import re
+import sqlite3
+import threading
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from urllib.request import pathname2url
+
+# A restaurant with its lookup values decoded (cuisine: all its cuisines, e.g. "Japanese, Sushi")
+DecodedRestaurant = namedtuple(
+    "DecodedRestaurant", ["restaurant_id", "name", "url", "cuisine", "cost", "location", "address"]
+)
+
+# The cuisines of a restaurant, primary cuisine first ("Japanese, Sushi"), or NULL if it has none.
+# {restaurant_id} is replaced by the SQL expression of the restaurant's id.
+CUISINES_SQL = """(
+    SELECT group_concat(cuisine_name, ', ') FROM (
+        SELECT C.cuisine_name FROM RestaurantCuisine RC JOIN Cuisine C ON C.cuisine_id = RC.cuisine_id
+        WHERE RC.restaurant_id = {restaurant_id} ORDER BY RC.position
+    )
+)"""
+
+DECODED_RESTAURANT_QUERY = f"""
+    SELECT R.restaurant_id, R.restaurant_name, R.restaurant_url,
+           COALESCE({CUISINES_SQL.format(restaurant_id="R.restaurant_id")}, C.cuisine_name),
+           CO.cost_symbol, L.location_name, R.street_address
+    FROM Restaurant R
+    JOIN Cuisine C ON R.cuisine_id = C.cuisine_id
+    JOIN Cost CO ON R.cost_id = CO.cost_id
+    JOIN Location L ON R.location_id = L.location_id
+"""
+
+# Version of the schema made by migrate() (stored in the database file, PRAGMA user_version)
+SCHEMA_VERSION = 3
+
+# Max number of ids per "IN (...)" query (SQLite limits the number of parameters of a statement)
+BATCH_SIZE = 500
+
+# Max number of decoded restaurants kept by a QueryCache (least recently used are evicted first)
+RESTAURANT_CACHE_SIZE = 256
+
+# Listing -> (the table it's read from, the column it filters on). Table and column names are put in the SQL,
+# so only these are allowed. Both tables have the restaurant_id, restaurant_name, delisted and cost_level columns.
+LISTING_TABLES = {"location": ("Restaurant", "location_id"), "cuisine": ("RestaurantCuisine", "cuisine_id")}
+
+# Default number of rows of a listing page
+PAGE_SIZE = 50
+
+# Max number of results of a full-text search
+SEARCH_LIMIT = 100
+
+# Above this number of matches, the results of a search aren't ranked: bm25() scores every match
+# (~2 us per match), while unranked results stop at the first SEARCH_LIMIT matches
+SEARCH_RANK_LIMIT = 20000
+
+# Separator of the cuisines in a directory card's cuisine ("Japanese, Sushi") and of the city and country
+# in its location ("San Jose, USA")
+NAME_SEPARATOR = ", "
+
+# The cuisines of a restaurant (many-to-many), position 0 is its primary cuisine (Restaurant.cuisine_id).
+# A cuisine listing is read from this table only: it has a copy of the restaurant's listing columns
+# (name, delisted, cost level), kept up to date by LISTING_TRIGGERS_SQL.
+RESTAURANT_CUISINE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS RestaurantCuisine (
+        restaurant_id INTEGER NOT NULL,
+        cuisine_id INTEGER NOT NULL,
+        position INTEGER NOT NULL DEFAULT 0,
+        restaurant_name TEXT,
+        delisted INTEGER NOT NULL DEFAULT 0,
+        cost_level INTEGER,
+        PRIMARY KEY (restaurant_id, cuisine_id),
+        FOREIGN KEY (restaurant_id) REFERENCES Restaurant (restaurant_id),
+        FOREIGN KEY (cuisine_id) REFERENCES Cuisine (cuisine_id)
+    ) WITHOUT ROWID
+"""
+
+COUNTRY_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS Country (
+        country_id INTEGER PRIMARY KEY,
+        country_name TEXT UNIQUE
+    )
+"""
+
+# Composite indexes of the GUI's access patterns:
+#   - a listing by city or cuisine (sorted by name, case-insensitively, then id, with a name prefix and a max
+#     cost level) is read in order from one covering index, without reading the Restaurant table
+#   - the restaurants of a country: its cities, then their ranges of idx_location_names
+#   - a cost range over every restaurant ("cost <= 2") is a range of idx_restaurant_cost
+LISTING_INDEXES_SQL = [
+    "CREATE INDEX IF NOT EXISTS idx_location_names "
+    "ON Restaurant (location_id, delisted, restaurant_name COLLATE NOCASE, restaurant_id, cost_level)",
+    "CREATE INDEX IF NOT EXISTS idx_cuisine_names "
+    "ON RestaurantCuisine (cuisine_id, delisted, restaurant_name COLLATE NOCASE, restaurant_id, cost_level)",
+    "CREATE INDEX IF NOT EXISTS idx_location_country ON Location (country_id)",
+    "CREATE INDEX IF NOT EXISTS idx_restaurant_cost ON Restaurant (cost_level, delisted)",
+]
+
+# Keep the listing columns of RestaurantCuisine in sync with Restaurant
+LISTING_TRIGGERS_SQL = [
+    "CREATE TRIGGER IF NOT EXISTS restaurant_cuisine_listing "
+    "AFTER UPDATE OF restaurant_name, delisted, cost_level ON Restaurant BEGIN "
+    "UPDATE RestaurantCuisine SET restaurant_name = NEW.restaurant_name, delisted = NEW.delisted, "
+    "cost_level = NEW.cost_level WHERE restaurant_id = NEW.restaurant_id; END",
+    "CREATE TRIGGER IF NOT EXISTS restaurant_cuisine_delete AFTER DELETE ON Restaurant BEGIN "
+    "DELETE FROM RestaurantCuisine WHERE restaurant_id = OLD.restaurant_id; END",
+]
+
+# Full-text search index, one row per restaurant (rowid = restaurant_id). The prefix indexes make
+# the prefix queries of type-ahead search ("lun*") as fast as whole-word queries.
+SEARCH_TABLE_SQL = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS RestaurantSearch USING fts5(
+        restaurant_name, cuisine_name, location_name, street_address,
+        tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+    )
+"""
+
+# The search row of a restaurant, from its new values (NEW.*). The restaurant's cuisines are usually
+# linked after it's inserted: until then, its cuisine is the primary one.
+SEARCH_ROW_SQL = f"""
+    INSERT INTO RestaurantSearch (rowid, restaurant_name, cuisine_name, location_name, street_address)
+    VALUES (
+        NEW.restaurant_id, NEW.restaurant_name,
+        COALESCE(
+            {CUISINES_SQL.format(restaurant_id="NEW.restaurant_id")},
+            (SELECT cuisine_name FROM Cuisine WHERE cuisine_id = NEW.cuisine_id)
+        ),
+        (SELECT location_name FROM Location WHERE location_id = NEW.location_id),
+        NEW.street_address
+    );
+"""
+
+# The search row's cuisines, after a restaurant's cuisines changed ({restaurant_id}: NEW / OLD.restaurant_id)
+SEARCH_CUISINES_SQL = f"""
+    UPDATE RestaurantSearch SET cuisine_name = {CUISINES_SQL} WHERE rowid = {{restaurant_id}};
+"""
+
+# Keep the search index in sync with every write to Restaurant and RestaurantCuisine (insert_into_database,
+# upsert_into_database ...; bulk_insert_into_database fills it once per load instead, see deferred_search_index())
+SEARCH_INSERT_TRIGGERS_SQL = {
+    "restaurant_search_insert": "CREATE TRIGGER IF NOT EXISTS restaurant_search_insert "
+    f"AFTER INSERT ON Restaurant BEGIN {SEARCH_ROW_SQL} END",
+    "restaurant_cuisine_search_insert": "CREATE TRIGGER IF NOT EXISTS restaurant_cuisine_search_insert "
+    "AFTER INSERT ON RestaurantCuisine BEGIN "
+    f"{SEARCH_CUISINES_SQL.format(restaurant_id='NEW.restaurant_id')} END",
+}
+SEARCH_TRIGGERS_SQL = list(SEARCH_INSERT_TRIGGERS_SQL.values()) + [
+    "CREATE TRIGGER IF NOT EXISTS restaurant_search_delete AFTER DELETE ON Restaurant BEGIN "
+    "DELETE FROM RestaurantSearch WHERE rowid = OLD.restaurant_id; END",
+    "CREATE TRIGGER IF NOT EXISTS restaurant_search_update "
+    "AFTER UPDATE OF restaurant_name, cuisine_id, location_id, street_address ON Restaurant BEGIN "
+    f"DELETE FROM RestaurantSearch WHERE rowid = OLD.restaurant_id; {SEARCH_ROW_SQL} END",
+    "CREATE TRIGGER IF NOT EXISTS restaurant_cuisine_search_delete AFTER DELETE ON RestaurantCuisine BEGIN "
+    f"{SEARCH_CUISINES_SQL.format(restaurant_id='OLD.restaurant_id')} END",
+]
+
+# Relative weight of the columns in the ranking (a match in the name counts most)
+SEARCH_WEIGHTS = (10.0, 4.0, 2.0, 1.0)
+
+# Geocoding results by address (latitude / longitude NULL: the address wasn't found, it's not looked up again)
+GEOCODE_CACHE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS GeocodeCache (
+        address TEXT PRIMARY KEY,
+        latitude REAL,
+        longitude REAL,
+        source TEXT,
+        geocoded_at REAL
+    )
+"""
+
+# Spatial index of the geocoded restaurants (R*Tree: a radius query only reads the entries of its bounding box).
+# A restaurant is a point: min = max (the R*Tree stores 32-bit floats, rounded outwards: within a meter).
+GEO_TABLE_SQL = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS RestaurantGeo USING rtree(
+        restaurant_id, min_latitude, max_latitude, min_longitude, max_longitude
+    )
+"""
+
+# A restaurant whose address changed (or that was deleted) leaves the spatial index, to be geocoded again
+GEO_TRIGGERS_SQL = [
+    "CREATE TRIGGER IF NOT EXISTS restaurant_geo_update AFTER UPDATE OF street_address ON Restaurant "
+    "WHEN NEW.street_address IS NOT OLD.street_address BEGIN "
+    "DELETE FROM RestaurantGeo WHERE restaurant_id = OLD.restaurant_id; END",
+    "CREATE TRIGGER IF NOT EXISTS restaurant_geo_delete AFTER DELETE ON Restaurant BEGIN "
+    "DELETE FROM RestaurantGeo WHERE restaurant_id = OLD.restaurant_id; END",
+]
+
+# Mean radius of the Earth (km), for the great-circle distances
+EARTH_RADIUS_KM = 6371.0088
+
+# Radius (km) of the first search of nearest_restaurants(), doubled until there are enough restaurants in it
+NEAREST_START_RADIUS_KM = 2.0
+
+# Default number of restaurants of nearest_restaurants()
+NEAREST_COUNT = 20
+
+# A place typed as coordinates: "37.33, -121.89"
+COORDINATES_PATTERN = re.compile(r"^\s*([-+]?\d+(?:\.\d*)?)\s*[,\s]\s*([-+]?\d+(?:\.\d*)?)\s*$")
+
+# Catalog snapshots: directory, pointer file (name of the current snapshot), number of snapshots kept
+SNAPSHOT_DIRECTORY = "snapshots"
+SNAPSHOT_POINTER = "CURRENT"
+SNAPSHOT_KEEP = 3
+
+# Memory-mapped size of a snapshot (bytes): its pages are read from the OS page cache without copies
+SNAPSHOT_MMAP_SIZE = 256 * 1024 * 1024
+
+# Back end tables left out of the snapshots (the crawl journal, the geocoding cache)
+SNAPSHOT_EXCLUDED_TABLES = ["CrawlJournal", "GeocodeCache"]
+
+# Precomputed listings of a snapshot: every city's / cuisine's listed restaurants with their position in the
+# listing (sorted by name, case-insensitively, then id), so a page at any offset and a count are index seeks
+LISTING_ENTRY_TABLE_SQL = """
+    CREATE TABLE ListingEntry (
+        listing TEXT NOT NULL,
+        listing_id INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        restaurant_id INTEGER NOT NULL,
+        restaurant_name TEXT,
+        PRIMARY KEY (listing, listing_id, position)
+    ) WITHOUT ROWID
+"""
+LISTING_ENTRY_INDEX_SQL = (
+    "CREATE INDEX idx_listing_entry_names ON ListingEntry (listing, listing_id, restaurant_name COLLATE NOCASE)"
+)
+
+# Seconds a read waits for a writer's lock before failing (only needed if the database isn't in WAL mode)
+BUSY_TIMEOUT = 30
+
+
+def open_read_only(filename, check_same_thread=True):
+    """
+    Open the database read-only: the connection can never write (or create the file if it's missing).
+    In WAL mode, a reader isn't blocked by the back end writing a scrape to the same file.
+
+    PARAM: filename (str) - the database file
+    PARAM: check_same_thread (bool) - passed to sqlite3.connect()
+    RETURN: the connection
+    RAISES: sqlite3.OperationalError if the file can't be opened
+    """
+    return sqlite3.connect(
+        f"file:{pathname2url(filename)}?mode=ro", uri=True, timeout=BUSY_TIMEOUT, check_same_thread=check_same_thread
+    )
+
+
+def open_snapshot(filename, check_same_thread=True):
+    """
+    Open a catalog snapshot: read-only and immutable (SQLite takes no locks and never checks the file for
+    changes: it's never written after it's published), and memory-mapped.
+
+    PARAM: filename (str) - the snapshot file
+    PARAM: check_same_thread (bool) - passed to sqlite3.connect()
+    RETURN: the connection
+    RAISES: sqlite3.OperationalError if the file can't be opened
+    """
+    conn = sqlite3.connect(
+        f"file:{pathname2url(filename)}?mode=ro&immutable=1", uri=True, check_same_thread=check_same_thread
+    )
+    conn.execute(f"PRAGMA mmap_size = {SNAPSHOT_MMAP_SIZE}")
+    return conn
+
+
+def current_snapshot(directory=SNAPSHOT_DIRECTORY):
+    """
+    PARAM: directory (str) - the snapshot directory
+    RETURN: the file of the current snapshot (str), or None if none was published
+    """
+    try:
+        with open(os.path.join(directory, SNAPSHOT_POINTER), "r", encoding="utf-8") as file:
+            name = file.read().strip()
+    except FileNotFoundError:
+        return None
+    filename = os.path.join(directory, name)
+    return filename if name and os.path.exists(filename) else None
+
+
+def _snapshot_version(filename):
+    # catalog-000042.db -> 42
+    return int(os.path.basename(filename).split("-")[1].split(".")[0])
+
+
+def build_listings(conn):
+    """
+    Fill the precomputed listings (ListingEntry) of a snapshot, from the listing tables
+
+    PARAM: conn - the snapshot's connection (read-write, before it's published)
+    """
+    conn.execute(LISTING_ENTRY_TABLE_SQL)
+    for listing, (table, column) in LISTING_TABLES.items():
+        conn.execute(
+            "INSERT INTO ListingEntry (listing, listing_id, position, restaurant_id, restaurant_name) "
+            f"SELECT ?, {column}, row_number() OVER ("
+            f"PARTITION BY {column} ORDER BY restaurant_name COLLATE NOCASE, restaurant_id) - 1, "
+            f"restaurant_id, restaurant_name FROM {table} WHERE delisted = 0",
+            (listing,),
+        )
+    conn.execute(LISTING_ENTRY_INDEX_SQL)
+
+
+def publish_snapshot(conn, directory=SNAPSHOT_DIRECTORY, keep=SNAPSHOT_KEEP):
+    """
+    Publish a catalog snapshot of the database, for the GUI:
+
+        - VACUUM INTO a new file (a consistent, compact copy, made while other connections can still read)
+        - without the back end's tables, with the precomputed listings (build_listings())
+        - published atomically: the file gets its final name, then the pointer file is replaced
+          (a reader sees the old snapshot or the new one, never a partial one)
+        - versioned (catalog-<version>.db), the keep last snapshots are kept
+
+    PARAM: conn - the database connection
+    PARAM: directory (str) - the snapshot directory (created if needed)
+    PARAM: keep (int) - number of snapshots kept
+    RETURN: the new snapshot file (str)
+    """
+    os.makedirs(directory, exist_ok=True)
+    current = current_snapshot(directory)
+    version = _snapshot_version(current) + 1 if current else 1
+    filename = os.path.join(directory, f"catalog-{version:06d}.db")
+    temporary = filename + ".tmp"
+    if os.path.exists(temporary):
+        os.remove(temporary)  # (left by a failed publish)
+
+    conn.commit()
+    conn.execute("VACUUM INTO ?", (temporary,))
+    snapshot = sqlite3.connect(temporary)
+    try:
+        for table in SNAPSHOT_EXCLUDED_TABLES:
+            snapshot.execute(f"DROP TABLE IF EXISTS {table}")
+        build_listings(snapshot)
+        snapshot.commit()
+        snapshot.execute("PRAGMA journal_mode = DELETE")  # (no -wal file next to a read-only snapshot)
+        snapshot.execute("VACUUM")
+    finally:
+        snapshot.close()
+
+    os.replace(temporary, filename)
+    pointer = os.path.join(directory, SNAPSHOT_POINTER)
+    with open(pointer + ".tmp", "w", encoding="utf-8") as file:
+        file.write(os.path.basename(filename))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(pointer + ".tmp", pointer)
+
+    # Remove the old snapshots (one still open by a reader stays readable until it's closed, on POSIX)
+    for name in os.listdir(directory):
+        if name.startswith("catalog-") and name.endswith(".db") and _snapshot_version(name) <= version - keep:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass  # (e.g. open by a reader, on Windows: removed by a later publish)
+    return filename
+
+
+def _first_position(conn, listing, listing_id, name, end):
+    """
+    RETURN: the position of the first restaurant of a precomputed listing with a name from name (NOCASE),
+        or end if there's none
+    """
+    row = conn.execute(
+        "SELECT position FROM ListingEntry WHERE listing = ? AND listing_id = ? "
+        "AND restaurant_name COLLATE NOCASE >= ? ORDER BY restaurant_name COLLATE NOCASE, position LIMIT 1",
+        (listing, listing_id, name),
+    ).fetchone()
+    return row[0] if row else end
+
+
+def snapshot_listing_range(conn, listing, listing_id, prefix=""):
+    """
+    PARAM: conn - a snapshot's connection
+    PARAM: listing (str) - "location" or "cuisine"
+    PARAM: listing_id (int) - the city's / cuisine's id
+    PARAM: prefix (str) - only the names starting with it (case-insensitive)
+    RETURN: (start, end) positions of the restaurants of the precomputed listing (two or three index seeks)
+    """
+    row = conn.execute(
+        "SELECT position + 1 FROM ListingEntry WHERE listing = ? AND listing_id = ? ORDER BY position DESC LIMIT 1",
+        (listing, listing_id),
+    ).fetchone()
+    if row is None:
+        return 0, 0
+    end = row[0]
+    if not prefix:
+        return 0, end
+    low, high = prefix_range(prefix)
+    return _first_position(conn, listing, listing_id, low, end), _first_position(conn, listing, listing_id, high, end)
+
+
+def snapshot_listing_page(conn, listing, listing_id, prefix="", offset=0, limit=PAGE_SIZE):
+    """
+    One page of a precomputed listing: a seek to the position, at any offset
+
+    RETURN: list of (restaurant_id, restaurant_name), sorted by name (case-insensitive) then id
+    """
+    start, end = snapshot_listing_range(conn, listing, listing_id, prefix)
+    return conn.execute(
+        "SELECT restaurant_id, restaurant_name FROM ListingEntry WHERE listing = ? AND listing_id = ? "
+        "AND position >= ? AND position < ? ORDER BY position LIMIT ?",
+        (listing, listing_id, start + offset, end, limit),
+    ).fetchall()
+
+
+def cost_level(cost_symbol):
+    """
+    PARAM: cost_symbol (str) - the cost of a directory card, e.g. "$$" or "€€€"
+    RETURN: the number of cost symbols (int), or None if it's not a cost (e.g. "N/A")
+    """
+    if cost_symbol and len(set(cost_symbol)) == 1 and not cost_symbol.isalnum():
+        return len(cost_symbol)
+    return None
+
+
+def split_cuisines(cuisine_name):
+    """
+    PARAM: cuisine_name (str) - the cuisine of a directory card, e.g. "Japanese, Sushi"
+    RETURN: list of the cuisines (str), primary cuisine first, without duplicates
+    """
+    cuisines = [cuisine.strip() for cuisine in cuisine_name.split(NAME_SEPARATOR.strip())]
+    return list(dict.fromkeys(cuisine for cuisine in cuisines if cuisine)) or [cuisine_name]
+
+
+def split_location(location_name):
+    """
+    PARAM: location_name (str) - the location of a directory card, e.g. "San Jose, USA"
+    RETURN: (city, country), country is None if the location has no country
+    """
+    city, separator, country = location_name.rpartition(NAME_SEPARATOR)
+    if not separator:
+        return location_name, None
+    return city, country
+
+
+def normalize_locations(conn):
+    """
+    Fill the city and country of the locations that don't have them yet (the new ones):
+    the back end calls it after inserting restaurants, before committing.
+
+    PARAM: conn - the database connection
+    """
+    locations = conn.execute("SELECT location_id, location_name FROM Location WHERE city_name IS NULL").fetchall()
+    if not locations:
+        return
+
+    split = [(location_id, *split_location(location_name)) for location_id, location_name in locations]
+    countries = {country for _, _, country in split if country is not None}
+    conn.executemany("INSERT OR IGNORE INTO Country (country_name) VALUES (?)", [(name,) for name in countries])
+    country_ids = dict(conn.execute("SELECT country_name, country_id FROM Country"))
+    conn.executemany(
+        "UPDATE Location SET city_name = ?, country_id = ? WHERE location_id = ?",
+        [(city, country_ids.get(country), location_id) for location_id, city, country in split],
+    )
+
+
+def link_cuisines(conn, links):
+    """
+    Link restaurants to their cuisines, with the restaurants' current listing columns
+
+    PARAM: conn - the database connection
+    PARAM: links - iterable of (restaurant_url, cuisine_id, position), position 0 for the primary cuisine
+    """
+    conn.executemany(
+        "INSERT OR IGNORE INTO RestaurantCuisine "
+        "(restaurant_id, cuisine_id, position, restaurant_name, delisted, cost_level) "
+        "SELECT restaurant_id, ?, ?, restaurant_name, delisted, cost_level FROM Restaurant WHERE restaurant_url = ?",
+        [(cuisine_id, position, restaurant_url) for restaurant_url, cuisine_id, position in links],
+    )
+
+
+def _add_column(conn, table, column, definition):
+    """
+    ALTER TABLE ... ADD COLUMN, unless the table already has the column
+    """
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def _migrate_v1(conn):
+    """
+    Schema v1: the "delisted" column of the back end's incremental mode
+    """
+    _add_column(conn, "Restaurant", "delisted", "INTEGER NOT NULL DEFAULT 0")
+
+
+def _migrate_v2(conn):
+    """
+    Schema v2, query-optimized:
+        - Restaurant.cost_level: the number of cost symbols ("$$" -> 2), so a cost range is an index range
+        - Location.city_name and Location.country_id (Country table): "San Jose, USA" split in city and country
+        - RestaurantCuisine: every cuisine of a restaurant ("Japanese, Sushi" is split in Japanese and Sushi)
+        - the composite indexes of the listings and filters, and the search index with every cuisine
+    """
+    # The indexes and triggers of earlier versions are replaced
+    for index in ("idx_location_listing", "idx_cuisine_listing", "idx_location_names", "idx_cuisine_names"):
+        conn.execute(f"DROP INDEX IF EXISTS {index}")
+    for trigger in ("restaurant_search_insert", "restaurant_search_delete", "restaurant_search_update"):
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    conn.execute("DROP TABLE IF EXISTS RestaurantSearch")
+
+    conn.execute(COUNTRY_TABLE_SQL)
+    conn.execute(RESTAURANT_CUISINE_TABLE_SQL)
+    _add_column(conn, "Restaurant", "cost_level", "INTEGER")
+    _add_column(conn, "Location", "city_name", "TEXT")
+    _add_column(conn, "Location", "country_id", "INTEGER REFERENCES Country (country_id)")
+
+    # Cost levels and cities / countries of the existing rows
+    conn.executemany(
+        "UPDATE Restaurant SET cost_level = ? WHERE cost_id = ?",
+        [(cost_level(symbol), cost_id) for cost_id, symbol in conn.execute("SELECT cost_id, cost_symbol FROM Cost")],
+    )
+    normalize_locations(conn)
+
+    # Every restaurant is linked to its cuisine, then the combined cuisines are replaced by their parts
+    conn.execute(
+        "INSERT OR IGNORE INTO RestaurantCuisine "
+        "(restaurant_id, cuisine_id, position, restaurant_name, delisted, cost_level) "
+        "SELECT restaurant_id, cuisine_id, 0, restaurant_name, delisted, cost_level FROM Restaurant"
+    )
+    combined = [
+        (cuisine_id, split_cuisines(name))
+        for cuisine_id, name in conn.execute("SELECT cuisine_id, cuisine_name FROM Cuisine").fetchall()
+        if name and split_cuisines(name) != [name]
+    ]
+    for cuisine_id, names in combined:
+        conn.executemany("INSERT OR IGNORE INTO Cuisine (cuisine_name) VALUES (?)", [(name,) for name in names])
+        part_ids = [
+            conn.execute("SELECT cuisine_id FROM Cuisine WHERE cuisine_name = ?", (name,)).fetchone()[0]
+            for name in names
+        ]
+        for position, part_id in enumerate(part_ids):
+            conn.execute(
+                "INSERT OR IGNORE INTO RestaurantCuisine "
+                "(restaurant_id, cuisine_id, position, restaurant_name, delisted, cost_level) "
+                "SELECT restaurant_id, ?, ?, restaurant_name, delisted, cost_level "
+                "FROM Restaurant WHERE cuisine_id = ?",
+                (part_id, position, cuisine_id),
+            )
+        conn.execute("DELETE FROM RestaurantCuisine WHERE cuisine_id = ?", (cuisine_id,))
+        conn.execute("UPDATE Restaurant SET cuisine_id = ? WHERE cuisine_id = ?", (part_ids[0], cuisine_id))
+        conn.execute("DELETE FROM Cuisine WHERE cuisine_id = ?", (cuisine_id,))
+
+    for sql in LISTING_INDEXES_SQL + LISTING_TRIGGERS_SQL:
+        conn.execute(sql)
+
+    conn.execute(SEARCH_TABLE_SQL)
+    index_restaurants(conn)
+    for trigger_sql in SEARCH_TRIGGERS_SQL:
+        conn.execute(trigger_sql)
+
+
+def _migrate_v3(conn):
+    """
+    Schema v3: the geocoding cache (GeocodeCache) and the spatial index of the restaurants (RestaurantGeo),
+    filled by the back end's geocoding stage
+    """
+    conn.execute(GEOCODE_CACHE_TABLE_SQL)
+    conn.execute(GEO_TABLE_SQL)
+    for trigger_sql in GEO_TRIGGERS_SQL:
+        conn.execute(trigger_sql)
+
+
+# Schema version -> the function that migrates the previous version to it
+MIGRATIONS = {1: _migrate_v1, 2: _migrate_v2, 3: _migrate_v3}
+
+
+def schema_version(conn):
+    """
+    PARAM: conn - the database connection (read-only is enough)
+    RETURN: the schema version of the database (int, 0 if it was never migrated)
+    """
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    """
+    Bring the database's schema up to SCHEMA_VERSION: every missing migration runs in its own transaction,
+    and the version is stored in the file (PRAGMA user_version), so a migration only runs once.
+
+    PARAM: conn - the database connection (read-write)
+    RETURN: the schema version before the migrations (int)
+    """
+    version = schema_version(conn)
+    for number in range(version + 1, SCHEMA_VERSION + 1):
+        conn.commit()
+        conn.execute("BEGIN")
+        try:
+            MIGRATIONS[number](conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return version
+
+
+def rebuild_search_index(conn):
+    """
+    Refill the search table from Restaurant, Cuisine and Location
+    (e.g. after renaming a cuisine or city: the triggers only follow the Restaurant and RestaurantCuisine tables)
+
+    PARAM: conn - the database connection
+    """
+    conn.execute("DELETE FROM RestaurantSearch")
+    index_restaurants(conn)
+    conn.commit()
+
+
+def index_restaurants(conn, after_id=0):
+    """
+    Add the restaurants with an id greater than after_id to the search table, with one INSERT ... SELECT
+
+    PARAM: conn - the database connection
+    PARAM: after_id (int) - the restaurants already indexed have an id up to after_id
+    """
+    conn.execute(
+        "INSERT INTO RestaurantSearch (rowid, restaurant_name, cuisine_name, location_name, street_address) "
+        "SELECT R.restaurant_id, R.restaurant_name, "
+        f"COALESCE({CUISINES_SQL.format(restaurant_id='R.restaurant_id')}, C.cuisine_name), "
+        "L.location_name, R.street_address "
+        "FROM Restaurant R "
+        "LEFT JOIN Cuisine C ON R.cuisine_id = C.cuisine_id "
+        "LEFT JOIN Location L ON R.location_id = L.location_id "
+        "WHERE R.restaurant_id > ?",
+        (after_id,),
+    )
+
+
+@contextmanager
+def deferred_search_index(conn):
+    """
+    For a bulk load in a transaction: the insert triggers are dropped for the load, and the new restaurants
+    are added to the search table at the end with one INSERT ... SELECT (3x faster than triggers per row).
+    New restaurants get ids greater than the current max id (restaurant_id is the rowid).
+    If the load fails, the transaction's rollback restores the triggers.
+
+    PARAM: conn - the database connection, in a transaction
+    """
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'restaurant_search_insert'").fetchone():
+        yield  # no search index
+        return
+
+    last_id = conn.execute("SELECT COALESCE(MAX(restaurant_id), 0) FROM Restaurant").fetchone()[0]
+    for trigger in SEARCH_INSERT_TRIGGERS_SQL:
+        conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    yield
+    index_restaurants(conn, last_id)
+    for trigger_sql in SEARCH_INSERT_TRIGGERS_SQL.values():
+        conn.execute(trigger_sql)
+
+
+def ensure_schema(conn):
+    """
+    Make an older database usable by these queries: migrate it to the current schema (see migrate()),
+    and switch it to WAL.
+
+    PARAM: conn - the database connection (read-write)
+    """
+    migrate(conn)
+    # WAL (persistent in the file): readers and the writer don't block each other
+    conn.execute("PRAGMA journal_mode = WAL")
+
+
+def get_restaurant(conn, restaurant_id):
+    """
+    PARAM: conn - the database connection
+    PARAM: restaurant_id (int) - the restaurant's id
+    RETURN: the DecodedRestaurant, or None if there's no restaurant with this id
+    """
+    row = conn.execute(DECODED_RESTAURANT_QUERY + " WHERE R.restaurant_id = ?", (restaurant_id,)).fetchone()
+    return DecodedRestaurant(*row) if row else None
+
+
+def get_restaurants(conn, restaurant_ids):
+    """
+    Batch lookup: one query per BATCH_SIZE ids, instead of queries per restaurant
+
+    PARAM: conn - the database connection
+    PARAM: restaurant_ids (list of int) - the ids
+    RETURN: list of DecodedRestaurant, in the order of restaurant_ids (unknown ids are skipped)
+    """
+    restaurant_ids = list(restaurant_ids)
+    found = {}
+    for start in range(0, len(restaurant_ids), BATCH_SIZE):
+        batch = restaurant_ids[start : start + BATCH_SIZE]
+        placeholders = ", ".join("?" * len(batch))
+        for row in conn.execute(DECODED_RESTAURANT_QUERY + f" WHERE R.restaurant_id IN ({placeholders})", batch):
+            found[row[0]] = DecodedRestaurant(*row)
+
+    return [found[restaurant_id] for restaurant_id in restaurant_ids if restaurant_id in found]
+
+
+def get_locations(conn):
+    """
+    PARAM: conn - the database connection
+    RETURN: list of (location_id, location_name), sorted by name
+        (read in order from the index of the UNIQUE location_name)
+    """
+    return conn.execute("SELECT location_id, location_name FROM Location ORDER BY location_name").fetchall()
+
+
+def get_cuisines(conn):
+    """
+    PARAM: conn - the database connection
+    RETURN: list of (cuisine_id, cuisine_name), sorted by name
+        (read in order from the index of the UNIQUE cuisine_name)
+    """
+    return conn.execute("SELECT cuisine_id, cuisine_name FROM Cuisine ORDER BY cuisine_name").fetchall()
+
+
+def iter_restaurants(conn):
+    """
+    YIELDS: every listed restaurant (DecodedRestaurant), sorted by id
+    """
+    for row in conn.execute(DECODED_RESTAURANT_QUERY + " WHERE R.delisted = 0 ORDER BY R.restaurant_id"):
+        yield DecodedRestaurant(*row)
+
+
+def prefix_range(prefix):
+    """
+    The range of the names starting with prefix, case-insensitively: low <= name < high (with COLLATE NOCASE).
+    (NOCASE only folds the ASCII letters, to lowercase)
+
+    PARAM: prefix (str) - not empty
+    RETURN: (low, high)
+    """
+    low = "".join(char.lower() if char.isascii() else char for char in prefix)
+    return low, low[:-1] + chr(ord(low[-1]) + 1)
+
+
+def _listing_filter(listing, listing_id, prefix, max_cost_level=None, after_name=None):
+    """
+    RETURN: (the table, the WHERE clause, its parameters) of the listed restaurants of a city / cuisine, starting
+        with prefix, up to a cost level, and with names from after_name (then the index seeks to after_name,
+        instead of the start of the prefix)
+    """
+    table, column = LISTING_TABLES[listing]
+    where = f"WHERE {column} = ? AND delisted = 0"
+    params = [listing_id]
+    low, high = prefix_range(prefix) if prefix else (None, None)
+    if after_name is not None:
+        # (the rows of a page come after the previous page's rows, which all start with the prefix)
+        low = after_name
+    if low is not None:
+        where += " AND restaurant_name COLLATE NOCASE >= ?"
+        params.append(low)
+    if high is not None:
+        where += " AND restaurant_name COLLATE NOCASE < ?"
+        params.append(high)
+    if max_cost_level is not None:
+        # (the cost level is the last column of the listing indexes: checked in the index entries)
+        where += " AND cost_level <= ?"
+        params.append(max_cost_level)
+    return table, where, params
+
+
+def listing_count(conn, listing, listing_id, prefix="", max_cost_level=None):
+    """
+    PARAM: conn - the database connection
+    PARAM: listing (str) - "location" or "cuisine"
+    PARAM: listing_id (int) - the city's / cuisine's id
+    PARAM: prefix (str) - only count the names starting with it (case-insensitive)
+    PARAM: max_cost_level (int) - only count the restaurants up to this cost level, or None
+    RETURN: the number of restaurants of the listing (counted in the covering index)
+    """
+    table, where, params = _listing_filter(listing, listing_id, prefix, max_cost_level)
+    return conn.execute(f"SELECT count(*) FROM {table} {where}", params).fetchone()[0]
+
+
+def listing_page(conn, listing, listing_id, prefix="", after=None, offset=0, limit=PAGE_SIZE, max_cost_level=None):
+    """
+    One page of a listing, sorted by name (case-insensitive) then id, read from the covering index.
+
+        - after: keyset pagination, the page starts after this (restaurant_id, restaurant_name) row:
+          it's a seek in the index, and stays correct if rows are added or removed before it
+        - otherwise offset rows are skipped (to jump to any position, the skipped rows are read from the index)
+
+    PARAM: conn - the database connection
+    PARAM: listing (str) - "location" or "cuisine"
+    PARAM: listing_id (int) - the city's / cuisine's id
+    PARAM: prefix (str) - only the names starting with it (case-insensitive)
+    PARAM: after (tuple) - the last (restaurant_id, restaurant_name) row of the previous page, or None
+    PARAM: offset (int) - number of rows to skip (if after is None)
+    PARAM: limit (int) - max number of rows
+    PARAM: max_cost_level (int) - only the restaurants up to this cost level, or None
+    RETURN: list of (restaurant_id, restaurant_name)
+    """
+    table, where, params = _listing_filter(
+        listing, listing_id, prefix, max_cost_level, after[1] if after is not None else None
+    )
+    if after is not None:
+        # Skip the rows with the same name up to the previous page's last id
+        where += " AND (restaurant_name COLLATE NOCASE, restaurant_id) > (?, ?)"
+        params.extend((after[1], after[0]))
+        offset = 0
+    return conn.execute(
+        f"SELECT restaurant_id, restaurant_name FROM {table} {where} "
+        "ORDER BY restaurant_name COLLATE NOCASE, restaurant_id LIMIT ? OFFSET ?",
+        params + [limit, offset],
+    ).fetchall()
+
+
+def get_cost_levels(conn):
+    """
+    PARAM: conn - the database connection
+    RETURN: list of (cost_level, cost_symbol), from the cheapest (one symbol per level, of the costs that have one)
+    """
+    levels = {}
+    for (symbol,) in conn.execute("SELECT cost_symbol FROM Cost ORDER BY cost_symbol"):
+        level = cost_level(symbol)
+        if level is not None:
+            levels.setdefault(level, symbol)
+    return sorted(levels.items())
+
+
+def get_countries(conn):
+    """
+    PARAM: conn - the database connection
+    RETURN: list of (country_id, country_name), sorted by name
+    """
+    return conn.execute("SELECT country_id, country_name FROM Country ORDER BY country_name").fetchall()
+
+
+def _restaurant_filter(country_id=None, cuisine_id=None, max_cost_level=None):
+    """
+    RETURN: (the table, the WHERE clause, its parameters) of the listed restaurants (R) of a country,
+        with a cuisine and up to a cost level (None: any)
+    """
+    if cuisine_id is not None:
+        # The cuisine's range of idx_cuisine_names, in name order (a query with a LIMIT stops early)
+        table, where, params = "RestaurantCuisine", "WHERE R.cuisine_id = ? AND R.delisted = 0", [cuisine_id]
+        location = "(SELECT location_id FROM Restaurant WHERE restaurant_id = R.restaurant_id)"
+    else:
+        table, where, params = "Restaurant", "WHERE R.delisted = 0", []
+        location = "R.location_id"
+    if country_id is not None:
+        # (the country's cities, then each city's range of idx_location_names)
+        where += f" AND {location} IN (SELECT location_id FROM Location WHERE country_id = ?)"
+        params.append(country_id)
+    if max_cost_level is not None:
+        where += " AND R.cost_level <= ?"
+        params.append(max_cost_level)
+    return table, where, params
+
+
+def filter_count(conn, country_id=None, cuisine_id=None, max_cost_level=None):
+    """
+    PARAM: conn - the database connection
+    PARAM: country_id (int) - only the restaurants of this country, or None
+    PARAM: cuisine_id (int) - only the restaurants with this cuisine, or None
+    PARAM: max_cost_level (int) - only the restaurants up to this cost level, or None
+    RETURN: the number of listed restaurants that match every filter
+    """
+    table, where, params = _restaurant_filter(country_id, cuisine_id, max_cost_level)
+    return conn.execute(f"SELECT count(*) FROM {table} R {where}", params).fetchone()[0]
+
+
+def filter_restaurants(conn, country_id=None, cuisine_id=None, max_cost_level=None, limit=PAGE_SIZE):
+    """
+    The listed restaurants that match every filter, e.g. the Japanese restaurants of the USA up to $$
+
+    PARAM: conn - the database connection
+    PARAM: country_id (int) - only the restaurants of this country, or None
+    PARAM: cuisine_id (int) - only the restaurants with this cuisine, or None
+    PARAM: max_cost_level (int) - only the restaurants up to this cost level, or None
+    PARAM: limit (int) - max number of rows (-1: no limit)
+    RETURN: list of (restaurant_id, restaurant_name), sorted by name (case-insensitive) then id
+    """
+    table, where, params = _restaurant_filter(country_id, cuisine_id, max_cost_level)
+    return conn.execute(
+        f"SELECT R.restaurant_id, R.restaurant_name FROM {table} R {where} "
+        "ORDER BY R.restaurant_name COLLATE NOCASE, R.restaurant_id LIMIT ?",
+        params + [limit],
+    ).fetchall()
+
+
+def search_query(text):
+    """
+    The FTS5 query of what the user typed: every word must match, as a word prefix
+    (the words are quoted, so the FTS5 operators and punctuation in the text are just text)
+
+    PARAM: text (str) - the search text
+    RETURN: the query (str), or "" if the text has no words
+    """
+    words = text.replace('"', " ").split()
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def search_restaurants(conn, text, limit=SEARCH_LIMIT):
+    """
+    Full-text search of the listed restaurants, by name, cuisine, city and address, best matches first
+    (in id order if there are more than SEARCH_RANK_LIMIT matches, e.g. a search for one common letter)
+
+    PARAM: conn - the database connection
+    PARAM: text (str) - the search text, e.g. "lun mex" finds "Luna Mexican Kitchen"
+    PARAM: limit (int) - max number of results
+    RETURN: list of (restaurant_id, restaurant_name, cuisine_name, location_name)
+    """
+    query = search_query(text)
+    if not query:
+        return []
+
+    # (counting the matches only reads the index)
+    matches = conn.execute(
+        "SELECT count(*) FROM RestaurantSearch WHERE RestaurantSearch MATCH ?", (query,)
+    ).fetchone()[0]
+    if matches > SEARCH_RANK_LIMIT:
+        order = "S.rowid"
+    else:
+        # (ties broken by id, so the same search always gives the same order)
+        order = f"bm25(RestaurantSearch, {', '.join(map(str, SEARCH_WEIGHTS))}), S.rowid"
+    return conn.execute(
+        "SELECT S.rowid, S.restaurant_name, S.cuisine_name, S.location_name "
+        "FROM RestaurantSearch S JOIN Restaurant R ON R.restaurant_id = S.rowid "
+        f"WHERE RestaurantSearch MATCH ? AND R.delisted = 0 ORDER BY {order} LIMIT ?",
+        (query, limit),
+    ).fetchall()
+
+
+def restaurants_in_location(conn, location_id):
+    """
+    PARAM: conn - the database connection
+    PARAM: location_id (int) - the city's id
+    RETURN: list of (restaurant_id, restaurant_name) of the listed restaurants of the city, sorted by name
+        (read from the idx_location_names covering index)
+    """
+    return listing_page(conn, "location", location_id, limit=-1)
+
+
+def restaurants_with_cuisine(conn, cuisine_id):
+    """
+    PARAM: conn - the database connection
+    PARAM: cuisine_id (int) - the cuisine's id
+    RETURN: list of (restaurant_id, restaurant_name) of the listed restaurants of the cuisine, sorted by name
+        (read from the idx_cuisine_names covering index of RestaurantCuisine)
+    """
+    return listing_page(conn, "cuisine", cuisine_id, limit=-1)
+
+
+def haversine_km(latitude1, longitude1, latitude2, longitude2):
+    """
+    RETURN: the great-circle distance (km) between two points (degrees)
+    """
+    latitude1, longitude1, latitude2, longitude2 = map(math.radians, (latitude1, longitude1, latitude2, longitude2))
+    a = (
+        math.sin((latitude2 - latitude1) / 2) ** 2
+        + math.cos(latitude1) * math.cos(latitude2) * math.sin((longitude2 - longitude1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(latitude, longitude, radius_km):
+    """
+    RETURN: (min_latitude, max_latitude, min_longitude, max_longitude) of a box that contains the circle
+        (every longitude if the circle reaches a pole or crosses the 180th meridian)
+    """
+    delta_latitude = math.degrees(radius_km / EARTH_RADIUS_KM)
+    min_latitude, max_latitude = latitude - delta_latitude, latitude + delta_latitude
+    if min_latitude <= -90 or max_latitude >= 90:
+        return max(min_latitude, -90.0), min(max_latitude, 90.0), -180.0, 180.0
+
+    # (the circle is widest, in longitude, at the latitude where it touches the box's meridians)
+    ratio = math.sin(radius_km / EARTH_RADIUS_KM) / math.cos(math.radians(latitude))
+    if ratio >= 1:
+        return min_latitude, max_latitude, -180.0, 180.0
+    delta_longitude = math.degrees(math.asin(ratio))
+    min_longitude, max_longitude = longitude - delta_longitude, longitude + delta_longitude
+    if min_longitude < -180 or max_longitude > 180:
+        return min_latitude, max_latitude, -180.0, 180.0
+    return min_latitude, max_latitude, min_longitude, max_longitude
+
+
+def restaurants_near(conn, latitude, longitude, radius_km, limit=SEARCH_LIMIT):
+    """
+    The listed restaurants within radius_km of a point, nearest first: the R*Tree gives the restaurants
+    of the circle's bounding box, their exact distance drops the ones outside the circle.
+
+    PARAM: conn - the database connection
+    PARAM: latitude, longitude (float) - the point (degrees)
+    PARAM: radius_km (float) - the radius
+    PARAM: limit (int) - max number of restaurants
+    RETURN: list of (restaurant_id, restaurant_name, distance in km)
+    """
+    # (an entry is in the box if its max is above the box's min and its min below the box's max)
+    rows = conn.execute(
+        "SELECT G.restaurant_id, R.restaurant_name, "
+        "(G.min_latitude + G.max_latitude) / 2, (G.min_longitude + G.max_longitude) / 2 "
+        "FROM RestaurantGeo G JOIN Restaurant R ON R.restaurant_id = G.restaurant_id "
+        "WHERE G.max_latitude >= ? AND G.min_latitude <= ? AND G.max_longitude >= ? AND G.min_longitude <= ? "
+        "AND R.delisted = 0",
+        bounding_box(latitude, longitude, radius_km),
+    )
+    near = []
+    for restaurant_id, name, point_latitude, point_longitude in rows:
+        distance = haversine_km(latitude, longitude, point_latitude, point_longitude)
+        if distance <= radius_km:
+            near.append((restaurant_id, name, distance))
+    near.sort(key=lambda row: (row[2], row[0]))
+    return near[:limit]
+
+
+def nearest_restaurants(conn, latitude, longitude, count=NEAREST_COUNT):
+    """
+    The count listed restaurants nearest to a point (k nearest neighbors): radius queries from
+    NEAREST_START_RADIUS_KM, doubled until the circle has count restaurants (then it has the nearest ones),
+    so a query only reads the R*Tree entries around the point.
+
+    PARAM: conn - the database connection
+    PARAM: latitude, longitude (float) - the point (degrees)
+    PARAM: count (int) - number of restaurants
+    RETURN: list of (restaurant_id, restaurant_name, distance in km), nearest first
+        (fewer than count if there aren't as many geocoded restaurants)
+    """
+    radius_km = NEAREST_START_RADIUS_KM
+    while True:
+        near = restaurants_near(conn, latitude, longitude, radius_km, count)
+        # (half the Earth's circumference: the circle covers the whole Earth)
+        if len(near) >= count or radius_km >= math.pi * EARTH_RADIUS_KM:
+            return near
+        radius_km *= 2
+
+
+def locate(conn, place):
+    """
+    The coordinates of a place typed by the user: "latitude, longitude", or a city
+    (the center of its geocoded restaurants)
+
+    PARAM: conn - the database connection
+    PARAM: place (str) - e.g. "37.33, -121.89" or "san jose"
+    RETURN: (latitude, longitude), or None if the place isn't known
+    """
+    match = COORDINATES_PATTERN.match(place)
+    if match:
+        latitude, longitude = float(match.group(1)), float(match.group(2))
+        if -90 <= latitude <= 90 and -180 <= longitude <= 180:
+            return latitude, longitude
+        return None
+
+    row = conn.execute(
+        "SELECT avg((G.min_latitude + G.max_latitude) / 2), avg((G.min_longitude + G.max_longitude) / 2) "
+        "FROM Location L JOIN Restaurant R ON R.location_id = L.location_id "
+        "JOIN RestaurantGeo G ON G.restaurant_id = R.restaurant_id "
+        "WHERE L.city_name = ? COLLATE NOCASE OR L.location_name = ? COLLATE NOCASE",
+        (place.strip(), place.strip()),
+    ).fetchone()
+    return row if row[0] is not None else None
+
+
+class QueryCache:
+    """
+    Read-through cache of the queries the GUI repeats: the lookup tables (cities, cuisines ...) are read once,
+    and the decoded restaurants are kept in a bounded LRU.
+
+    The cache is dropped when the database changes: "PRAGMA data_version" changes whenever another
+    connection (e.g. the back end re-scraping into the same file) commits, so the cache stays
+    correct after a re-scrape, and a check costs no disk read.
+
+    On a catalog snapshot, the listings without a cost filter are read from the precomputed listings.
+    """
+
+    def __init__(self, conn, max_restaurants=RESTAURANT_CACHE_SIZE):
+        """
+        PARAM: conn - the database connection
+        PARAM: max_restaurants (int) - max number of decoded restaurants kept
+        """
+        self.conn = conn
+        self.max_restaurants = max_restaurants
+        self._data_version = None
+        self._lookups = {}
+        self._restaurants = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.precomputed_listings = (
+            conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'ListingEntry'").fetchone() is not None
+        )
+
+    def _check_data_version(self):
+        """
+        Clear the cache if the database was changed by another connection since the last check
+        """
+        data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version != self._data_version:
+            self.clear()
+            self._data_version = data_version
+
+    def clear(self):
+        self._lookups.clear()
+        self._restaurants.clear()
+
+    def _lookup(self, name, query):
+        self._check_data_version()
+        if name in self._lookups:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self._lookups[name] = query(self.conn)
+        return self._lookups[name]
+
+    def get_locations(self):
+        """
+        RETURN: list of (location_id, location_name), sorted by name
+        """
+        return self._lookup("locations", get_locations)
+
+    def get_cuisines(self):
+        """
+        RETURN: list of (cuisine_id, cuisine_name), sorted by name
+        """
+        return self._lookup("cuisines", get_cuisines)
+
+    def get_cost_levels(self):
+        """
+        RETURN: list of (cost_level, cost_symbol), from the cheapest
+        """
+        return self._lookup("cost_levels", get_cost_levels)
+
+    def get_countries(self):
+        """
+        RETURN: list of (country_id, country_name), sorted by name
+        """
+        return self._lookup("countries", get_countries)
+
+    def listing_count(self, listing, listing_id, prefix="", max_cost_level=None):
+        """
+        RETURN: the number of restaurants of the listing (see listing_count())
+        """
+        if self.precomputed_listings and max_cost_level is None:
+            start, end = snapshot_listing_range(self.conn, listing, listing_id, prefix)
+            return end - start
+        return listing_count(self.conn, listing, listing_id, prefix, max_cost_level)
+
+    def listing_page(self, listing, listing_id, prefix="", after=None, offset=0, limit=PAGE_SIZE, max_cost_level=None):
+        """
+        RETURN: one page of the listing (see listing_page(); on a snapshot, after isn't needed: an offset is a seek)
+        """
+        if self.precomputed_listings and max_cost_level is None:
+            return snapshot_listing_page(self.conn, listing, listing_id, prefix, offset, limit)
+        return listing_page(self.conn, listing, listing_id, prefix, after, offset, limit, max_cost_level)
+
+    def get_restaurant(self, restaurant_id):
+        """
+        PARAM: restaurant_id (int) - the restaurant's id
+        RETURN: the DecodedRestaurant, or None if there's no restaurant with this id
+        """
+        restaurants = self.get_restaurants([restaurant_id])
+        return restaurants[0] if restaurants else None
+
+    def get_restaurants(self, restaurant_ids):
+        """
+        Gets the restaurants missing from the cache with one batch lookup
+
+        PARAM: restaurant_ids (list of int) - the ids
+        RETURN: list of DecodedRestaurant, in the order of restaurant_ids (unknown ids are skipped)
+        """
+        self._check_data_version()
+        restaurant_ids = list(restaurant_ids)
+        missing = [restaurant_id for restaurant_id in restaurant_ids if restaurant_id not in self._restaurants]
+        self.hits += len(restaurant_ids) - len(missing)
+        self.misses += len(missing)
+
+        found = {restaurant.restaurant_id: restaurant for restaurant in get_restaurants(self.conn, missing)}
+        restaurants = []
+        for restaurant_id in restaurant_ids:
+            restaurant = self._restaurants.get(restaurant_id) or found.get(restaurant_id)
+            if restaurant is None:
+                continue
+            # Most recently used last
+            self._restaurants[restaurant_id] = restaurant
+            self._restaurants.move_to_end(restaurant_id)
+            restaurants.append(restaurant)
+
+        while len(self._restaurants) > self.max_restaurants:
+            self._restaurants.popitem(last=False)
+        return restaurants
+
+
+class DatabaseRequest:
+    """
+    A query submitted to a DatabaseWorker, which can be cancelled (e.g. when its window is closed)
+    """
+
+    def __init__(self, worker, query, on_done, on_error):
+        self.worker = worker
+        self.query = query
+        self.on_done = on_done
+        self.on_error = on_error
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Don't deliver the result; a query that's already running is interrupted
+        """
+        self.cancelled = True
+        self.worker._interrupt(self)
+
+
+class DatabaseWorker:
+    """
+    Runs queries on a background thread, so the GUI thread is never blocked by a slow query or a locked database.
+
+        - The thread has its own read-only connection (an sqlite3 connection belongs to the thread that made it)
+          and a QueryCache on it.
+        - With a snapshot directory, it reads the current catalog snapshot (the database file until one is
+          published), and swaps to a newer snapshot between two queries.
+        - A query is a function that takes the QueryCache (its .conn is the connection) and returns the result.
+        - The results are queued, and deliver_results() calls the callbacks on the calling (GUI) thread,
+          e.g. polled with Tk's after().
+    """
+
+    def __init__(self, filename, max_restaurants=RESTAURANT_CACHE_SIZE, snapshot_directory=None):
+        """
+        PARAM: filename (str) - the database file
+        PARAM: max_restaurants (int) - max number of decoded restaurants cached
+        PARAM: snapshot_directory (str) - the catalog snapshot directory, or None to read the database file
+        """
+        self.filename = filename
+        self.max_restaurants = max_restaurants
+        self.snapshot_directory = snapshot_directory
+        self.snapshot = None  # file of the snapshot being read (None: the database file)
+        self._pointer_stat = None
+        self.conn = None
+        self.queries = None
+        self._requests = queue.Queue()
+        self._results = queue.Queue()
+        self._running = None  # request being run by the thread
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="lab3db-worker", daemon=True)
+        self._thread.start()
+
+    def submit(self, query, on_done, on_error=None):
+        """
+        PARAM: query - function(QueryCache) -> result, run on the worker thread
+        PARAM: on_done - function(result), called by deliver_results()
+        PARAM: on_error - function(exception), called by deliver_results() if the query raised (any exception)
+            (if None, the error is raised by deliver_results())
+        RETURN: the DatabaseRequest
+        """
+        request = DatabaseRequest(self, query, on_done, on_error)
+        self._requests.put(request)
+        return request
+
+    def _open(self, snapshot):
+        """
+        Open the snapshot (or the database file if it's None) and swap to it
+        """
+        # interrupt() is called from the GUI thread, so the connection can't be restricted to this thread
+        if snapshot is not None:
+            conn = open_snapshot(snapshot, check_same_thread=False)
+        else:
+            conn = open_read_only(self.filename, check_same_thread=False)
+        queries = QueryCache(conn, self.max_restaurants)
+        with self._lock:
+            previous, self.conn, self.queries, self.snapshot = self.conn, conn, queries, snapshot
+        if previous is not None:
+            previous.close()
+
+    def _check_snapshot(self):
+        """
+        Swap to the current snapshot if a newer one was published (a stat of the pointer file, per query)
+        """
+        try:
+            stat = os.stat(os.path.join(self.snapshot_directory, SNAPSHOT_POINTER))
+            pointer_stat = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        except FileNotFoundError:
+            pointer_stat = None
+        if pointer_stat == self._pointer_stat and self.conn is not None:
+            return
+        self._pointer_stat = pointer_stat
+        snapshot = current_snapshot(self.snapshot_directory)
+        if snapshot != self.snapshot or self.conn is None:
+            self._open(snapshot)
+
+    def _run(self):
+        open_error = None
+        try:
+            if self.snapshot_directory is not None:
+                self._check_snapshot()
+            else:
+                self._open(None)
+        except Exception as error:  # (sent back as the error of every request)
+            open_error = error
+
+        while True:
+            request = self._requests.get()
+            if request is None:
+                break
+            if request.cancelled:
+                continue
+
+            if self.snapshot_directory is not None and open_error is None:
+                try:
+                    self._check_snapshot()
+                except (sqlite3.Error, OSError):
+                    pass  # (keep reading the current one)
+
+            with self._lock:
+                self._running = request
+            try:
+                if open_error is not None:
+                    raise open_error
+                result, error = request.query(self.queries), None
+            except Exception as query_error:  # (any error goes back to the request, the thread keeps running)
+                result, error = None, query_error
+            finally:
+                with self._lock:
+                    self._running = None
+            self._results.put((request, result, error))
+
+        if self.conn is not None:
+            self.conn.close()
+
+    def _interrupt(self, request):
+        with self._lock:
+            if self._running is request:
+                self.conn.interrupt()
+
+    def deliver_results(self):
+        """
+        Call the callbacks of the finished queries (skipping cancelled ones), on the calling thread
+        """
+        while True:
+            try:
+                request, result, error = self._results.get_nowait()
+            except queue.Empty:
+                return
+            if request.cancelled:
+                continue
+            if error is None:
+                request.on_done(result)
+            elif request.on_error is not None:
+                request.on_error(error)
+            else:
+                raise error
+
+    def close(self, timeout=5):
+        """
+        Stop the thread (after the query it's running) and close its connection
+        """
+        self._requests.put(None)
+        self._thread.join(timeout)
@@ -10,6 +10,29 @@ import tkinter as tk
 import tkinter.messagebox as tkmb
 import sqlite3
 import webbrowser
+from collections import OrderedDict
+
+import lab3db
+
+DATABASE_FILE = "restaurants.db"
+
+# Directory of the catalog snapshots published by the back end (read instead of the database file when there's one)
+SNAPSHOT_DIRECTORY = lab3db.SNAPSHOT_DIRECTORY
+
+# Milliseconds between checks for finished database queries
+POLL_INTERVAL = 20
+
+# Number of rows shown by a restaurant list (only the shown rows are read from the database and put in the listbox)
+VISIBLE_ROWS = 10
+
+# Max number of pages (lab3db.PAGE_SIZE rows) of a restaurant list kept in memory
+CACHED_PAGES = 20
+
+# Milliseconds after the last key press in the name filter before the list is filtered
+FILTER_DELAY = 150
+
+# Option of the cost filter that shows every restaurant
+ANY_COST = "Any"
 
 
 class MainWindow(tk.Tk):
@@ -17,7 +40,7 @@ class MainWindow(tk.Tk):
     Main window of the program:
 
         - Responsible for displaying the main user interface and options
-        - Handles user interactions related to searching by city or cuisine
+        - Handles user interactions related to searching by city or cuisine, by text and by distance
         - Creates and manages instances of other windows
     """
 
@@ -37,18 +60,62 @@ class MainWindow(tk.Tk):
             row=2, column=1, padx=15, pady=10
         )
 
+        # Full-text search box: name, cuisine, city or address (Enter or the Search button)
+        self.search_text = tk.StringVar()
+        search_entry = tk.Entry(self, textvariable=self.search_text)
+        search_entry.grid(row=3, column=0, columnspan=2, padx=15, pady=10, sticky="ew")
+        search_entry.bind("<Return>", lambda event: self.search_by_text())
+        tk.Button(self, text="Search", fg="blue", command=self.search_by_text).grid(row=3, column=2, padx=15, pady=10)
+
+        # Restaurants near a place: a city or "latitude, longitude" (Enter or the Nearby button)
+        self.near_text = tk.StringVar()
+        near_entry = tk.Entry(self, textvariable=self.near_text)
+        near_entry.grid(row=4, column=0, columnspan=2, padx=15, pady=10, sticky="ew")
+        near_entry.bind("<Return>", lambda event: self.search_nearby())
+        tk.Button(self, text="Nearby", fg="blue", command=self.search_nearby).grid(row=4, column=2, padx=15, pady=10)
+
         # Call closeWin method when user clicks on the close button
         self.protocol("WM_DELETE_WINDOW", self.closeWin)
 
-        # Try to connect to database
+        # Check the database, read-only: the back end creates and migrates it (lab3back.create_database()),
+        # the front end never writes to it, so it can't be locked out by (or lock out) a running scrape
         try:
-            self.conn = sqlite3.connect("restaurants.db")
-            self.cur = self.conn.cursor()
+            snapshot = lab3db.current_snapshot(SNAPSHOT_DIRECTORY)
+            conn = lab3db.open_snapshot(snapshot) if snapshot else lab3db.open_read_only(DATABASE_FILE)
+            version = lab3db.schema_version(conn)
+            conn.close()
+        except (sqlite3.Error, OSError):
+            version = None
         # If failed, show error message and close the program
-        except sqlite3.OperationalError:
-            tkmb.showerror("Error", "Failed to open database")
+        if version is None or version < lab3db.SCHEMA_VERSION:
+            if version is None:
+                tkmb.showerror("Error", "Failed to open database")
+            else:
+                tkmb.showerror(
+                    "Error",
+                    f"The database is older than this program (schema version {version}, "
+                    f"needs {lab3db.SCHEMA_VERSION}).\nRun lab3back.py to update it.",
+                )
             self.destroy() # Close the main window
             self.quit() # Close the program
+            return
+
+        # All the queries run on a background thread with a read-only connection (and a cache of the
+        # cities, cuisines and restaurant details), so the window never freezes on a slow or locked database.
+        # It reads the latest catalog snapshot (memory-mapped, no locks against a running scrape) and swaps to
+        # a newer one between two queries, when the back end publishes it.
+        self.db = lab3db.DatabaseWorker(DATABASE_FILE, snapshot_directory=SNAPSHOT_DIRECTORY)
+        self.poll_database()
+
+    def poll_database(self):
+        """
+        Hands the results of the finished queries to their windows, on the Tk thread
+        """
+        try:
+            self.db.deliver_results()
+        finally:
+            # (a callback that raises must not stop the polling: Tk reports the error, the next poll still runs)
+            self.after(POLL_INTERVAL, self.poll_database)
 
     def search_by_city(self):
         """
@@ -61,7 +128,7 @@ class MainWindow(tk.Tk):
 
         """
         # Create an instance of DialogWindow, passing the current instance of MainWindow and the database connection
-        self.cities_window = DialogWindow(self, self.conn)
+        self.cities_window = DialogWindow(self, self.db)
         # Call displayCity method of DialogWindow to display a list of cities
         self.cities_window.display_cities()
         # Wait for the dialog window to be closed before continuing
@@ -70,28 +137,18 @@ class MainWindow(tk.Tk):
 
         # check if user has selected a city
         if len(self.cities_window.getSelection) != 0:
-            # indices of choices in the listbox starts with 0, so add 1 to get correct ID
-            cityID = self.cities_window.getSelection[0] + 1
+            # the dialog returns the ID of the selected city
+            cityID = self.cities_window.getSelection[0]
 
             # create a new dialog win to retrieve restaurant's city
-            self.restauraunts_window = DialogWindow(self, self.conn)
+            self.restauraunts_window = DialogWindow(self, self.db)
             # retrieve restaurant from given cityID
             self.restauraunts_window.get_restauraunt_from_cityID(cityID)
             # wait for the dialog window to be closed before continuing
             self.wait_window(self.restauraunts_window)
 
-            # Get the restaurant with the selected index from the listbox
-            self.cur.execute(
-                "SELECT Restaurant.restaurant_id FROM Restaurant WHERE Restaurant.location_id = ?", (cityID,)
-            )
-            selectedRestaurant = self.cur.fetchall()
-
-            # open a new DisplayWindow for each selected restaurant
-            for i in self.restauraunts_window.getSelection:
-                # Pass the restaurant's ID that was selected from the dialog to DisplayWindow
-                DisplayWindow(self, selectedRestaurant[i][0], self.conn)
-
-        print(f"Selected restaurant: {selectedRestaurant}")
+            # The dialog kept the restaurant IDs of the selection, so no need to query them again
+            self.open_restaurants(self.restauraunts_window.getSelection)
 
     def search_by_cuisine(self):
         """
@@ -103,46 +160,343 @@ class MainWindow(tk.Tk):
             - Allows the user to choose one or more restaurants, opening a separate window (DisplayWindow) for each selection
         """
         # Create an instance of DialogWindow, passing the current instance of MainWindow and the database connection
-        self.cities_window = DialogWindow(self, self.conn)
+        self.cities_window = DialogWindow(self, self.db)
         # Call displayCuisine method of DialogWindow to display a list of cuisines
         self.cities_window.display_cuisines()
         # Wait for the dialog window to be closed before continuing
         self.wait_window(self.cities_window)
 
-        # Set selectedRestaurant to a default value
-        selectedRestaurant = "No selection"
-
         if len(self.cities_window.getSelection) != 0:
-            # indices of choices in the listbox starts with 0, so should be +1 to get correct ID
-            cuisineID = self.cities_window.getSelection[0] + 1
+            # the dialog returns the ID of the selected cuisine
+            cuisineID = self.cities_window.getSelection[0]
 
             # create a new dialog win to retrieve restaurant's city
-            self.restauraunts_window = DialogWindow(self, self.conn)
+            self.restauraunts_window = DialogWindow(self, self.db)
             self.restauraunts_window.get_restauraunts_by_cuisine(cuisineID)
             self.wait_window(self.restauraunts_window)
 
-            # fetch the restaurant with the selected index
-            self.cur.execute(
-                "SELECT Restaurant.restaurant_id FROM Restaurant WHERE Restaurant.cuisine_id = ?", (cuisineID,)
-            )
-            selectedRestaurant = self.cur.fetchall()
+            # The dialog kept the restaurant IDs of the selection, so no need to query them again
+            self.open_restaurants(self.restauraunts_window.getSelection)
+
+    def search_by_text(self):
+        """
+        Handles the user's full-text search.
+
+            - Displays the best matching restaurants (by name, cuisine, city or address) in a dialog window.
+            - User can choose one or more restaurants, opening a separate DisplayWindow for each selection
+        """
+        text = self.search_text.get().strip()
+        if not text:
+            return
+
+        self.restauraunts_window = DialogWindow(self, self.db)
+        self.restauraunts_window.display_search_results(text)
+        self.wait_window(self.restauraunts_window)
+
+        self.open_restaurants(self.restauraunts_window.getSelection)
 
-            # open a new DisplayWindow for each selected restaurant by passing the restaurant's ID to DisplayWindow
-            for i in self.restauraunts_window.getSelection:
-                DisplayWindow(self, selectedRestaurant[i][0], self.conn)
+    def search_nearby(self):
+        """
+        Handles the user's "restaurants near" search.
+
+            - Displays the restaurants nearest to the place (a city or "latitude, longitude"), with their distance.
+            - User can choose one or more restaurants, opening a separate DisplayWindow for each selection
+        """
+        place = self.near_text.get().strip()
+        if not place:
+            return
+
+        self.restauraunts_window = DialogWindow(self, self.db)
+        self.restauraunts_window.display_nearby(place)
+        self.wait_window(self.restauraunts_window)
 
-        print(f"Selected restaurant IDs in processCuisine: {selectedRestaurant}")
+        self.open_restaurants(self.restauraunts_window.getSelection)
+
+    def open_restaurants(self, restaurant_ids):
+        """
+        Opens a DisplayWindow for each restaurant selected in the restaurants dialog.
+
+            - Gets all the selected restaurants, decoded, with one batch query (in the background).
+        """
+        if not restaurant_ids:
+            return
+
+        def show_restaurants(restaurants):
+            self.config(cursor="")
+            for restaurant in restaurants:
+                DisplayWindow(self, restaurant.restaurant_id, self.db, restaurant)
+
+        def show_error(error):
+            self.config(cursor="")
+            tkmb.showerror("Error", f"Failed to read the restaurants: {error}")
+
+        self.config(cursor="watch")  # Loading indicator
+        self.db.submit(lambda queries: queries.get_restaurants(restaurant_ids), show_restaurants, show_error)
 
     def closeWin(self):
         """
         Closes the database connection and closes the program.
         """
-        self.conn.close()
+        self.db.close()
         self.destroy()
         self.quit()
 
 
-class DialogWindow(tk.Toplevel):
+class LoadingWindow(tk.Toplevel):
+    """
+    Window that fills itself with the result of a background query.
+
+        - Shows a loading message until the result is delivered (or an error message if the query failed).
+        - Cancels its queries that haven't finished when it's closed.
+    """
+
+    def __init__(self, master, db):
+        super().__init__(master)
+        self.db = db  # The lab3db.DatabaseWorker
+        self._requests = []  # Queries that haven't finished
+        self.protocol("WM_DELETE_WINDOW", self.closeWindow)  # Call closeWindow when user clicks on the close button
+
+    def load(self, query, on_done, row):
+        """
+        Runs the query in the background, then calls on_done with its result.
+
+            - query is a function(lab3db.QueryCache) -> result
+            - row is the grid row of the loading message
+        """
+        loading_label = tk.Label(self, text="Loading...", font=("Helvetica", 13), fg="gray")
+        loading_label.grid(row=row, column=0, columnspan=2, padx=15, pady=10)
+
+        def done(result):
+            loading_label.destroy()
+            on_done(result)
+
+        def failed(error):
+            loading_label.configure(text=f"Failed to load: {error}", fg="red")
+
+        self.submit(query, done, failed)
+
+    def submit(self, query, on_done, on_error):
+        """
+        Runs the query in the background (without a loading message), cancelled if the window is closed first.
+        """
+
+        def done(result):
+            self._requests.remove(request)
+            on_done(result)
+
+        def failed(error):
+            self._requests.remove(request)
+            on_error(error)
+
+        request = self.db.submit(query, done, failed)
+        self._requests.append(request)
+
+    def closeWindow(self):
+        for request in self._requests:
+            request.cancel()
+        self.destroy()
+
+
+class RestaurantList(tk.Frame):
+    """
+    Virtualized list of the restaurants of a city or cuisine, with a type-ahead name filter and a max cost filter.
+
+        - Only the visible rows are in the listbox. They're read from the database by pages in the background:
+          with keyset queries when scrolling on from a loaded page, with an offset when jumping.
+        - The scrollbar is driven by the row count, not by the listbox.
+        - The selection is kept by restaurant ID, so it stays the same while scrolling and filtering.
+    """
+
+    def __init__(self, window, listing, listing_id):
+        """
+            - window is the LoadingWindow the list is in (it runs the queries)
+            - listing is "location" or "cuisine", listing_id is the city's / cuisine's ID
+        """
+        super().__init__(window)
+        self.window = window
+        self.listing = listing
+        self.listing_id = listing_id
+        self.selected_ids = set()  # IDs of the selected restaurants
+        self.prefix = ""  # Name filter
+        self.max_cost_level = None  # Cost filter (None: any cost)
+        self.generation = 0  # Incremented when the filter changes, the results of older queries are ignored
+        self.total = 0  # Number of rows of the (filtered) list
+        self.top = 0  # Index of the first visible row
+        self.pages = OrderedDict()  # page number -> rows (restaurant ID, name), least recently used first
+        self.loading_pages = set()  # page numbers being read
+        self.visible_ids = []  # Restaurant IDs of the listbox rows (None while a row is loading)
+        self._filter_job = None
+
+        # Name filter: the list is filtered as the user types
+        tk.Label(self, text="Name starts with:", font=("Helvetica", 13)).grid(row=0, column=0, sticky="w")
+        self.filter_text = tk.StringVar()
+        self.filter_text.trace_add("write", self.filter_changed)
+        filter_entry = tk.Entry(self, textvariable=self.filter_text)
+        filter_entry.grid(row=1, column=0, columnspan=2, sticky="ew", pady=5)
+        filter_entry.focus_set()
+
+        self.listbox = tk.Listbox(self, height=VISIBLE_ROWS, width=40, selectmode="multiple", exportselection=False)
+        self.scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL, command=self.scroll)
+        self.listbox.bind("<<ListboxSelect>>", self.selection_changed)
+        self.listbox.bind("<MouseWheel>", lambda event: self.scroll("scroll", -event.delta // 120, "units"))
+        self.listbox.bind("<Button-4>", lambda event: self.scroll("scroll", -1, "units"))
+        self.listbox.bind("<Button-5>", lambda event: self.scroll("scroll", 1, "units"))
+        self.listbox.grid(row=2, column=0, sticky="nsew")
+        self.scrollbar.grid(row=2, column=1, sticky="ns")
+
+        self.count_label = tk.Label(self, text="Loading...", font=("Helvetica", 13), fg="gray")
+        self.count_label.grid(row=3, column=0, columnspan=2, sticky="w")
+
+        # Cost filter: the restaurants up to a cost level (the levels are read from the database)
+        cost_frame = tk.Frame(self)
+        cost_frame.grid(row=4, column=0, columnspan=2, sticky="w", pady=5)
+        tk.Label(cost_frame, text="Max cost:", font=("Helvetica", 13)).pack(side=tk.LEFT)
+        self.cost_text = tk.StringVar(value=ANY_COST)
+        self.cost_menu = tk.OptionMenu(cost_frame, self.cost_text, ANY_COST)
+        self.cost_menu.pack(side=tk.LEFT)
+        self.window.submit(lambda queries: queries.get_cost_levels(), self.show_cost_levels, self.show_error)
+
+        self.reload()
+
+    def show_cost_levels(self, cost_levels):
+        """
+        Puts the cost levels, e.g. [(1, "$"), (2, "$$")], in the cost filter's menu
+        """
+        menu = self.cost_menu["menu"]
+        menu.delete(0, tk.END)
+        for level, symbol in [(None, ANY_COST)] + cost_levels:
+            menu.add_command(label=symbol, command=lambda level=level, symbol=symbol: self.cost_changed(level, symbol))
+
+    def cost_changed(self, level, symbol):
+        self.cost_text.set(symbol)
+        if level != self.max_cost_level:
+            self.max_cost_level = level
+            self.reload()
+
+    def filter_changed(self, *args):
+        # Wait for the user to stop typing before querying
+        if self._filter_job is not None:
+            self.after_cancel(self._filter_job)
+        self._filter_job = self.after(FILTER_DELAY, self.apply_filter)
+
+    def apply_filter(self):
+        self._filter_job = None
+        prefix = self.filter_text.get().strip()
+        if prefix != self.prefix:
+            self.prefix = prefix
+            self.reload()
+
+    def reload(self):
+        """
+        Counts the rows of the (filtered) list, then shows its first rows.
+        """
+        self.generation += 1
+        self.pages.clear()
+        self.loading_pages.clear()
+        self.top = 0
+        generation, listing, listing_id, prefix = self.generation, self.listing, self.listing_id, self.prefix
+        max_cost_level = self.max_cost_level
+
+        def show_count(total):
+            if generation == self.generation:
+                self.total = total
+                self.count_label.configure(text=f"{total} restaurants", fg="black")
+                self.render()
+
+        self.window.submit(
+            lambda queries: queries.listing_count(listing, listing_id, prefix, max_cost_level),
+            show_count,
+            self.show_error,
+        )
+
+    def show_error(self, error):
+        self.count_label.configure(text=f"Failed to load: {error}", fg="red")
+
+    def load_page(self, page_number):
+        """
+        Reads a page of rows in the background, then shows them if they're still visible.
+        """
+        self.loading_pages.add(page_number)
+        generation, listing, listing_id, prefix = self.generation, self.listing, self.listing_id, self.prefix
+        max_cost_level = self.max_cost_level
+        # Continue from the end of the previous page if it's loaded (an index seek), otherwise skip to the page
+        previous_page = self.pages.get(page_number - 1)
+        after = previous_page[-1] if previous_page else None
+        offset = page_number * lab3db.PAGE_SIZE
+
+        def show_page(rows):
+            if generation == self.generation:
+                self.loading_pages.discard(page_number)
+                self.pages[page_number] = rows
+                while len(self.pages) > CACHED_PAGES:
+                    self.pages.popitem(last=False)
+                self.render()
+
+        self.window.submit(
+            lambda queries: queries.listing_page(
+                listing, listing_id, prefix, after, offset, max_cost_level=max_cost_level
+            ),
+            show_page,
+            self.show_error,
+        )
+
+    def render(self):
+        """
+        Puts the visible rows in the listbox (reading the pages that aren't loaded), and updates the scrollbar.
+        """
+        end = min(self.top + VISIBLE_ROWS, self.total)
+        rows = []
+        for index in range(self.top, end):
+            page_number, row_number = divmod(index, lab3db.PAGE_SIZE)
+            page = self.pages.get(page_number)
+            if page is None:
+                if page_number not in self.loading_pages:
+                    self.load_page(page_number)
+                rows.append((None, "Loading..."))
+            else:
+                self.pages.move_to_end(page_number)
+                # (the page can be shorter than expected if rows were removed since the count)
+                rows.append(page[row_number] if row_number < len(page) else (None, ""))
+
+        self.listbox.delete(0, tk.END)
+        self.visible_ids = [row[0] for row in rows]
+        for index, (restaurant_id, name) in enumerate(rows):
+            self.listbox.insert(tk.END, name)
+            if restaurant_id in self.selected_ids:
+                self.listbox.selection_set(index)
+
+        if self.total:
+            self.scrollbar.set(self.top / self.total, end / self.total)
+        else:
+            self.scrollbar.set(0, 1)
+
+    def scroll(self, *args):
+        """
+        Scrollbar command (and mouse wheel): ("moveto", fraction) or ("scroll", number, "units" or "pages")
+        """
+        if args[0] == "moveto":
+            top = round(float(args[1]) * self.total)
+        else:
+            step = VISIBLE_ROWS if args[2] == "pages" else 1
+            top = self.top + int(args[1]) * step
+        top = max(0, min(top, self.total - VISIBLE_ROWS))
+        if top != self.top:
+            self.top = top
+            self.render()
+        return "break"
+
+    def selection_changed(self, event):
+        selected = self.listbox.curselection()
+        for index, restaurant_id in enumerate(self.visible_ids):
+            if restaurant_id is None:
+                continue
+            if index in selected:
+                self.selected_ids.add(restaurant_id)
+            else:
+                self.selected_ids.discard(restaurant_id)
+
+
+class DialogWindow(LoadingWindow):
     """
     Dialog window that interacts with the user and gets input.
 
@@ -152,14 +506,14 @@ class DialogWindow(tk.Toplevel):
         - Provides methods to close the dialog window and communicate with the MainWindow.
     """
 
-    def __init__(self, master, db_connection):
-        super().__init__(master)  # Need to call the constructor of the parent class
+    def __init__(self, master, db):
+        super().__init__(master, db)  # Need to call the constructor of the parent class
         self.grab_set()  # Prevents user from interacting with the main window while the dialog is open
         self.focus_set()  # Sets the focus to the dialog window
         self.transient(master)  # Makes the dialog window dependent on the main window
-        self.protocol("WM_DELETE_WINDOW", self.closeWindow)  # Call closeWin method when user clicks on the close button
-        self._selection = ()  # Stores the user's selection
-        self.conn = db_connection  # Stores the database connection
+        self._selection = ()  # Stores the IDs of the user's selection
+        self.item_ids = []  # IDs (city, cuisine or restaurant) of the listbox rows
+        self.restaurant_list = None  # The RestaurantList (restaurant dialogs), it keeps the selected IDs itself
 
     def display_cities(self):
         """
@@ -177,12 +531,8 @@ class DialogWindow(tk.Toplevel):
         self.scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL, command=self.listbox.yview)
         self.listbox.configure(yscrollcommand=self.scrollbar.set)
 
-        # Connect to database
-        self.cur = self.conn.cursor()
-
-        # Add items to the listbox from the database query
-        for city in self.cur.execute("SELECT * FROM Location"):
-            self.listbox.insert(tk.END, city[1])  # city[0] is city's ID
+        # Add the cities (ID, name) to the listbox from the (cached) Location table, once loaded
+        self.load(lambda queries: queries.get_locations(), self.show_items, row=3)
 
         self.listbox.grid(row=1, column=0, ipadx=5, padx=20, pady=20, sticky="nsew")
         self.scrollbar.grid(row=1, column=1, sticky="ns")
@@ -208,11 +558,8 @@ class DialogWindow(tk.Toplevel):
         self.scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL, command=self.listbox.yview)
         self.listbox.configure(yscrollcommand=self.scrollbar.set)
 
-        self.cur = self.conn.cursor()
-
-        # Add items to the listbox from the database query
-        for city in self.cur.execute("SELECT * FROM Cuisine"):
-            self.listbox.insert(tk.END, city[1])
+        # Add the cuisines (ID, name) to the listbox from the (cached) Cuisine table, once loaded
+        self.load(lambda queries: queries.get_cuisines(), self.show_items, row=3)
 
         self.listbox.grid(row=1, column=0, ipadx=5, padx=20, pady=20, sticky="nsew")
         self.scrollbar.grid(row=1, column=1, sticky="ns")
@@ -231,88 +578,122 @@ class DialogWindow(tk.Toplevel):
             - Waits for the user to make a selection from the list.
             - Returns the selected restaurants to the calling function (MainWindow).
         """
-        tk.Label(self, text="Click on a restaurant to select", font=("Helvetica", 15)).grid(row=0, padx=15, pady=10)
+        self.show_restaurant_list("location", cityID)
 
-        # Create the Listbox and Scrollbar widgets
-        self.listbox = tk.Listbox(self, height=6, selectmode="multiple")
-        self.scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL, command=self.listbox.yview)
-        self.listbox.configure(yscrollcommand=self.scrollbar.set)
+    def get_restauraunts_by_cuisine(self, cuisineID):
+        """
+        Displays restaurants based on the selected cuisine ID for the user to select.
 
-        # Connect to database
-        self.cur = self.conn.cursor()
+            - Retrieves the restaurants from the database that match the selected cuisine ID.
+            - Displays the restaurants in a listbox within a dialog window.
+            - Allows the user to select one or more restaurants.
+            - Returns the selected restaurants to the calling function (MainWindow).
+        """
+        self.show_restaurant_list("cuisine", cuisineID)
 
-        self.cur.execute(
-            "SELECT Restaurant.restaurant_name FROM Restaurant WHERE Restaurant.location_id = ?", (cityID,)
+    def show_restaurant_list(self, listing, listing_id):
+        """
+        Displays the restaurants of the city or cuisine in a virtualized list, with a name filter.
+        """
+        tk.Label(self, text="Click on a restaurant to select", font=("Helvetica", 15)).grid(row=0, padx=15, pady=10)
+
+        self.restaurant_list = RestaurantList(self, listing, listing_id)
+        self.restaurant_list.grid(row=1, column=0, padx=20, pady=10, sticky="nsew")
+
+        # Select button that calls the select method, which closes the dialog window
+        tk.Button(self, text="Click to select", font=("Helvetica", 15), command=self.click_select).grid(
+            row=2, column=0, columnspan=2, padx=20, pady=20
         )
 
-        restaurants = self.cur.fetchall()  # for debugging
-        print(f"Restaurants in city {cityID}: {restaurants}")  # Debug print
+    def display_search_results(self, text):
+        """
+        Displays the restaurants matching the search text, best matches first, for the user to select.
+        """
+        tk.Label(self, text=f'Results for "{text}"', font=("Helvetica", 15)).grid(row=0, padx=15, pady=10)
+
+        self.listbox = tk.Listbox(self, height=VISIBLE_ROWS, width=50, selectmode="multiple")
+        self.scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL, command=self.listbox.yview)
+        self.listbox.configure(yscrollcommand=self.scrollbar.set)
+
+        def show_results(results):
+            self.show_items(
+                [(restaurant_id, f"{name} ({cuisine}, {city})") for restaurant_id, name, cuisine, city in results]
+            )
+            if not results:
+                self.listbox.insert(tk.END, "No restaurant found")
 
-        for restaurant in restaurants:
-            self.listbox.insert(tk.END, restaurant[0])
+        self.load(lambda queries: lab3db.search_restaurants(queries.conn, text), show_results, row=3)
 
         self.listbox.grid(row=1, column=0, ipadx=5, padx=20, pady=20, sticky="nsew")
         self.scrollbar.grid(row=1, column=1, sticky="ns")
 
-        # Select button that calls the select method, which closes the dialog window
         tk.Button(self, text="Click to select", font=("Helvetica", 15), command=self.click_select).grid(
             row=2, column=0, columnspan=2, padx=20, pady=20
         )
 
-    def get_restauraunts_by_cuisine(self, cuisineID):
+    def display_nearby(self, place):
         """
-        Displays restaurants based on the selected cuisine ID for the user to select.
-
-            - Retrieves the restaurants from the database that match the selected cuisine ID.
-            - Displays the restaurants in a listbox within a dialog window.
-            - Allows the user to select one or more restaurants.
-            - Returns the selected restaurants to the calling function (MainWindow).
+        Displays the restaurants nearest to the place, nearest first, for the user to select.
         """
-        tk.Label(self, text="Click on a restaurant to select", font=("Helvetica", 15)).grid(row=0, padx=15, pady=10)
+        tk.Label(self, text=f"Restaurants near {place}", font=("Helvetica", 15)).grid(row=0, padx=15, pady=10)
 
-        # Listbox and Scrollbar
-        self.listbox = tk.Listbox(self, height=6, selectmode="multiple")
+        self.listbox = tk.Listbox(self, height=VISIBLE_ROWS, width=50, selectmode="multiple")
         self.scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL, command=self.listbox.yview)
         self.listbox.configure(yscrollcommand=self.scrollbar.set)
 
-        self.cur = self.conn.cursor()  # Connect to database
-
-        # Find all the restaurants that match the selected cuisine ID
-        self.cur.execute(
-            "SELECT Restaurant.restaurant_name FROM Restaurant WHERE Restaurant.cuisine_id = ?", (cuisineID,)
-        )
-        # Fetch all the restaurants from the query
-        restaurants = self.cur.fetchall()
+        def find_nearest(queries):
+            point = lab3db.locate(queries.conn, place)
+            return lab3db.nearest_restaurants(queries.conn, *point) if point is not None else None
+
+        def show_results(results):
+            if results is None:
+                self.show_items([])
+                self.listbox.insert(tk.END, 'Unknown place: enter a city or "latitude, longitude"')
+                return
+            self.show_items(
+                [(restaurant_id, f"{name} ({distance:.1f} km)") for restaurant_id, name, distance in results]
+            )
+            if not results:
+                self.listbox.insert(tk.END, "No geocoded restaurant")
 
-        # Loop used to add restaurants to the listbox
-        for restaurant in restaurants:
-            self.listbox.insert(tk.END, restaurant[0])
+        self.load(find_nearest, show_results, row=3)
 
-        # Add the listbox and scrollbar to the dialog window
         self.listbox.grid(row=1, column=0, ipadx=5, padx=20, pady=20, sticky="nsew")
         self.scrollbar.grid(row=1, column=1, sticky="ns")
 
-        # Select button that calls the on_click method, which closes the dialog window
         tk.Button(self, text="Click to select", font=("Helvetica", 15), command=self.click_select).grid(
             row=2, column=0, columnspan=2, padx=20, pady=20
         )
 
+    def show_items(self, items):
+        """
+        Adds the (ID, text) items to the listbox: the IDs are kept in the order of the rows,
+        so a selected row gives its ID directly (IDs don't have to follow the row numbers)
+        """
+        for item_id, text in items:
+            self.item_ids.append(item_id)
+            self.listbox.insert(tk.END, text)
+
     def click_select(self):
         """
-        Retrieves the user's selection from the listbox and closes the dialog window.
+        Retrieves the IDs of the user's selection from the listbox and closes the dialog window.
         """
-        self._selection = self.listbox.curselection()
+        if self.restaurant_list is not None:
+            self._selection = tuple(sorted(self.restaurant_list.selected_ids))
+        else:
+            # (rows without an ID, like "No restaurant found", can't be selected)
+            self._selection = tuple(self.item_ids[i] for i in self.listbox.curselection() if i < len(self.item_ids))
         self.closeWindow()
 
     @property  # @property decorator allows the method to be called without parentheses
     def getSelection(self):
+        """
+        RETURN: the IDs (city, cuisine or restaurant) of the selected items
+        """
         return self._selection
 
-    def closeWindow(self):
-        self.destroy() # Close the dialog window without closing the main window
-
 
-class DisplayWindow(tk.Toplevel):
+class DisplayWindow(LoadingWindow):
     """
     Displays information about selected restaurants in a separate window.
 
@@ -321,37 +702,41 @@ class DisplayWindow(tk.Toplevel):
         - Provides a method to open the restaurant's webpage in a web browser.
     """
 
-    # Call the constructor of the parent class, passing the current instance of MainWindow, the restaurant's ID, and the database connection
-    def __init__(self, master, restaurant_ID, db_connection):
-        super().__init__(master)
+    # Call the constructor of the parent class, passing the current instance of MainWindow, the restaurant's ID, and the database worker
+    def __init__(self, master, restaurant_ID, db, restaurant=None):
+        """
+        Shows the details of one restaurant.
+
+            - restaurant is the decoded restaurant (lab3db.DecodedRestaurant) if the caller already has it,
+              otherwise it is read from the database (in the background) with one joined query.
+        """
+        super().__init__(master, db)
         self.transient(
             master
         )  # .transient() makes the dialog window dependent on the main window (it will close when the main window is closed)
 
-        self.conn = db_connection  # Connect to database
-        self.cur = self.conn.cursor()  # Create cursor object
-
-        # Get the restaurant's details from the database based on the restaurant's ID
-        self.cur.execute("SELECT * FROM Restaurant WHERE Restaurant.restaurant_id = ?", (restaurant_ID,))
-        restaurant = self.cur.fetchone()
-        name, address = restaurant[1], restaurant[6]
-
-        # Get the restaurant's cost and cuisine from the database based on the restaurant's ID
-        self.cur.execute(
-            "SELECT Cost.cost_symbol FROM Restaurant JOIN Cost ON Restaurant.cost_id = Cost.cost_id AND Restaurant.restaurant_id = ?",
-            (restaurant_ID,),
-        )
-        cost = self.cur.fetchone()[0]
+        # Get the restaurant's details (name, address, cost, cuisine, URL) based on the restaurant's ID
+        if restaurant is None:
+            self.load(lambda queries: queries.get_restaurant(restaurant_ID), self.show_restaurant, row=0)
+        else:
+            self.show_restaurant(restaurant)
 
-        # Get the restaurant's cuisine from the database based on the restaurant's ID
-        self.cur.execute(
-            "SELECT Cuisine.cuisine_name FROM Restaurant JOIN Cuisine ON Restaurant.cuisine_id = Cuisine.cuisine_id AND Restaurant.restaurant_id = ?",
-            (restaurant_ID,),
+    def show_restaurant(self, restaurant):
+        """
+        Shows the restaurant's name, address, cost, cuisine, and a button to visit its webpage
+        (or a message if there's no restaurant with this ID: restaurant is None, e.g. deleted by a new scrape).
+        """
+        if restaurant is None:
+            tk.Label(self, text="Restaurant not found", font=("Helvetica", 15)).grid(row=0, padx=15, pady=10)
+            return
+
+        name, address, cost, cuisine, url = (
+            restaurant.name,
+            restaurant.address,
+            restaurant.cost,
+            restaurant.cuisine,
+            restaurant.url,
         )
-        cuisine = self.cur.fetchone()[0]
-
-        # Get the restaurant's URL
-        url = restaurant[2]
 
         tk.Label(self, text=name, font=("Helvetica", 18), fg="blue").grid(row=0, padx=15, pady=10)
         tk.Label(self, text=address, font=("Helvetica", 15)).grid(row=1, padx=15, pady=10)
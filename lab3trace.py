@@ -0,0 +1,290 @@
+"""
+Authors: Alex Hagemeister & Marcel Gunadi
+Spring Quarter, 2023
+CIS41B Advanced Python
+
+Lab 3: Web Scraping and Database Interaction
+
+lab3trace.py
+
+    Lightweight instrumentation of the scraper's hot paths (fetch, parse, extract, dedup, database write):
+
+    - span("name") context manager and @timed("name") decorator: time a block / function
+    - count("name"): counters
+    - summary() / print_summary(): per-run totals (count, total, mean and max time of every span)
+    - write_chrome_trace(): JSON timeline of every span, per thread, for chrome://tracing or Perfetto
+    - profile(): cProfile of a block, saved for pstats / snakeviz
+
+    Disabled by default: a disabled span or counter is a flag check (no clock read, no lock, no allocation).
+    The decorators use functools.wraps and call the function directly, so sampling profilers (py-spy) show
+    the real stacks.
+
+    Enabled with enable(), or for a whole run with environment variables:
+        LAB3_TRACE=1             print the summary at exit
+        LAB3_TRACE=trace.json    also write the Chrome trace to trace.json at exit
+        LAB3_PROFILE=run.prof    cProfile the whole run, saved to run.prof at exit
+"""
+
+import atexit
+import cProfile
+import functools
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+# Max number of timeline events kept (a long run still gets its summary, the timeline stops growing)
+MAX_TIMELINE_EVENTS = 1000000
+
+_enabled = False
+_timeline = False
+_lock = threading.Lock()
+_stats = {}  # span name -> [count, total ns, max ns]
+_counters = {}  # counter name -> value
+_events = []  # Chrome trace events
+_thread_names = {}  # thread id -> name
+_start_ns = time.perf_counter_ns()
+
+
+def enable(timeline=False):
+    """
+    Start recording the spans and counters
+
+    PARAM: timeline (bool) - also keep every span for the Chrome trace (more memory)
+    """
+    global _enabled, _timeline
+    _timeline = timeline
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """
+    Forget the recorded spans, counters and timeline
+    """
+    global _start_ns
+    with _lock:
+        _stats.clear()
+        _counters.clear()
+        _events.clear()
+        _thread_names.clear()
+        _start_ns = time.perf_counter_ns()
+
+
+class _NullSpan:
+    """
+    Span returned while disabled: does nothing
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        _record(self.name, self.start, time.perf_counter_ns(), self.args)
+        return False
+
+
+def _record(name, start, end, args=None):
+    duration = end - start
+    with _lock:
+        stats = _stats.get(name)
+        if stats is None:
+            _stats[name] = [1, duration, duration]
+        else:
+            stats[0] += 1
+            stats[1] += duration
+            if duration > stats[2]:
+                stats[2] = duration
+
+        if _timeline and len(_events) < MAX_TIMELINE_EVENTS:
+            thread = threading.current_thread()
+            _thread_names.setdefault(thread.ident, thread.name)
+            event = {
+                "name": name,
+                "ph": "X",  # complete event: start and duration (microseconds)
+                "ts": (start - _start_ns) / 1000,
+                "dur": duration / 1000,
+                "pid": os.getpid(),
+                "tid": thread.ident,
+            }
+            if args:
+                event["args"] = args
+            _events.append(event)
+
+
+def span(name, **args):
+    """
+    Time a block: with span("fetch", url=url): ...
+
+    PARAM: name (str) - the span name, dotted by stage (e.g. "parse.directory")
+    PARAM: args - values shown with the span in the timeline
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def timed(name):
+    """
+    Decorator: time every call of the function as a span
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _record(name, start, time.perf_counter_ns())
+
+        return wrapper
+
+    return decorator
+
+
+def count(name, value=1):
+    """
+    Add value to a counter
+    """
+    if _enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + value
+
+
+def summary():
+    """
+    RETURN: dict with:
+        spans - span name -> {count, total_s, mean_ms, max_ms}, by decreasing total time
+        counters - counter name -> value
+    """
+    with _lock:
+        stats = sorted(_stats.items(), key=lambda item: item[1][1], reverse=True)
+        counters = dict(sorted(_counters.items()))
+    return {
+        "spans": {
+            name: {
+                "count": number,
+                "total_s": round(total / 1e9, 6),
+                "mean_ms": round(total / number / 1e6, 4),
+                "max_ms": round(longest / 1e6, 4),
+            }
+            for name, (number, total, longest) in stats
+        },
+        "counters": counters,
+    }
+
+
+def print_summary():
+    report = summary()
+    print(f"{'span':28} | {'count':>9} | {'total s':>9} | {'mean ms':>9} | {'max ms':>9}")
+    for name, stats in report["spans"].items():
+        print(
+            f"{name:28} | {stats['count']:9} | {stats['total_s']:9.3f} | {stats['mean_ms']:9.3f}"
+            f" | {stats['max_ms']:9.3f}"
+        )
+    for name, value in report["counters"].items():
+        print(f"{name:28} | {value:9}")
+
+
+def write_summary(filename):
+    """
+    Write summary() to a JSON file
+    """
+    with open(filename, "w", encoding="utf-8") as file:
+        json.dump(summary(), file, indent=2)
+
+
+def write_chrome_trace(filename):
+    """
+    Write the timeline (enable(timeline=True)) in the Chrome trace format: open it in chrome://tracing
+    or https://ui.perfetto.dev. The counters and the summary are in its metadata.
+    """
+    with _lock:
+        events = list(_events)
+        thread_names = dict(_thread_names)
+    # name the threads (ThreadPoolExecutor-0_1, MainThread ...)
+    metadata = [
+        {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+        for tid, name in thread_names.items()
+    ]
+    with open(filename, "w", encoding="utf-8") as file:
+        json.dump(
+            {"traceEvents": metadata + events, "displayTimeUnit": "ms", "otherData": summary()},
+            file,
+        )
+
+
+@contextmanager
+def profile(filename=None, top=25):
+    """
+    cProfile the block (the calling thread only), then print the top functions by cumulative time
+
+    PARAM: filename (str) - also save the stats there (for pstats / snakeviz), optional
+    PARAM: top (int) - number of functions printed
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if filename:
+            profiler.dump_stats(filename)
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(top)
+
+
+def _enable_from_environment():
+    trace = os.environ.get("LAB3_TRACE", "")
+    if trace:
+        timeline_file = trace if trace.endswith(".json") else None
+        enable(timeline=timeline_file is not None)
+
+        def report():
+            print_summary()
+            if timeline_file:
+                write_chrome_trace(timeline_file)
+
+        atexit.register(report)
+
+    profile_file = os.environ.get("LAB3_PROFILE", "")
+    if profile_file:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        def save_profile():
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+
+        atexit.register(save_profile)
+
+
+_enable_from_environment()
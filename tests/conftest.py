@@ -0,0 +1,8 @@
+"""
+Tests of the lab3 modules: the modules are at the top of the repository (run: python -m pytest tests)
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,68 @@
+"""
+Tests of the database layer: the back end's insert paths (lab3back.py) and the front end's queries (lab3db.py)
+"""
+
+import lab3back
+
+
+def make_restaurant(index, **fields):
+    """
+    RETURN: a restaurant dictionary, as read from the JSON file (fields override the defaults)
+    """
+    restaurant = {
+        "name": f"Restaurant {index}",
+        "url": f"https://guide.michelin.com/us/en/california/san-jose/restaurant/restaurant-{index}",
+        "location": "San Jose, USA",
+        "cost": "$$",
+        "cuisine": "Japanese",
+        "address": f"{index} N. First St., San Jose, 95112, USA",
+    }
+    restaurant.update(fields)
+    return restaurant
+
+
+def cuisines_of(conn, url):
+    """
+    RETURN: the cuisine names linked to the restaurant, in their order
+    """
+    rows = conn.execute(
+        "SELECT C.cuisine_name FROM RestaurantCuisine RC "
+        "JOIN Cuisine C ON RC.cuisine_id = C.cuisine_id "
+        "JOIN Restaurant R ON RC.restaurant_id = R.restaurant_id "
+        "WHERE R.restaurant_url = ? ORDER BY RC.position",
+        (url,),
+    )
+    return [name for (name,) in rows]
+
+
+def test_insert_repeated_url_keeps_cuisines(tmp_path):
+    conn = lab3back.create_database(str(tmp_path / "restaurants.db"))
+    first = make_restaurant(1, cuisine="Japanese, Sushi")
+    lab3back.insert_into_database(conn, [first])
+    lab3back.insert_into_database(conn, [make_restaurant(1, cuisine="Thai, Vegan")])
+
+    assert conn.execute("SELECT COUNT(*) FROM Restaurant").fetchone()[0] == 1
+    assert cuisines_of(conn, first["url"]) == ["Japanese", "Sushi"]
+    conn.close()
+
+
+def test_bulk_insert_in_open_transaction(tmp_path):
+    """
+    bulk_insert_into_database() in a transaction the caller opened is part of it: no nested BEGIN,
+    and the caller's rollback undoes the load too
+    """
+    conn = lab3back.create_database(str(tmp_path / "restaurants.db"))
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"  # (tuned once by create_database())
+
+    conn.execute("INSERT INTO Cost (cost_symbol) VALUES ('$$$$$')")
+    assert conn.in_transaction
+    assert lab3back.bulk_insert_into_database(conn, [make_restaurant(1), make_restaurant(2)]) == 2
+    assert conn.in_transaction
+    conn.rollback()
+    assert conn.execute("SELECT COUNT(*) FROM Restaurant").fetchone()[0] == 0
+
+    # no transaction open: the load commits its own
+    lab3back.bulk_insert_into_database(conn, [make_restaurant(1), make_restaurant(2)])
+    assert not conn.in_transaction
+    assert conn.execute("SELECT COUNT(*) FROM Restaurant").fetchone()[0] == 2
+    conn.close()
@@ -0,0 +1,32 @@
+"""
+Tests of the Restaurant record (lab3back.py)
+"""
+import pickle
+
+import lab3back
+
+
+def test_restaurant_interns_strings():
+    """
+    The repeated fields (cost, cuisine, location) are interned: equal strings are the same object
+    """
+    first = lab3back.Restaurant(location="".join(["San ", "Jose"]), cost="$$", cuisine="Thai")
+    second = lab3back.Restaurant(location="San Jose", cost="".join(["$", "$"]), cuisine="Thai")
+    assert first.location is second.location and first.cost is second.cost
+
+    second["cuisine"] = "".join(["Th", "ai"])
+    assert first.cuisine is second.cuisine
+
+
+def test_restaurant_none_fields():
+    """
+    None (a JSON null, a NULL column) is accepted in every field, also the interned ones, and kept as is
+    """
+    restaurant = lab3back.Restaurant.from_dict({"name": "Sushi", "url": "/sushi", "cost": None, "cuisine": None})
+    assert restaurant["cost"] is None and restaurant["cuisine"] is None
+    assert restaurant["location"] == "N/A"
+
+    restaurant["location"] = None
+    assert restaurant.location is None
+    assert pickle.loads(pickle.dumps(restaurant)) == restaurant
+    assert lab3back.Restaurant(*restaurant.to_tuple()) == restaurant
@@ -0,0 +1,258 @@
+"""
+Tests of the scraper (lab3back.py) against the local stand-in of the Michelin Guide (lab3bench.StubMichelinSite)
+"""
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from urllib.parse import urlsplit
+
+import pytest
+
+import lab3back
+from lab3bench import DIRECTORY_PATH, StubMichelinSite
+
+# Path of a restaurant page of the stand-in site with 100 restaurants
+TEST_PAGE_PATH = "/100/us/en/california/san-jose/restaurant/restaurant-1"
+
+# Saved pages of the Michelin Guide (markup of the live site: head scripts, nested cards, pagination, entities)
+FIXTURES_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+@pytest.fixture
+def site(monkeypatch):
+    """
+    The stand-in site with 200 restaurants (several directory pages), used by a client without cache
+    """
+    with StubMichelinSite() as site:
+        monkeypatch.setattr(lab3back, "SITE_URL", f"{site.url}/200")
+        previous = lab3back.set_scraper_client(lab3back.ScraperClient(backoff_factor=0.01, max_backoff=0.1))
+        yield site
+        lab3back.set_scraper_client(previous)
+
+
+def read_fixture(filename):
+    """
+    RETURN: the content (bytes) of a saved page of the fixtures directory
+    """
+    with open(os.path.join(FIXTURES_DIRECTORY, filename), "rb") as file:
+        return file.read()
+
+
+def new_threads(before):
+    """
+    RETURN: names of the threads started since before (set of threads), but the stand-in site's request threads
+    """
+    return sorted(
+        thread.name
+        for thread in set(threading.enumerate()) - before
+        if "process_request_thread" not in thread.name
+    )
+
+
+class FailingSink:
+    """
+    Sink that raises after a few rows, stopping the pipeline's writer early
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def write(self, restaurant):
+        self.rows -= 1
+        if self.rows < 0:
+            raise RuntimeError("sink failed")
+
+    def close(self):
+        pass
+
+
+def test_pipeline_early_stop_stops_stages(site, tmp_path, monkeypatch):
+    """
+    When the writer stops early, run_pipeline() closes every stage before returning:
+    no queue_stage() thread or executor thread is left running
+    """
+    monkeypatch.setattr(lab3back, "open_sink", lambda filename: FailingSink(5))
+    conn = lab3back.create_database(str(tmp_path / "restaurants.db"))
+    before = set(threading.enumerate())
+    with pytest.raises(RuntimeError, match="sink failed"):
+        lab3back.run_pipeline(conn, [lab3back.SITE_URL + DIRECTORY_PATH], "restaurants.jsonl", queue_size=2)
+    conn.close()
+
+    assert new_threads(before) == []
+    assert site.requests < 200, "the stages kept crawling after the writer stopped"
+
+
+def test_response_cache_revalidation(tmp_path):
+    """
+    The ResponseCache revalidates a stale page with a conditional GET (If-None-Match):
+        - 304 Not Modified: the cached body and parse result are used, counted in not_modified
+        - the server ignores the validators (200): the new body is stored, its old parse result dropped
+        - a fresh page is served from the cache without a request, counted in cache_hits
+    """
+    with StubMichelinSite() as site:
+        site.etags = True
+        url = site.url + TEST_PAGE_PATH
+        cache = lab3back.ResponseCache(str(tmp_path / "http_cache.db"), max_age=0)
+        client = lab3back.ScraperClient(backoff_factor=0.01, max_backoff=0.1, cache=cache)
+
+        # miss: normal GET, stored with its ETag
+        first = client.fetch(url)
+        assert not first.from_cache and first.parsed is None
+        assert cache.lookup(url)["etag"]
+        client.store_parsed(first, {"address": "1 N. First St."})
+
+        # stale entry, 304
+        requests = site.requests
+        second = client.fetch(url)
+        assert second.from_cache and second.content == first.content
+        assert second.parsed == {"address": "1 N. First St."}
+        assert site.requests == requests + 1 and site.not_modified == 1
+
+        # stale entry, the server answers 200 anyway
+        site.not_modified_responses = False
+        third = client.fetch(url)
+        assert not third.from_cache and third.content == first.content and third.parsed is None
+        assert site.not_modified == 1
+
+        # fresh entry: no request
+        cache.max_age = 3600
+        requests = site.requests
+        fourth = client.fetch(url)
+        assert fourth.from_cache and site.requests == requests
+
+        stats = client.stats()
+        assert stats["cache_hits"] == 1 and stats["not_modified"] == 1, stats
+        assert stats["requests"] == 3 and stats["failures"] == 0, stats
+        cache.close()
+
+
+def test_rate_limiter_throttling():
+    """
+    The HostRateLimiter backs off when the site throttles the scraper (429 + Retry-After), then recovers:
+        - the retries wait for Retry-After, and the host's rate is halved per 429
+        - the page is still fetched (the 429s are retries, not failures)
+        - the successful requests bring the rate back up to the base rate
+    """
+    rate = 20.0
+    with StubMichelinSite() as site:
+        limiter = lab3back.HostRateLimiter(rate=rate, burst=1)
+        client = lab3back.ScraperClient(backoff_factor=0.01, max_backoff=0.1, rate_limiter=limiter)
+        host = urlsplit(site.url).netloc
+
+        site.throttle(2, retry_after="0.3")
+        start = time.monotonic()
+        response = client.get(site.url + TEST_PAGE_PATH)
+        seconds = time.monotonic() - start
+        assert response.status_code == 200
+        assert site.throttled == 2
+        assert seconds >= 0.6, f"the retries didn't wait for Retry-After ({seconds:.2f} s)"
+        stats = client.stats()
+        assert stats["retries"] == 2 and stats["failures"] == 0, stats
+        assert stats["rate_limiter"]["throttled"] == {host: 2}
+        slowed = stats["rate_limiter"]["rates"][host]
+        assert slowed < rate / 2, f"the rate wasn't lowered ({slowed})"
+
+        # recovery: RECOVERY_STEP of the base rate back per successful request
+        for _ in range(int(1 / lab3back.RECOVERY_STEP) + 1):
+            client.get(site.url + TEST_PAGE_PATH)
+        assert limiter.stats()["rates"][host] == rate
+
+        # without Retry-After the slowdown alone spaces the retries out
+        site.throttle(1)
+        assert client.get(site.url + TEST_PAGE_PATH).status_code == 200
+        assert limiter.stats()["rates"][host] == rate * lab3back.SLOWDOWN_FACTOR + rate * lab3back.RECOVERY_STEP
+
+
+def http_date(seconds):
+    """
+    RETURN: the HTTP date (str, like a Retry-After header) seconds from now
+    """
+    return format_datetime(datetime.now(timezone.utc) + timedelta(seconds=seconds), usegmt=True)
+
+
+def test_parse_retry_after():
+    """
+    Retry-After is a number of seconds or an HTTP date; a missing or malformed value is None
+    """
+    assert lab3back.parse_retry_after("0.3") == 0.3
+    assert lab3back.parse_retry_after("-5") == 0.0
+    assert 8 <= lab3back.parse_retry_after(http_date(10)) <= 10
+    assert lab3back.parse_retry_after(http_date(-60)) == 0.0  # (date in the past: no wait)
+    for value in (None, "", "soon", "Sun, 99 Foo 2023 25:61:00 GMT"):
+        assert lab3back.parse_retry_after(value) is None, value
+
+
+def test_rate_limiter_throttling_retry_after_date_or_malformed():
+    """
+    A Retry-After HTTP date makes the retry wait until that date; a malformed Retry-After is ignored:
+    the host is only slowed down, and the page is still fetched
+    """
+    rate = 20.0
+    with StubMichelinSite() as site:
+        limiter = lab3back.HostRateLimiter(rate=rate, burst=1)
+        client = lab3back.ScraperClient(backoff_factor=0.01, max_backoff=0.1, rate_limiter=limiter)
+        host = urlsplit(site.url).netloc
+
+        # HTTP date (second resolution): at least 1 s away
+        site.throttle(1, retry_after=http_date(2))
+        start = time.monotonic()
+        assert client.get(site.url + TEST_PAGE_PATH).status_code == 200
+        seconds = time.monotonic() - start
+        assert seconds >= 1.0, f"the retry didn't wait for the Retry-After date ({seconds:.2f} s)"
+
+        # malformed: no wait for it, but the slowdown
+        site.throttle(1, retry_after="soon")
+        start = time.monotonic()
+        assert client.get(site.url + TEST_PAGE_PATH).status_code == 200
+        seconds = time.monotonic() - start
+        assert seconds < 1.0, f"the retry waited for a malformed Retry-After ({seconds:.2f} s)"
+
+        stats = client.stats()
+        assert stats["retries"] == 2 and stats["failures"] == 0, stats
+        assert stats["rate_limiter"]["throttled"] == {host: 2}
+        assert stats["rate_limiter"]["rates"][host] < rate
+
+
+def test_parse_directory_page_saved_page(monkeypatch):
+    """
+    On a saved directory page, the lxml fast path gives the same cards and next page as the BeautifulSoup
+    reference (the sponsored card of another layout is skipped by both), also on the last page
+    """
+    monkeypatch.setattr(lab3back, "SITE_URL", "https://guide.michelin.com")
+    content = read_fixture("directory_page.html")
+
+    restaurants, next_url = lab3back.parse_directory_page(content)
+    assert (restaurants, next_url) == lab3back.parse_directory_page_bs4(content)
+    assert [restaurant.name for restaurant in restaurants] == [
+        "Adega", "Luna Mexican Kitchen", "Zeni Ethiopian Restaurant", "Orchard City Kitchen",
+        "Phở Y #1 Noodle House & Café",
+    ]
+    assert restaurants[0] == lab3back.Restaurant(
+        name="Adega",
+        url="https://guide.michelin.com/us/en/california/san-jose/restaurant/adega",
+        location="San Jose, USA",
+        cost="$$$$",
+        cuisine="Portuguese",
+    )
+    assert restaurants[3].cuisine == "Small eats, Fusion" and restaurants[4].location == "San José, USA"
+    assert next_url == "https://guide.michelin.com/us/en/california/san-jose/restaurants/page/3"
+
+    # last page: no right arrow, the page number links aren't the next page
+    last_page = content.replace(b"fa-angle-right", b"fa-angle-double-right")
+    assert lab3back.parse_directory_page(last_page) == lab3back.parse_directory_page_bs4(last_page)
+    assert lab3back.parse_directory_page(last_page)[1] is None
+
+
+def test_parse_restaurant_address_saved_page():
+    """
+    On a saved restaurant page (mobile and desktop headings), the lxml fast path and the BeautifulSoup
+    reference give the same address, and both give "" for a page without address
+    """
+    content = read_fixture("restaurant_page.html")
+    address = lab3back.parse_restaurant_address(content)
+    assert address == lab3back.parse_restaurant_address_bs4(content) == "1614 Alum Rock Ave., San Jose, 95116, USA"
+
+    no_address = content.replace(b"restaurant-details__heading--address", b"restaurant-details__heading--phone")
+    assert lab3back.parse_restaurant_address(no_address) == lab3back.parse_restaurant_address_bs4(no_address) == ""